@@ -9,9 +9,10 @@ from elfi.methods.parameter_inference import *
 from elfi.methods.post_processing import adjust_posterior
 from elfi.model.elfi_model import *
 from elfi.model.extensions import ScipyLikeDistribution as Distribution
-from elfi.store import OutputPool, ArrayPool
+from elfi.store import OutputPool, ArrayPool, CachedArrayPool
 from elfi.visualization.visualization import nx_draw as draw
 from elfi.methods.bo.gpy_regression import GPyRegression
+from elfi.methods.bo.gp_regression import GPRegression, SparseGPRegression
 
 __author__ = 'ELFI authors'
 __email__ = 'elfi-support@hiit.fi'
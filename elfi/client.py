@@ -1,14 +1,16 @@
 import logging
+from math import ceil
 from types import ModuleType
 from collections import OrderedDict
 
 import networkx as nx
+import numpy as np
 
 from elfi.executor import Executor
 from elfi.compiler import OutputCompiler, ObservedCompiler, AdditionalNodesCompiler, \
     ReduceCompiler, RandomStateCompiler
 from elfi.loader import ObservedLoader, AdditionalNodesLoader, RandomStateLoader, \
-    PoolLoader
+    PoolLoader, DtypeLoader
 from elfi.store import OutputPool
 
 logger = logging.getLogger(__name__)
@@ -53,6 +55,9 @@ class BatchHandler:
         self.context = context
         self.client = client
 
+        # Acceptance condition (node, threshold) evaluated in the workers, see `Executor`
+        self.accept = None
+
         self._next_batch_index = 0
         self._pending_batches = OrderedDict()
 
@@ -137,6 +142,8 @@ class BatchHandler:
         loaded_net = self.client.load_data(self.compiled_net, self.context, batch_index)
         # Override
         for k,v in batch.items(): loaded_net.node[k] = {'output': v}
+        if self.accept is not None:
+            loaded_net.graph['accept'] = self.accept
 
         task_id = self.client.submit(loaded_net)
         self._pending_batches[batch_index] = task_id
@@ -167,6 +174,135 @@ class BatchHandler:
         return self.client.num_cores
 
 
+class PoolReplay:
+    """Recomputes nodes of a model over large chunks of batches stored in a pool.
+
+    Useful e.g. after changing the summaries or the discrepancy of a model whose
+    simulations are stored in an `OutputPool`. Stores that contain all of the requested
+    batches are used as inputs and the rest of the nodes are evaluated for many batches
+    at once. The chunks are computed in parallel in the client.
+
+    Only deterministic nodes can be recomputed, i.e. the stored nodes must cut all the
+    paths from the stochastic nodes to the requested outputs. Nodes using `_meta` will
+    receive the information of the first batch of the chunk.
+    """
+
+    def __init__(self, model, context, output_names, start=0, stop=None, client=None):
+        """
+
+        Parameters
+        ----------
+        model : ElfiModel
+            The (possibly modified) model that produced the pool.
+        context : ComputationContext
+            Context with the pool to replay.
+        output_names : list
+            Names of the nodes to compute.
+        start : int, optional
+            First batch index to replay.
+        stop : int, optional
+            Batch index after the last one to replay. Defaults to `len(pool)`.
+        client : ClientBase, optional
+        """
+        pool = context.pool
+        if pool is None:
+            raise ValueError('Context has no pool to replay')
+
+        self.client = client or get_client()
+        self.context = context
+        self.pool = pool
+        self.output_names = list(output_names)
+        self.start = start
+        self.stop = len(pool) if stop is None else stop
+
+        self.compiled_net = self.client.compile(model.source_net, self.output_names)
+        self.input_names = self._find_inputs()
+
+    @property
+    def n_batches(self):
+        return self.stop - self.start
+
+    def _find_inputs(self):
+        """Find the stored nodes that have all the batches and check that they suffice
+        for computing the outputs without simulating."""
+        inputs = []
+        for node, store in self.pool.stores.items():
+            if store is None or not self.compiled_net.has_node(node):
+                continue
+            if all(bi in store for bi in range(self.start, self.stop)):
+                inputs.append(node)
+
+        net = self._load(self.start, self.start + 1)
+        for node in inputs:
+            net.node[node] = {'output': None}
+        for node in Executor.get_execution_order(net):
+            if self.compiled_net.has_edge('_random_state', node):
+                raise ValueError("Cannot replay the pool: node '{}' is stochastic and "
+                                 "its output is not stored for batches {}-{}."
+                                 .format(node, self.start, self.stop - 1))
+        return inputs
+
+    def compute(self, batches_per_chunk=None, pool=None):
+        """Compute the outputs over the batches.
+
+        Parameters
+        ----------
+        batches_per_chunk : int, optional
+            Number of batches computed at once. Defaults to an even split of the
+            batches to the cores of the client.
+        pool : OutputPool, optional
+            If given, the computed outputs are also added batchwise to the stores of
+            this pool, e.g. for storing new discrepancies.
+
+        Returns
+        -------
+        outputs : dict
+            Outputs concatenated over the batches.
+        """
+        batch_size = self.context.batch_size
+        if batches_per_chunk is None:
+            batches_per_chunk = ceil(self.n_batches / max(self.num_cores, 1))
+        batches_per_chunk = max(int(batches_per_chunk), 1)
+
+        task_ids = []
+        for chunk_start in range(self.start, self.stop, batches_per_chunk):
+            chunk_stop = min(chunk_start + batches_per_chunk, self.stop)
+            loaded_net = self._load_chunk(chunk_start, chunk_stop)
+            task_ids.append((chunk_start, self.client.submit(loaded_net)))
+
+        outputs = {node: [] for node in self.output_names}
+        for chunk_start, task_id in task_ids:
+            chunk = self.client.get_result(task_id)
+            for node in self.output_names:
+                outputs[node].append(chunk[node])
+            if pool is not None:
+                n_chunk = len(chunk[self.output_names[0]]) // batch_size
+                for i in range(n_chunk):
+                    sl = slice(i*batch_size, (i + 1)*batch_size)
+                    pool.add_batch({k: v[sl] for k, v in chunk.items()}, chunk_start + i)
+
+        return {node: np.concatenate(v) for node, v in outputs.items()}
+
+    def _load(self, start, stop):
+        context = self.context.copy()
+        context.pool = None
+        context.batch_size = (stop - start)*self.context.batch_size
+        return self.client.load_data(self.compiled_net, context, start)
+
+    def _load_chunk(self, start, stop):
+        loaded_net = self._load(start, stop)
+        for node in self.input_names:
+            data = self.pool.get_range(node, start, stop)
+            if not isinstance(data, np.ndarray):
+                data = np.concatenate(list(data))
+            loaded_net.node[node] = {'output': data}
+        return loaded_net
+
+    @property
+    def num_cores(self):
+        return self.client.num_cores
+
+
 class ClientBase:
     """Client api for serving multiple simultaneous inferences"""
 
@@ -269,5 +405,6 @@ class ClientBase:
         loaded_net = AdditionalNodesLoader.load(context, loaded_net, batch_index)
         loaded_net = RandomStateLoader.load(context, loaded_net, batch_index)
         loaded_net = PoolLoader.load(context, loaded_net, batch_index)
+        loaded_net = DtypeLoader.load(context, loaded_net, batch_index)
 
         return loaded_net
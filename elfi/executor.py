@@ -2,6 +2,9 @@ import logging
 from operator import itemgetter
 
 import networkx as nx
+import numpy as np
+
+from elfi.utils import is_array
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +21,9 @@ class Executor:
 
     outputs : list
         lists all the names of the nodes whose outputs are returned.
+    accept : tuple, optional
+        (node, threshold). Only the rows of the outputs where the output of the node is
+        smaller than or equal to the threshold are returned.
 
 
     ### Keys in edge dictionaries, G[parent_name][child_name]
@@ -78,8 +84,19 @@ class Executor:
 
         # Make a result dict based on the requested outputs
         result = {k:G.node[k]['output'] for k in G.graph['outputs']}
+
+        if G.graph.get('accept') is not None:
+            result = cls._accept(result, *G.graph['accept'])
         return result
 
+    @staticmethod
+    def _accept(result, node, threshold):
+        """Filter the rows of the batch outputs by the output of the node."""
+        values = np.asarray(result[node])
+        mask = values.reshape(len(values), -1)[:, 0] <= threshold
+        return {k: v[mask] if is_array(v) and len(v) == len(mask) else v
+                for k, v in result.items()}
+
 
     @classmethod
     def get_execution_order(cls, G):
@@ -1,6 +1,8 @@
+from functools import partial
+
 import numpy as np
 
-from elfi.utils import observed_name, get_sub_seed, is_array
+from elfi.utils import observed_name, get_sub_seed, is_array, cast_floats
 
 
 class Loader:
@@ -72,13 +74,19 @@ class PoolLoader(Loader):
 
         batch = context.pool.get_batch(batch_index)
 
+        # Batches are usually loaded in order, so start reading the next ones
+        read_ahead = getattr(context.pool, 'read_ahead', 0)
+        if read_ahead:
+            context.pool.prefetch(range(batch_index + 1, batch_index + 1 + read_ahead))
+
         for node in context.pool.stores:
             if not compiled_net.has_node(node):
                 continue
             elif node in batch:
                 compiled_net.node[node]['output'] = batch[node]
                 compiled_net.node[node].pop('operation', None)
-            elif node not in compiled_net.graph['outputs']:
+            elif node not in compiled_net.graph['outputs'] and \
+                    context.pool.keeps(node, batch, batch_index):
                 # We are missing this item from the batch so add the output to the
                 # requested outputs so that it can be stored when the results arrive
                 compiled_net.graph['outputs'].append(node)
@@ -86,6 +94,35 @@ class PoolLoader(Loader):
         return compiled_net
 
 
+class DtypeLoader(Loader):
+    """
+    Cast the floating point outputs of the nodes to the dtypes of the context
+    """
+
+    @classmethod
+    def load(cls, context, compiled_net, batch_index):
+        dtypes = getattr(context, 'dtype', None)
+        if not dtypes:
+            return compiled_net
+
+        for node, dtype in dtypes.items():
+            for name in (node, observed_name(node)):
+                if not compiled_net.has_node(name):
+                    continue
+                attr = compiled_net.node[name]
+                if 'operation' in attr:
+                    attr['operation'] = partial(_cast_operation, attr['operation'],
+                                                np.dtype(dtype))
+                elif 'output' in attr:
+                    attr['output'] = cast_floats(attr['output'], dtype)
+
+        return compiled_net
+
+
+def _cast_operation(operation, dtype, *args, **kwargs):
+    return cast_floats(operation(*args, **kwargs), dtype)
+
+
 # We use a getter function so that the local process np.random doesn't get
 # copied to the loaded_net.
 def get_np_random():
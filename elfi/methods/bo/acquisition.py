@@ -1,9 +1,11 @@
 import logging
+from functools import partial
 
 import numpy as np
-from scipy.stats import uniform, truncnorm
+from scipy.special import log_ndtr
+from scipy.stats import norm, uniform, truncnorm
 
-from elfi.methods.bo.utils import minimize
+from elfi.methods.bo.utils import multistart_minimize
 
 
 logger = logging.getLogger(__name__)
@@ -15,9 +17,38 @@ class AcquisitionBase:
     Gaussian noise ~N(0, self.noise_var) is added to the acquired points. By default,
     noise_var=0. You can define a different variance for the separate dimensions.
 
+    By default a batch of points consists of copies of the minimum of the acquisition
+    function. With a `batch_method` the points of a batch are distinct:
+
+    'kriging_believer'
+        Each acquired point is added to a copy of the model with its predicted mean as
+        the outcome before acquiring the next one.
+    'constant_liar'
+        As 'kriging_believer' but the outcome is the minimum of the evidence.
+    'local_penalization'
+        The acquisition function is penalized around the acquired points by the
+        Lipschitz constant of the model mean (Gonzalez et al., 2016).
+
+    Points still under evaluation may be given to `acquire` as `pending`. They are
+    handled as already acquired points of the batch.
+
+    References
+    ----------
+    J. Gonzalez, Z. Dai, P. Hennig, and N. Lawrence. Batch Bayesian optimization via
+    local penalization. In Proc. International Conference on Artificial Intelligence and
+    Statistics (AISTATS), 2016.
+
+    D. Ginsbourger, R. Le Riche, and L. Carraro. Kriging is well-suited to parallelize
+    optimization. In Computational Intelligence in Expensive Optimization Problems,
+    Springer, 2010.
+
     """
-    def __init__(self, model, prior=None, n_inits=10, max_opt_iters=1000, noise_var=None,
-                 exploration_rate=10, seed=None):
+
+    batch_methods = ('kriging_believer', 'constant_liar', 'local_penalization')
+
+    def __init__(self, model, prior=None, n_inits=40, max_opt_iters=1000, noise_var=None,
+                 exploration_rate=10, seed=None, batch_method=None, n_candidates=1000,
+                 client=None):
         """
 
         Parameters
@@ -30,7 +61,7 @@ class AcquisitionBase:
         prior
             By default uniform distribution within model bounds.
         n_inits : int, optional
-            Number of initialization points in internal optimization.
+            Number of candidate points refined in internal optimization.
         max_opt_iters : int, optional
             Max iterations to optimize when finding the next point.
         noise_var : float or np.array, optional
@@ -42,12 +73,22 @@ class AcquisitionBase:
         seed : int, optional
             Seed for getting consistent acquisition results. Used in getting random
             starting locations in acquisition function optimization.
+        batch_method : str, optional
+            How to acquire distinct points for a batch, one of 'kriging_believer',
+            'constant_liar' or 'local_penalization'. Default is to copy the minimum.
+        n_candidates : int, optional
+            Number of quasi-random candidate points evaluated at once in internal
+            optimization. The best `n_inits` of them are refined.
+        client : elfi.client.ClientBase, optional
+            Refine the candidate points in parallel in the client instead of in lockstep.
         """
 
         self.model = model
         self.prior = prior
         self.n_inits = int(n_inits)
         self.max_opt_iters = int(max_opt_iters)
+        self.n_candidates = int(n_candidates)
+        self.client = client
 
         if noise_var is not None and np.asanyarray(noise_var).ndim > 1:
             raise ValueError("Noise variance must be a float or 1d vector of variances "
@@ -56,6 +97,11 @@ class AcquisitionBase:
         self.exploration_rate = exploration_rate
         self.random_state = np.random if seed is None else np.random.RandomState(seed)
 
+        if batch_method is not None and batch_method not in self.batch_methods:
+            raise ValueError("Unknown batch method {}. Use one of {}."
+                             .format(batch_method, ', '.join(self.batch_methods)))
+        self.batch_method = batch_method
+
     def evaluate(self, x, t=None):
         """Evaluates the acquisition function value at 'x'.
 
@@ -78,7 +124,7 @@ class AcquisitionBase:
         """
         raise NotImplementedError
 
-    def acquire(self, n, t=None):
+    def acquire(self, n, t=None, pending=None):
         """Returns the next batch of acquisition points.
 
         Gaussian noise ~N(0, self.noise_var) is added to the acquired points.
@@ -89,7 +135,9 @@ class AcquisitionBase:
             Number of acquisition points to return.
         t : int
             Current acq_batch_index (starting from 0).
-        random_state : np.random.RandomState, optional
+        pending : np.ndarray, optional
+            Points under evaluation with shape (n_pending, input_dim). Used only with
+            a `batch_method`.
 
         Returns
         -------
@@ -98,19 +146,126 @@ class AcquisitionBase:
         """
         logger.debug('Acquiring the next batch of {} values'.format(n))
 
-        # Optimize the current minimum
-        obj = lambda x: self.evaluate(x, t)
-        grad_obj = lambda x: self.evaluate_gradient(x, t)
-        xhat, _ = minimize(obj, self.model.bounds, grad_obj, self.prior, self.n_inits,
-                           self.max_opt_iters, random_state=self.random_state)
+        if pending is not None:
+            pending = np.asarray(pending, dtype=np.float64)
+            pending = pending.reshape((-1, self.model.input_dim))
+
+        if self.batch_method is None:
+            # Create n copies of the current minimum
+            x = np.tile(self._minimize(t), (n, 1))
+        elif self.batch_method == 'local_penalization':
+            x = self._acquire_penalized(n, t, pending)
+        else:
+            x = self._acquire_fantasized(n, t, pending)
 
-        # Create n copies of the minimum
-        x = np.tile(xhat, (n, 1))
         # Add noise for more efficient fitting of GP
         x = self._add_noise(x)
 
         return x
 
+    def _minimize(self, t, obj=None, grad_obj=None):
+        """Return the minimum of the acquisition function or of obj if given."""
+        if obj is None:
+            obj = partial(self.evaluate, t=t)
+            grad_obj = partial(self.evaluate_gradient, t=t)
+        xhat, _ = multistart_minimize(obj, self.model.bounds, grad_obj, self.prior,
+                                      self.n_inits, self.max_opt_iters,
+                                      random_state=self.random_state,
+                                      n_candidates=self.n_candidates, client=self.client)
+        return xhat
+
+    def _acquire_fantasized(self, n, t, pending):
+        """Acquire points one at a time adding each to a copy of the model with a
+        fantasized outcome."""
+        model = self.model
+        lie = None
+        if self.batch_method == 'constant_liar':
+            lie = np.min(model.Y) if model.n_evidence > 0 else 0.
+
+        def fantasize(x):
+            y = np.full((len(x), 1), lie) if lie is not None else \
+                self.model.predict_mean(x)
+            self.model.update(x, y)
+
+        x = np.empty((n, model.input_dim))
+        self.model = model.copy()
+        try:
+            if pending is not None and len(pending) > 0:
+                fantasize(pending)
+            for i in range(n):
+                x[i] = self._minimize(t)
+                if i < n - 1:
+                    fantasize(x[i:i + 1])
+        finally:
+            self.model = model
+        return x
+
+    def _acquire_penalized(self, n, t, pending):
+        """Acquire points one at a time penalizing the acquisition function around the
+        points acquired so far."""
+        centers = [] if pending is None else list(pending)
+        L = self._lipschitz_constant()
+        M = np.min(self.model.Y) if self.model.n_evidence > 0 else 0.
+
+        x = np.empty((n, self.model.input_dim))
+        for i in range(n):
+            if len(centers) == 0:
+                x[i] = self._minimize(t)
+            else:
+                mean, var = self.model.predict(np.asarray(centers), noiseless=True)
+                radius = (mean[:, 0] - M)/L
+                std = np.sqrt(var[:, 0])/L
+                obj = partial(self._penalized, t=t, centers=np.array(centers),
+                              radius=radius, std=std)
+                x[i] = self._minimize(t, obj, partial(obj, gradient=True))
+            centers.append(x[i])
+        return x
+
+    def _lipschitz_constant(self, n_points=500):
+        """Estimate the Lipschitz constant of the model mean in the bounds."""
+        bounds = np.asarray(self.model.bounds)
+        x = self.random_state.uniform(bounds[:, 0], bounds[:, 1],
+                                      size=(n_points, len(bounds)))
+        if self.model.n_evidence > 0:
+            x = np.r_[x, self.model.X]
+        grad_mean = self.model.predictive_gradients(x)[0]
+        return max(np.max(np.sqrt(np.sum(grad_mean**2, axis=1))), 1e-7)
+
+    def _penalized(self, x, t, centers, radius, std, gradient=False):
+        """Negative log of the softplus transformed negative acquisition function times
+        the local penalizers, or its gradient."""
+        x = x.reshape((-1, self.model.input_dim))
+        z = -self.evaluate(x, t)[:, 0]
+        # log(softplus(z)) ~ z for small z
+        small = z < -30
+        g = np.logaddexp(0, np.where(small, 0, z))
+
+        diff = x[:, None, :] - np.asarray(centers)[None, :, :]
+        dist = np.sqrt(np.sum(diff**2, axis=2))
+        u = (dist - radius)/std
+        log_phi = log_ndtr(u)
+
+        if not gradient:
+            return np.where(small, -z, -np.log(g)) - np.sum(log_phi, axis=1)
+
+        dvalue = np.where(small, 1., np.exp(z - g)/g)
+        ratio = np.exp(norm.logpdf(u) - log_phi)/std/np.maximum(dist, 1e-12)
+        return dvalue[:, None]*self.evaluate_gradient(x, t) - \
+            np.einsum('qc,qcd->qd', ratio, diff)
+
+    def __getstate__(self):
+        # The acquisition function is pickled to the client without the client itself
+        state = self.__dict__.copy()
+        state['client'] = None
+        if state['random_state'] is np.random:
+            state['random_state'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.random_state is None:
+            self.random_state = np.random
+
     def _add_noise(self, x):
         # Add noise for more efficient fitting of GP
         if self.noise_var is not None:
@@ -219,7 +374,7 @@ class LCBSC(AcquisitionBase):
 
 class UniformAcquisition(AcquisitionBase):
 
-    def acquire(self, n, t=None):
+    def acquire(self, n, t=None, pending=None):
         bounds = np.stack(self.model.bounds)
         return uniform(bounds[:,0], bounds[:,1] - bounds[:,0])\
             .rvs(size=(n, self.model.input_dim), random_state=self.random_state)
@@ -0,0 +1,907 @@
+"""Gaussian process regression implemented with numpy and scipy.
+
+`GPRegression` has the same interface as `GPyRegression` but does not depend on GPy.
+The Cholesky factor of the covariance and the Woodbury vector are cached between
+predictions, new evidence is added with a rank-k update of the factor and the
+hyperparameters are fitted with analytic gradients of the log marginal likelihood.
+"""
+
+import copy
+import logging
+
+import numpy as np
+import scipy.linalg as sl
+import scipy.optimize
+
+from elfi.methods.bo.utils import resolve_bounds
+
+logger = logging.getLogger(__name__)
+
+
+class Kernel:
+    """Base class for the covariance functions of `GPRegression`.
+
+    The hyperparameters are positive and they are optimized in the log space. Each of
+    them may have a Gamma prior.
+    """
+
+    param_names = []
+
+    def __init__(self, input_dim):
+        self.input_dim = input_dim
+        self.priors = {}
+
+    def get_params(self):
+        """Return the hyperparameters as a 1d array."""
+        return np.concatenate([np.atleast_1d(getattr(self, name)) for name in
+                               self.param_names]).astype(np.float64)
+
+    def set_params(self, params):
+        """Set the hyperparameters from a 1d array in the order of `get_params`."""
+        i = 0
+        for name in self.param_names:
+            size = np.size(getattr(self, name))
+            value = np.asarray(params[i:i + size], dtype=np.float64)
+            setattr(self, name, value if np.ndim(getattr(self, name)) else value.item())
+            i += size
+
+    def set_prior(self, name, mean, var):
+        """Set a Gamma prior with the given mean and variance for a hyperparameter."""
+        if name not in self.param_names:
+            raise ValueError('Kernel {} has no parameter {}'.format(self, name))
+        self.priors[name] = (mean**2/var, mean/var)
+
+    def log_prior(self):
+        """Return the log prior density of the log hyperparameters and its gradient."""
+        value = 0.
+        grad = []
+        for name in self.param_names:
+            theta = np.atleast_1d(getattr(self, name))
+            if name in self.priors:
+                shape, rate = self.priors[name]
+                # The Jacobian of the log transform is included
+                value += np.sum(shape*np.log(theta) - rate*theta)
+                grad.append(shape - rate*theta)
+            else:
+                grad.append(np.zeros(len(theta)))
+        return value, np.concatenate(grad)
+
+    def K(self, X, X2=None):
+        """Return the covariance matrix between the rows of X and X2."""
+        raise NotImplementedError
+
+    def Kdiag(self, X):
+        """Return the variances at the rows of X."""
+        raise NotImplementedError
+
+    def gradients(self, X, X2=None):
+        """Return the derivatives of K(X, X2) with respect to the log hyperparameters."""
+        raise NotImplementedError
+
+    def gradients_diag(self, X):
+        """Return the derivatives of Kdiag(X) with respect to the log hyperparameters."""
+        return [np.diag(g) for g in self.gradients(X)]
+
+    def gradients_X(self, x, X):
+        """Return the derivatives of K(x, X) with respect to x in an array of shape
+        (len(x), len(X), input_dim)."""
+        raise NotImplementedError
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    def __add__(self, other):
+        return Sum(self, other)
+
+    def __str__(self):
+        params = ', '.join('{}={}'.format(name, np.round(getattr(self, name), 4))
+                           for name in self.param_names)
+        return '{}({})'.format(self.__class__.__name__, params)
+
+
+class Stationary(Kernel):
+    """Base class for the kernels depending on the scaled distance r of the inputs.
+
+    The kernels implement k(r) and g(r) = -k'(r)/r with unit variance.
+    """
+
+    param_names = ['variance', 'lengthscale']
+
+    def __init__(self, input_dim, variance=1., lengthscale=1.):
+        """
+
+        Parameters
+        ----------
+        input_dim : int
+        variance : float, optional
+        lengthscale : float or np.ndarray, optional
+            A single lengthscale or one for each input dimension.
+        """
+        super(Stationary, self).__init__(input_dim)
+        self.variance = float(variance)
+        self.lengthscale = lengthscale if np.ndim(lengthscale) == 0 else \
+            np.asarray(lengthscale, dtype=np.float64)
+
+    def _k(self, r):
+        raise NotImplementedError
+
+    def _g(self, r):
+        raise NotImplementedError
+
+    def _scaled_dist(self, X, X2):
+        X = X / self.lengthscale
+        X2 = X2 / self.lengthscale
+        r2 = np.sum(X**2, 1)[:, None] + np.sum(X2**2, 1)[None, :] - 2*X.dot(X2.T)
+        return np.sqrt(np.maximum(r2, 0))
+
+    def K(self, X, X2=None):
+        X2 = X if X2 is None else X2
+        return self.variance*self._k(self._scaled_dist(X, X2))
+
+    def Kdiag(self, X):
+        return np.full(len(X), self.variance)
+
+    def gradients(self, X, X2=None):
+        X2 = X if X2 is None else X2
+        r = self._scaled_dist(X, X2)
+        grads = [self.variance*self._k(r)]
+        g = self.variance*self._g(r)
+        if np.ndim(self.lengthscale) == 0:
+            grads.append(g*r**2)
+        else:
+            for j in range(self.input_dim):
+                d = X[:, j]/self.lengthscale[j]
+                d2 = X2[:, j]/self.lengthscale[j]
+                grads.append(g*(d[:, None] - d2[None, :])**2)
+        return grads
+
+    def gradients_diag(self, X):
+        # The variances do not depend on the lengthscales
+        grads = [self.Kdiag(X)]
+        grads.extend(np.zeros(len(X)) for _ in range(np.size(self.lengthscale)))
+        return grads
+
+    def gradients_X(self, x, X):
+        g = self.variance*self._g(self._scaled_dist(x, X))
+        diff = x[:, None, :] - X[None, :, :]
+        return -g[:, :, None]*diff/self.lengthscale**2
+
+
+class RBF(Stationary):
+    """Squared exponential kernel."""
+
+    def _k(self, r):
+        return np.exp(-.5*r**2)
+
+    def _g(self, r):
+        return np.exp(-.5*r**2)
+
+
+class Matern32(Stationary):
+    """Matern kernel with nu=3/2."""
+
+    def _k(self, r):
+        a = np.sqrt(3.)*r
+        return (1 + a)*np.exp(-a)
+
+    def _g(self, r):
+        return 3*np.exp(-np.sqrt(3.)*r)
+
+
+class Matern52(Stationary):
+    """Matern kernel with nu=5/2."""
+
+    def _k(self, r):
+        a = np.sqrt(5.)*r
+        return (1 + a + a**2/3)*np.exp(-a)
+
+    def _g(self, r):
+        a = np.sqrt(5.)*r
+        return 5/3*(1 + a)*np.exp(-a)
+
+
+class Bias(Kernel):
+    """Constant kernel corresponding to an unknown constant mean."""
+
+    param_names = ['variance']
+
+    def __init__(self, input_dim, variance=1.):
+        super(Bias, self).__init__(input_dim)
+        self.variance = float(variance)
+
+    def K(self, X, X2=None):
+        X2 = X if X2 is None else X2
+        return np.full((len(X), len(X2)), self.variance)
+
+    def Kdiag(self, X):
+        return np.full(len(X), self.variance)
+
+    def gradients(self, X, X2=None):
+        return [self.K(X, X2)]
+
+    def gradients_diag(self, X):
+        return [self.Kdiag(X)]
+
+    def gradients_X(self, x, X):
+        return np.zeros((len(x), len(X), self.input_dim))
+
+
+class Sum(Kernel):
+    """Sum of kernels."""
+
+    def __init__(self, *kernels):
+        super(Sum, self).__init__(kernels[0].input_dim)
+        self.parts = []
+        for kernel in kernels:
+            self.parts.extend(kernel.parts if isinstance(kernel, Sum) else [kernel])
+
+    def get_params(self):
+        return np.concatenate([k.get_params() for k in self.parts])
+
+    def set_params(self, params):
+        i = 0
+        for k in self.parts:
+            n = len(k.get_params())
+            k.set_params(params[i:i + n])
+            i += n
+
+    def log_prior(self):
+        priors = [k.log_prior() for k in self.parts]
+        return sum(p[0] for p in priors), np.concatenate([p[1] for p in priors])
+
+    def K(self, X, X2=None):
+        return sum(k.K(X, X2) for k in self.parts)
+
+    def Kdiag(self, X):
+        return sum(k.Kdiag(X) for k in self.parts)
+
+    def gradients(self, X, X2=None):
+        return [g for k in self.parts for g in k.gradients(X, X2)]
+
+    def gradients_diag(self, X):
+        return [g for k in self.parts for g in k.gradients_diag(X)]
+
+    def gradients_X(self, x, X):
+        return sum(k.gradients_X(x, X) for k in self.parts)
+
+    def __str__(self):
+        return ' + '.join(str(k) for k in self.parts)
+
+
+class GPRegression:
+    """Gaussian process regression with a Gaussian likelihood and a zero mean.
+
+    A drop-in replacement of `GPyRegression` that uses only numpy and scipy.
+
+    Parameters
+    ----------
+    parameter_names : list of str, optional
+        Names of parameter nodes. If None, sets dimension to 1.
+    bounds : dict, optional
+        The region where to estimate the posterior for each parameter in
+        model.parameters.
+        `{'parameter_name':(lower, upper), ... }`
+        If not supplied, defaults to (0, 1) bounds for all dimensions.
+    optimizer : str, optional
+        Method of `scipy.optimize.minimize` for the hyper parameters. Default 'L-BFGS-B'.
+    max_opt_iters : int, optional
+    kernel : Kernel, optional
+        Defaults to an RBF kernel with a bias term, with Gamma priors set by the
+        first evidence as in `GPyRegression`.
+    noise_var : float, optional
+        Initial noise variance. Defaults to max(y)**2/100 of the first evidence.
+
+    """
+
+    def __init__(self, parameter_names=None, bounds=None, optimizer='L-BFGS-B',
+                 max_opt_iters=50, kernel=None, noise_var=None):
+
+        input_dim, bounds = resolve_bounds(parameter_names, bounds)
+
+        self.input_dim = input_dim
+        self.bounds = bounds
+        self.optimizer = optimizer
+        self.max_opt_iters = max_opt_iters
+
+        self.kernel = kernel
+        self.noise_var = noise_var
+
+        self._X = None
+        self._Y = None
+        self._clear_cache()
+
+        self.is_sampling = False  # for compatibility with GPyRegression
+
+    def __str__(self):
+        return 'GPRegression with {} evidence\n  kernel: {}\n  noise_var: {}'\
+            .format(self.n_evidence, self.kernel, self.noise_var)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def _clear_cache(self):
+        self._L = None
+        self._alpha = None
+        self._K_inv = None
+
+    def predict(self, x, noiseless=False):
+        """Returns the GP model mean and variance at x.
+
+        Parameters
+        ----------
+        x : np.array
+            numpy compatible (n, input_dim) array of points to evaluate
+            if len(x.shape) == 1 will be cast to 2D with x[None, :]
+        noiseless : bool
+            whether to include the noise variance or not to the returned variance
+
+        Returns
+        -------
+        tuple
+            GP (mean, var) at x where
+                mean : np.array
+                    with shape (x.shape[0], 1)
+                var : np.array
+                    with shape (x.shape[0], 1)
+        """
+        x = np.asanyarray(x, dtype=np.float64).reshape((-1, self.input_dim))
+
+        if self._X is None:
+            return np.zeros((x.shape[0], 1)), np.ones((x.shape[0], 1))
+
+        L, alpha = self._factors()
+        K_x = self.kernel.K(x, self._X)
+        mean = K_x.dot(alpha)
+        v = sl.solve_triangular(L, K_x.T, lower=True)
+        var = self.kernel.Kdiag(x) - np.sum(v**2, axis=0)
+        if not noiseless:
+            var += self.noise_var
+        return mean, np.maximum(var, 1e-15)[:, None]
+
+    def predict_mean(self, x):
+        """Returns the GP model mean function at x.
+        """
+        return self.predict(x)[0]
+
+    def predictive_gradients(self, x):
+        """Return the gradients of the GP model mean and variance at x.
+
+        Parameters
+        ----------
+        x : np.array
+            numpy compatible (n, input_dim) array of points to evaluate
+            if len(x.shape) == 1 will be cast to 2D with x[None, :]
+
+        Returns
+        -------
+        tuple
+            GP (grad_mean, grad_var) at x where
+                grad_mean : np.array
+                    with shape (x.shape[0], input_dim)
+                grad_var : np.array
+                    with shape (x.shape[0], input_dim)
+        """
+        x = np.asanyarray(x, dtype=np.float64).reshape((-1, self.input_dim))
+
+        if self._X is None:
+            return np.zeros((x.shape[0], self.input_dim)), \
+                   np.zeros((x.shape[0], self.input_dim))
+
+        L, alpha = self._factors()
+        if self._K_inv is None:
+            self._K_inv = sl.cho_solve((L, True), np.eye(len(L)))
+
+        dK = self.kernel.gradients_X(x, self._X)
+        grad_mean = np.einsum('mnd,n->md', dK, alpha[:, 0])
+        grad_var = -2*np.einsum('mnd,mn->md', dK,
+                                self.kernel.K(x, self._X).dot(self._K_inv))
+        return grad_mean, grad_var
+
+    def predictive_gradient_mean(self, x):
+        """Return the gradient of the GP model mean at x.
+        """
+        return self.predictive_gradients(x)[0]
+
+    def update(self, x, y, optimize=False):
+        """Updates the GP model with new data
+        """
+        x = np.asarray(x, dtype=np.float64).reshape((-1, self.input_dim))
+        y = np.asarray(y, dtype=np.float64).reshape((-1, 1))
+
+        if self._X is None:
+            self._init_gp(x, y)
+            self._X, self._Y = x, y
+            self._clear_cache()
+        elif optimize or not self._update_factors(x, y):
+            self._X = np.r_[self._X, x]
+            self._Y = np.r_[self._Y, y]
+            self._clear_cache()
+
+        if optimize:
+            self.optimize()
+
+    def _init_gp(self, x, y):
+        if self.kernel is None:
+            self.kernel = self._default_kernel(x, y)
+        if self.noise_var is None:
+            self.noise_var = np.max(y)**2. / 100.
+
+    def _default_kernel(self, x, y):
+        # Some heuristics to choose kernel parameters based on the initial data
+        length_scale = (np.max(self.bounds) - np.min(self.bounds)) / 3.
+        kernel_var = (np.max(y) / 3.)**2.
+        bias_var = kernel_var / 4.
+
+        kernel = RBF(self.input_dim)
+        kernel.set_prior('lengthscale', length_scale, length_scale)
+        kernel.set_prior('variance', kernel_var, kernel_var)
+
+        bias = Bias(self.input_dim)
+        bias.set_prior('variance', bias_var, bias_var)
+
+        return kernel + bias
+
+    def _factors(self):
+        """Return the cached Cholesky factor of the covariance and Woodbury vector."""
+        if self._L is None:
+            K = self.kernel.K(self._X)
+            K[np.diag_indices_from(K)] += self.noise_var + 1e-8
+            self._L = _jitchol(K)
+            self._alpha = sl.cho_solve((self._L, True), self._Y)
+            self._K_inv = None
+        return self._L, self._alpha
+
+    def _update_factors(self, x, y):
+        """Add evidence with a rank-k update of the cached Cholesky factor.
+
+        Returns False if the factor cannot be updated.
+        """
+        L, _ = self._factors()
+        n, k = len(L), len(x)
+        K_xn = self.kernel.K(self._X, x)
+        K_nn = self.kernel.K(x)
+        K_nn[np.diag_indices_from(K_nn)] += self.noise_var + 1e-8
+        B = sl.solve_triangular(L, K_xn, lower=True)
+        try:
+            C = sl.cholesky(K_nn - B.T.dot(B), lower=True)
+        except np.linalg.LinAlgError:
+            return False
+
+        L_new = np.zeros((n + k, n + k))
+        L_new[:n, :n] = L
+        L_new[n:, :n] = B.T
+        L_new[n:, n:] = C
+
+        self._X = np.r_[self._X, x]
+        self._Y = np.r_[self._Y, y]
+        self._L = L_new
+        self._alpha = sl.cho_solve((L_new, True), self._Y)
+        self._K_inv = None
+        return True
+
+    def log_likelihood(self):
+        """Return the log marginal likelihood of the evidence."""
+        L, alpha = self._factors()
+        return -.5*np.sum(alpha*self._Y) - np.sum(np.log(np.diag(L))) - \
+            .5*len(L)*np.log(2*np.pi)
+
+    def _objective(self, log_params, X, Y):
+        """Negative log marginal likelihood and log prior of the log hyperparameters
+        given the evidence X, Y and its gradient."""
+        self.kernel.set_params(np.exp(log_params[:-1]))
+        self.noise_var = np.exp(log_params[-1])
+
+        K = self.kernel.K(X)
+        K[np.diag_indices_from(K)] += self.noise_var + 1e-8
+        L = _jitchol(K)
+        alpha = sl.cho_solve((L, True), Y)
+        K_inv = sl.cho_solve((L, True), np.eye(len(L)))
+        W = alpha.dot(alpha.T) - K_inv
+
+        grad = [.5*np.sum(W*dK) for dK in self.kernel.gradients(X)]
+        grad.append(.5*self.noise_var*np.trace(W))
+        log_prior, grad_prior = self.kernel.log_prior()
+
+        value = -.5*np.sum(alpha*Y) - np.sum(np.log(np.diag(L))) - \
+            .5*len(L)*np.log(2*np.pi) + log_prior
+        grad = np.array(grad) + np.r_[grad_prior, 0]
+        return -value, -grad
+
+    def _fit_hyperparameters(self, X, Y):
+        """Maximize the log marginal likelihood and log prior of the evidence X, Y."""
+        logger.debug("Optimizing GP hyper parameters")
+        x0 = np.log(np.r_[self.kernel.get_params(), self.noise_var])
+        try:
+            result = scipy.optimize.minimize(self._objective, x0, args=(X, Y), jac=True,
+                                             method=self.optimizer,
+                                             options={'maxiter': self.max_opt_iters})
+            log_params = result.x
+        except np.linalg.LinAlgError:
+            logger.warning("Numerical error in GP optimization. Stopping optimization")
+            log_params = x0
+        self.kernel.set_params(np.exp(log_params[:-1]))
+        self.noise_var = np.exp(log_params[-1])
+
+    def optimize(self):
+        """Optimize GP hyper parameters.
+        """
+        self._fit_hyperparameters(self._X, self._Y)
+        self._clear_cache()
+
+    @property
+    def n_evidence(self):
+        """Returns the number of observed samples.
+        """
+        if self._X is None:
+            return 0
+        return len(self._X)
+
+    @property
+    def X(self):
+        """Return input evidence"""
+        return self._X
+
+    @property
+    def Y(self):
+        """Return output evidence"""
+        return self._Y
+
+    def copy(self):
+        kopy = self.__class__.__new__(self.__class__)
+        kopy.__dict__.update(self.__dict__)
+        if self.kernel is not None:
+            kopy.kernel = self.kernel.copy()
+        return kopy
+
+    def __copy__(self):
+        return self.copy()
+
+    def __getstate__(self):
+        # The cached factors are recomputed when needed
+        state = self.__dict__.copy()
+        state.update(_L=None, _alpha=None, _K_inv=None)
+        return state
+
+
+class SparseGPRegression(GPRegression):
+    """Sparse Gaussian process regression with inducing points.
+
+    The posterior is the variational approximation of Titsias (2009) with the inducing
+    inputs selected greedily from the evidence: a new evidence point becomes an
+    inducing input if its variance is not yet explained by the current ones. The
+    posterior is kept as sufficient statistics of size m x m, so adding evidence costs
+    O(k m^2) for k new points, refitting it costs O(n m^2) and predicting the mean
+    costs O(m) and the variance O(m^2) per point. The hyperparameters are optimized
+    by maximizing the variational lower bound of all evidence with the inducing inputs
+    fixed, which costs O(n m^2) per evaluation.
+
+    Parameters
+    ----------
+    parameter_names : list of str, optional
+        Names of parameter nodes. If None, sets dimension to 1.
+    bounds : dict, optional
+        The region where to estimate the posterior for each parameter in
+        model.parameters.
+        `{'parameter_name':(lower, upper), ... }`
+        If not supplied, defaults to (0, 1) bounds for all dimensions.
+    optimizer : str, optional
+        Method of `scipy.optimize.minimize` for the hyper parameters. Default 'L-BFGS-B'.
+    max_opt_iters : int, optional
+    kernel : Kernel, optional
+        Defaults to an RBF kernel with a bias term as in `GPRegression`.
+    noise_var : float, optional
+        Initial noise variance. Defaults to max(y)**2/100 of the first evidence.
+    max_inducing : int, optional
+        Maximum number of inducing inputs m.
+    inducing_threshold : float, optional
+        An evidence point is added to the inducing inputs if its prior variance
+        conditioned on them is above this fraction of its prior variance.
+
+    References
+    ----------
+    M. Titsias (2009). Variational Learning of Inducing Variables in Sparse Gaussian
+    Processes. AISTATS 2009.
+
+    """
+
+    def __init__(self, parameter_names=None, bounds=None, optimizer='L-BFGS-B',
+                 max_opt_iters=50, kernel=None, noise_var=None, max_inducing=300,
+                 inducing_threshold=1e-3):
+        self.max_inducing = max_inducing
+        self.inducing_threshold = inducing_threshold
+        self._inducing = np.zeros(0, dtype=int)
+        self._reset_statistics()
+        super(SparseGPRegression, self).__init__(parameter_names, bounds, optimizer,
+                                                 max_opt_iters, kernel, noise_var)
+
+    def __str__(self):
+        return 'SparseGPRegression with {} evidence and {} inducing inputs\n' \
+               '  kernel: {}\n  noise_var: {}'\
+            .format(self.n_evidence, self.n_inducing, self.kernel, self.noise_var)
+
+    def _clear_cache(self):
+        super(SparseGPRegression, self)._clear_cache()
+        self._w = None
+        self._W = None
+
+    def _reset_statistics(self):
+        m = len(self._inducing)
+        self._L_mm = np.zeros((m, m))
+        self._K_nm = None
+        self._P = np.zeros((m, m))
+        self._b = np.zeros((m, 1))
+
+    @property
+    def n_inducing(self):
+        """Return the number of inducing inputs."""
+        return len(self._inducing)
+
+    @property
+    def Z(self):
+        """Return the inducing inputs."""
+        if self._X is None:
+            return None
+        return self._X[self._inducing]
+
+    def predict(self, x, noiseless=False):
+        """Returns the GP model mean and variance at x.
+
+        Parameters
+        ----------
+        x : np.array
+            numpy compatible (n, input_dim) array of points to evaluate
+            if len(x.shape) == 1 will be cast to 2D with x[None, :]
+        noiseless : bool
+            whether to include the noise variance or not to the returned variance
+
+        Returns
+        -------
+        tuple
+            GP (mean, var) at x where
+                mean : np.array
+                    with shape (x.shape[0], 1)
+                var : np.array
+                    with shape (x.shape[0], 1)
+        """
+        x = np.asanyarray(x, dtype=np.float64).reshape((-1, self.input_dim))
+
+        if self._X is None:
+            return np.zeros((x.shape[0], 1)), np.ones((x.shape[0], 1))
+
+        w, W = self._factors()
+        K_xm = self.kernel.K(x, self.Z)
+        mean = K_xm.dot(w)
+        var = self.kernel.Kdiag(x) - np.sum(K_xm.dot(W)*K_xm, axis=1)
+        if not noiseless:
+            var += self.noise_var
+        return mean, np.maximum(var, 1e-15)[:, None]
+
+    def predictive_gradients(self, x):
+        """Return the gradients of the GP model mean and variance at x.
+
+        Parameters
+        ----------
+        x : np.array
+            numpy compatible (n, input_dim) array of points to evaluate
+            if len(x.shape) == 1 will be cast to 2D with x[None, :]
+
+        Returns
+        -------
+        tuple
+            GP (grad_mean, grad_var) at x where
+                grad_mean : np.array
+                    with shape (x.shape[0], input_dim)
+                grad_var : np.array
+                    with shape (x.shape[0], input_dim)
+        """
+        x = np.asanyarray(x, dtype=np.float64).reshape((-1, self.input_dim))
+
+        if self._X is None:
+            return np.zeros((x.shape[0], self.input_dim)), \
+                   np.zeros((x.shape[0], self.input_dim))
+
+        w, W = self._factors()
+        Z = self.Z
+        dK = self.kernel.gradients_X(x, Z)
+        grad_mean = np.einsum('mnd,n->md', dK, w[:, 0])
+        grad_var = -2*np.einsum('mnd,mn->md', dK, self.kernel.K(x, Z).dot(W))
+        return grad_mean, grad_var
+
+    def update(self, x, y, optimize=False):
+        """Updates the GP model with new data
+        """
+        x = np.asarray(x, dtype=np.float64).reshape((-1, self.input_dim))
+        y = np.asarray(y, dtype=np.float64).reshape((-1, 1))
+
+        if self._X is None:
+            self._init_gp(x, y)
+            self._X, self._Y = x, y
+            self._inducing = np.zeros(0, dtype=int)
+            self._reset_statistics()
+            self._K_nm = np.zeros((len(x), 0))
+            self._select_inducing(np.arange(len(x)))
+        else:
+            self._add_evidence(x, y)
+
+        if optimize:
+            self.optimize()
+        self._clear_cache()
+
+    def _add_evidence(self, x, y):
+        """Add the evidence to the sufficient statistics and select new inducing inputs
+        among it."""
+        if self._K_nm is None:
+            self._K_nm = self.kernel.K(self._X, self.Z)
+        n = len(self._X)
+        K_km = self.kernel.K(x, self.Z)
+        self._X = np.r_[self._X, x]
+        self._Y = np.r_[self._Y, y]
+        self._K_nm = np.r_[self._K_nm, K_km]
+        self._P = self._P + K_km.T.dot(K_km)
+        self._b = self._b + K_km.T.dot(y)
+        self._select_inducing(np.arange(n, n + len(x)))
+
+    def _select_inducing(self, candidates):
+        """Greedily add the candidate evidence points with the largest conditional
+        variance to the inducing inputs.
+
+        Each addition extends the Cholesky factor of the inducing covariance by one row
+        and the sufficient statistics by one row and column.
+        """
+        X = self._X
+        kdiag = self.kernel.Kdiag(X[candidates])
+        V = self._solve_mm(self._K_nm[candidates].T)
+        r = kdiag - np.sum(V**2, axis=0)
+
+        while self.n_inducing < self.max_inducing:
+            j = np.argmax(r)
+            if r[j] <= self.inducing_threshold*kdiag[j]:
+                break
+            i = candidates[j]
+            m = self.n_inducing
+            k_z = self.kernel.K(X, X[i:i + 1])
+            l, d = V[:, j], np.sqrt(r[j])
+
+            L_mm = np.zeros((m + 1, m + 1))
+            L_mm[:m, :m] = self._L_mm
+            L_mm[m, :m] = l
+            L_mm[m, m] = d
+            self._L_mm = L_mm
+
+            p = self._K_nm.T.dot(k_z)
+            self._P = np.r_[np.c_[self._P, p], np.c_[p.T, k_z.T.dot(k_z)]]
+            self._b = np.r_[self._b, k_z.T.dot(self._Y)]
+            self._K_nm = np.c_[self._K_nm, k_z]
+            self._inducing = np.r_[self._inducing, i]
+
+            v = (k_z[candidates, 0] - l.dot(V))/d
+            V = np.r_[V, v[None, :]]
+            r = r - v**2
+
+    def _solve_mm(self, B):
+        """Return L_mm^-1 B."""
+        if self.n_inducing == 0:
+            return np.zeros((0, ) + B.shape[1:])
+        return sl.solve_triangular(self._L_mm, B, lower=True)
+
+    def _recompute(self):
+        """Recompute the sufficient statistics of all evidence, e.g. after the
+        hyperparameters have changed."""
+        Z = self.Z
+        self._L_mm = _jitchol(self.kernel.K(Z))
+        self._K_nm = self.kernel.K(self._X, Z)
+        self._P = self._K_nm.T.dot(self._K_nm)
+        self._b = self._K_nm.T.dot(self._Y)
+        self._select_inducing(np.arange(len(self._X)))
+
+    def _factors(self):
+        """Return the cached weights of the predictive mean and the matrix of the
+        predictive variance."""
+        if self._w is None:
+            m = self.n_inducing
+            C = self._solve_mm(self._solve_mm(self._P).T)
+            A = np.eye(m) + C/self.noise_var
+            L_A = _jitchol(A)
+            A_inv = sl.cho_solve((L_A, True), np.eye(m))
+            self._w = sl.solve_triangular(self._L_mm, A_inv.dot(self._solve_mm(self._b)),
+                                          lower=True, trans='T')/self.noise_var
+            B = sl.solve_triangular(self._L_mm, np.eye(m) - A_inv, lower=True, trans='T')
+            self._W = sl.solve_triangular(self._L_mm, B.T, lower=True, trans='T')
+        return self._w, self._W
+
+    def log_likelihood(self):
+        """Return the variational lower bound of the log marginal likelihood."""
+        n, m = self.n_evidence, self.n_inducing
+        C = self._solve_mm(self._solve_mm(self._P).T)
+        L_A = _jitchol(np.eye(m) + C/self.noise_var)
+        c = sl.solve_triangular(L_A, self._solve_mm(self._b), lower=True)
+        trace = np.sum(self.kernel.Kdiag(self._X)) - np.trace(C)
+        return -.5*n*np.log(2*np.pi*self.noise_var) - np.sum(np.log(np.diag(L_A))) - \
+            .5*np.sum(self._Y**2)/self.noise_var + .5*np.sum(c**2)/self.noise_var**2 - \
+            .5*trace/self.noise_var
+
+    def _objective(self, log_params, X, Y):
+        """Negative variational lower bound and log prior of the log hyperparameters
+        given the evidence X, Y and its gradient.
+
+        The inducing inputs are the rows `_inducing` of X. With A = s2 K_mm + K_mn K_nm,
+        the bound is log N(Y | 0, Q_nn + s2 I) - tr(K_nn - Q_nn)/(2 s2), where
+        Q_nn = K_nm K_mm^-1 K_mn, and its derivatives with respect to K_mm, K_nm and the
+        diagonal of K_nn are computed from m x m matrices only.
+        """
+        self.kernel.set_params(np.exp(log_params[:-1]))
+        s2 = self.noise_var = np.exp(log_params[-1])
+
+        Z = X[self._inducing]
+        n, m = len(X), len(Z)
+        K_mm = self.kernel.K(Z)
+        K_mm[np.diag_indices_from(K_mm)] += 1e-8
+        K_nm = self.kernel.K(X, Z)
+        P = K_nm.T.dot(K_nm)
+        b = K_nm.T.dot(Y)
+
+        L_mm = _jitchol(K_mm)
+        L_A = _jitchol(s2*K_mm + P)
+        K_inv = sl.cho_solve((L_mm, True), np.eye(m))
+        A_inv = sl.cho_solve((L_A, True), np.eye(m))
+        a = A_inv.dot(b)
+        yy = np.sum(Y**2)
+        trace = np.sum(self.kernel.Kdiag(X)) - np.sum(K_inv*P)
+
+        value = -.5*n*np.log(2*np.pi) - .5*(n - m)*np.log(s2) - \
+            np.sum(np.log(np.diag(L_A))) + np.sum(np.log(np.diag(L_mm))) - \
+            .5*(yy - b.T.dot(a).item())/s2 - .5*trace/s2
+
+        # Derivatives of the bound with respect to K_mm, K_nm and diag(K_nn)
+        aa = a.dot(a.T)
+        G_mm = .5*(K_inv - s2*A_inv - aa - K_inv.dot(P).dot(K_inv)/s2)
+        G_nm = K_nm.dot(K_inv/s2 - A_inv - aa/s2) + Y.dot(a.T)/s2
+        grad = [np.sum(G_mm*dK_mm) + np.sum(G_nm*dK_nm) - .5*np.sum(dK_nn)/s2
+                for dK_mm, dK_nm, dK_nn in zip(self.kernel.gradients(Z),
+                                               self.kernel.gradients(X, Z),
+                                               self.kernel.gradients_diag(X))]
+        grad.append(-.5*(n - m) - .5*s2*np.sum(A_inv*K_mm) +
+                    .5*(yy - b.T.dot(a).item())/s2 - .5*a.T.dot(K_mm).dot(a).item() +
+                    .5*trace/s2)
+        log_prior, grad_prior = self.kernel.log_prior()
+
+        grad = np.array(grad) + np.r_[grad_prior, 0]
+        return -(value + log_prior), -grad
+
+    def optimize(self):
+        """Optimize GP hyper parameters.
+
+        The hyperparameters are fitted to all evidence with the current inducing inputs,
+        after which the sufficient statistics are recomputed and new inducing inputs
+        selected.
+        """
+        if self.n_inducing > 0:
+            self._fit_hyperparameters(self._X, self._Y)
+        self._recompute()
+        self._clear_cache()
+
+    def __getstate__(self):
+        # The covariance between the evidence and the inducing inputs is recomputed
+        # when new evidence arrives
+        state = super(SparseGPRegression, self).__getstate__()
+        state.update(_K_nm=None, _w=None, _W=None)
+        return state
+
+
+def _jitchol(K, max_tries=5):
+    """Cholesky factor of K adding jitter to the diagonal if needed."""
+    try:
+        return sl.cholesky(K, lower=True)
+    except np.linalg.LinAlgError:
+        pass
+
+    jitter = 1e-6*np.mean(np.diag(K))
+    for i in range(max_tries):
+        try:
+            L = sl.cholesky(K + jitter*np.eye(len(K)), lower=True)
+            logger.debug('Added jitter {} to the covariance'.format(jitter))
+            return L
+        except np.linalg.LinAlgError:
+            jitter *= 10
+    raise np.linalg.LinAlgError('The covariance is not positive definite even with '
+                                'jitter {}'.format(jitter))
@@ -1,10 +1,13 @@
-# TODO: make own general GPRegression and kernel classes
-
 import logging
-import copy
 
 import numpy as np
+import scipy.linalg as sl
 import GPy
+from GPy.inference.latent_function_inference import ExactGaussianInference
+from GPy.inference.latent_function_inference.posterior import Posterior
+from paramz import ObsAr
+
+from elfi.methods.bo.utils import resolve_bounds
 
 logger = logging.getLogger(__name__)
 logging.getLogger("GP").setLevel(logging.WARNING)  # GPy library logger
@@ -31,6 +34,10 @@ class GPyRegression:
         See also: paramz.Model.optimize()
     max_opt_iters : int, optional
     gp : GPy.model.GPRegression instance, optional
+    incremental : bool, optional
+        Add new evidence to the posterior with a rank-k update of its Cholesky factor
+        when the hyper parameters are not optimized. Otherwise the GP is refactorized
+        with all the evidence on every update. Default True.
     **gp_params
         kernel : GPy.Kern
         noise_var : float
@@ -39,31 +46,9 @@ class GPyRegression:
     """
 
     def __init__(self, parameter_names=None, bounds=None, optimizer="scg", max_opt_iters=50,
-                 gp=None, **gp_params):
+                 gp=None, incremental=True, **gp_params):
 
-        if parameter_names is None:
-            input_dim = 1
-        elif isinstance(parameter_names, (list, tuple)):
-            input_dim = len(parameter_names)
-        else:
-            raise ValueError("Keyword `parameter_names` must be a list of strings")
-
-        if bounds is None:
-            logger.warning('Parameter bounds not specified. Using [0,1] for each parameter.')
-            bounds = [(0, 1)] * input_dim
-        elif len(bounds) != input_dim:
-            raise ValueError('Length of `bounds` ({}) does not match the length of `parameter_names` ({}).'
-                             .format(len(bounds), input_dim))
-
-        elif isinstance(bounds, dict):
-            if len(bounds) == 1:  # might be the case parameter_names=None
-                bounds = [bounds[n] for n in bounds.keys()]
-            else:
-                # turn bounds dict into a list in the same order as parameter_names
-                bounds = [bounds[n] for n in parameter_names]
-        else:
-            raise ValueError("Keyword `bounds` must be a dictionary "
-                             "`{'parameter_name': (lower, upper), ... }`")
+        input_dim, bounds = resolve_bounds(parameter_names, bounds)
 
         self.input_dim = input_dim
         self.bounds = bounds
@@ -72,6 +57,7 @@ class GPyRegression:
 
         self.optimizer = optimizer
         self.max_opt_iters = max_opt_iters
+        self.incremental = incremental
 
         self._gp = gp
 
@@ -252,13 +238,15 @@ class GPyRegression:
         """Updates the GP model with new data
         """
 
-        # Must cast these as 2d for GPy
-        x = x.reshape((-1, self.input_dim))
-        y = y.reshape((-1, 1))
+        # Must cast these as 2d for GPy. Keep the double precision also when the
+        # outputs are computed in a lower one.
+        x = np.asarray(x, dtype=np.float64).reshape((-1, self.input_dim))
+        y = np.asarray(y, dtype=np.float64).reshape((-1, 1))
 
+        self._rbf_is_cached = False
         if self._gp is None:
             self._init_gp(x, y)
-        else:
+        elif optimize or not self._update_posterior(x, y):
             # Reconstruct with new data
             x = np.r_[self._gp.X, x]
             y = np.r_[self._gp.Y, y]
@@ -272,6 +260,54 @@ class GPyRegression:
         if optimize:
             self.optimize()
 
+    def _update_posterior(self, x, y):
+        """Add evidence to the exact posterior with a rank-k Cholesky update.
+
+        Returns False if the posterior cannot be updated incrementally.
+        """
+        gp = self._gp
+        if not self.incremental or gp.normalizer is not None or \
+                not isinstance(gp.inference_method, ExactGaussianInference):
+            return False
+
+        X = np.asarray(gp.X)
+        n, k = len(X), len(x)
+        L = gp.posterior.woodbury_chol
+        K_old = gp.posterior._K
+        K_xn = gp.kern.K(X, x)
+        K_nn = gp.kern.K(x)
+
+        # The same jitter as in GPy ExactGaussianInference
+        Ky_nn = K_nn + (gp.likelihood.variance[0] + 1e-8)*np.eye(k)
+        B = sl.solve_triangular(L, K_xn, lower=True)
+        try:
+            C = sl.cholesky(Ky_nn - B.T.dot(B), lower=True)
+        except np.linalg.LinAlgError:
+            return False
+
+        L_new = np.zeros((n + k, n + k), order='F')
+        L_new[:n, :n] = L
+        L_new[n:, :n] = B.T
+        L_new[n:, n:] = C
+
+        X = np.r_[X, x]
+        Y = np.r_[np.asarray(gp.Y), y]
+        r = Y - gp.mean_function.f(X) if gp.mean_function else Y
+        alpha = sl.cho_solve((L_new, True), r)
+
+        K = None
+        if K_old is not None:
+            K = np.vstack((np.hstack((K_old, K_xn)), np.hstack((K_xn.T, K_nn))))
+
+        gp.X = ObsAr(X)
+        gp.Y = ObsAr(Y)
+        gp.Y_normalized = gp.Y
+        gp.num_data = n + k
+        gp.posterior = Posterior(woodbury_chol=L_new, woodbury_vector=alpha, K=K)
+        gp._log_marginal_likelihood = -.5*(len(Y)*np.log(2*np.pi) + np.sum(alpha*r)) \
+            - np.sum(np.log(np.diag(L_new)))
+        return True
+
     def optimize(self):
         """Optimize GP hyper parameters.
         """
@@ -300,7 +336,9 @@ class GPyRegression:
         return self._gp.Y
 
     def copy(self):
-        kopy = copy.copy(self)
+        kopy = self.__class__.__new__(self.__class__)
+        kopy.__dict__.update(self.__dict__)
+        kopy.gp_params = dict(self.gp_params)
         if self._gp:
             kopy._gp = self._gp.copy()
 
@@ -1,6 +1,53 @@
+import logging
+
 import numpy as np
 from scipy.optimize import differential_evolution, fmin_l_bfgs_b
 
+logger = logging.getLogger(__name__)
+
+
+def resolve_bounds(parameter_names, bounds):
+    """Return the input dimension and the bounds in the order of the parameters.
+
+    Parameters
+    ----------
+    parameter_names : list of str or None
+        Names of parameter nodes. If None, the dimension is 1.
+    bounds : dict or None
+        `{'parameter_name':(lower, upper), ... }`. If None, defaults to (0, 1) bounds for
+        all dimensions.
+
+    Returns
+    -------
+    tuple
+        (input_dim, list of (lower, upper) bounds)
+    """
+    if parameter_names is None:
+        input_dim = 1
+    elif isinstance(parameter_names, (list, tuple)):
+        input_dim = len(parameter_names)
+    else:
+        raise ValueError("Keyword `parameter_names` must be a list of strings")
+
+    if bounds is None:
+        logger.warning('Parameter bounds not specified. Using [0,1] for each parameter.')
+        bounds = [(0, 1)] * input_dim
+    elif len(bounds) != input_dim:
+        raise ValueError('Length of `bounds` ({}) does not match the length of '
+                         '`parameter_names` ({}).'.format(len(bounds), input_dim))
+
+    elif isinstance(bounds, dict):
+        if len(bounds) == 1:  # might be the case parameter_names=None
+            bounds = [bounds[n] for n in bounds.keys()]
+        else:
+            # turn bounds dict into a list in the same order as parameter_names
+            bounds = [bounds[n] for n in parameter_names]
+    else:
+        raise ValueError("Keyword `bounds` must be a dictionary "
+                         "`{'parameter_name': (lower, upper), ... }`")
+
+    return input_dim, bounds
+
 
 # TODO: remove or combine to minimize
 def stochastic_optimization(fun, bounds, maxiter=1000, polish=True, seed=0):
@@ -68,3 +115,137 @@ def minimize(fun, bounds, grad=None, prior=None, n_start_points=10, maxiter=1000
     ind_min = np.argmin(vals)
     return locs[ind_min], vals[ind_min]
 
+
+def multistart_minimize(fun, bounds, grad=None, prior=None, n_start_points=10,
+                        maxiter=1000, random_state=None, n_candidates=1000, client=None):
+    """Find the minimum of a vectorized function 'fun' by refining the best points of a
+    quasi-random candidate set.
+
+    The candidates are evaluated with a single call of `fun`. The best half of
+    `n_start_points` and as many other random candidates are refined with L-BFGS-B,
+    either in lockstep as one optimization problem of the stacked points, so that each
+    iteration evaluates `fun` once for all of them, or in parallel in the `client`.
+
+    Parameters
+    ----------
+    fun : callable
+        Function to minimize. Takes an array of shape (n, input_dim) and returns n
+        values.
+    bounds : list of tuples
+        Bounds for each parameter.
+    grad : callable, optional
+        Gradient of fun, returns an array of shape (n, input_dim). If None, the gradient
+        is approximated with finite differences.
+    prior : scipy-like distribution object, optional
+        Used for sampling the candidates. If None, the candidates are a randomly shifted
+        Halton sequence within the bounds.
+    n_start_points : int, optional
+        Number of candidates to refine.
+    maxiter : int, optional
+        Maximum number of iterations.
+    random_state : np.random.RandomState, optional
+        Used in drawing the candidates.
+    n_candidates : int, optional
+        Number of candidates.
+    client : elfi.client.ClientBase, optional
+        Refine each start point as a separate task in the client.
+
+    Returns
+    -------
+    tuple of the found coordinates of minimum and the corresponding value.
+    """
+    random_state = random_state or np.random
+    bounds = [tuple(b) for b in bounds]
+    ndim = len(bounds)
+    lower, upper = np.array(bounds, dtype=float).T
+    n_candidates = max(n_candidates, n_start_points)
+
+    if prior is None:
+        candidates = lower + (upper - lower)*_halton(n_candidates, ndim, random_state)
+    else:
+        candidates = prior.rvs(n_candidates, random_state=random_state)
+        candidates = np.clip(candidates.reshape((n_candidates, ndim)), lower, upper)
+
+    values = np.asarray(fun(candidates), dtype=float).reshape(n_candidates)
+    values[np.isnan(values)] = np.inf
+    # Refine the best candidates and, to escape a single basin, random other ones
+    order = np.argsort(values)
+    n_best = max(n_start_points // 2, 1)
+    n_other = min(n_start_points - n_best, n_candidates - n_best)
+    others = random_state.choice(order[n_best:], n_other, replace=False)
+    start_points = candidates[np.r_[order[:n_best], others].astype(int)]
+
+    if client is not None:
+        ids = [client.apply(_minimize_point, fun, x0, bounds, grad, maxiter)
+               for x0 in start_points]
+        locs = np.array([client.get_result(id)[0] for id in ids])
+    else:
+        locs = _minimize_lockstep(fun, start_points, bounds, grad, maxiter)
+
+    locs = np.r_[locs, candidates[np.argmin(values)][None, :]]
+    vals = np.asarray(fun(locs), dtype=float).reshape(len(locs))
+    ind_min = np.nanargmin(vals)
+    return locs[ind_min], vals[ind_min]
+
+
+def _minimize_lockstep(fun, start_points, bounds, grad=None, maxiter=1000):
+    """Minimize the sum of fun over the stacked start points with L-BFGS-B.
+
+    The problem is separable so the minimum of the sum is the minimum of each point.
+    """
+    shape = start_points.shape
+
+    def objective(z):
+        x = z.reshape(shape)
+        g = _approx_grad(fun, x) if grad is None else grad(x)
+        return np.sum(fun(x)), np.asarray(g, dtype=float).ravel()
+
+    result = fmin_l_bfgs_b(objective, start_points.ravel(), bounds=bounds*shape[0],
+                           maxiter=maxiter)
+    return result[0].reshape(shape)
+
+
+def _minimize_point(fun, x0, bounds, grad=None, maxiter=1000):
+    """Minimize the vectorized fun from a single start point with L-BFGS-B."""
+    def obj(x):
+        return np.asarray(fun(x[None, :])).item()
+
+    def grad_obj(x):
+        return np.asarray(grad(x[None, :])).ravel()
+
+    if grad is None:
+        result = fmin_l_bfgs_b(obj, x0, approx_grad=True, bounds=bounds, maxiter=maxiter)
+    else:
+        result = fmin_l_bfgs_b(obj, x0, fprime=grad_obj, bounds=bounds, maxiter=maxiter)
+    return result[0], result[1]
+
+
+def _approx_grad(fun, x, eps=1e-8):
+    """Forward differences of a vectorized function at each row of x."""
+    f0 = np.asarray(fun(x)).reshape(len(x))
+    grad = np.empty(x.shape)
+    for i in range(x.shape[1]):
+        x_eps = x.copy()
+        x_eps[:, i] += eps
+        grad[:, i] = (np.asarray(fun(x_eps)).reshape(len(x)) - f0)/eps
+    return grad
+
+
+def _halton(n, dim, random_state):
+    """Halton sequence in the unit cube with a random shift modulo 1."""
+    primes = []
+    candidate = 2
+    while len(primes) < dim:
+        if all(candidate % p != 0 for p in primes):
+            primes.append(candidate)
+        candidate += 1
+
+    points = np.zeros((n, dim))
+    for j, base in enumerate(primes):
+        i = np.arange(1, n + 1)
+        f = 1.
+        while np.any(i > 0):
+            f /= base
+            points[:, j] += f*(i % base)
+            i //= base
+    return (points + random_state.uniform(size=dim)) % 1
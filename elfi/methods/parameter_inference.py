@@ -1,8 +1,13 @@
 import logging
+import os
+from collections import OrderedDict
+from functools import partial
 from math import ceil
 
 import matplotlib.pyplot as plt
+import networkx as nx
 import numpy as np
+from scipy.special import logsumexp
 
 import elfi.client
 import elfi.methods.mcmc as mcmc
@@ -16,8 +21,9 @@ from elfi.methods.bo.utils import stochastic_optimization
 from elfi.methods.posteriors import BolfiPosterior
 from elfi.methods.results import Sample, SmcSample, BolfiSample, OptimizationResult
 from elfi.methods.utils import GMDistribution, weighted_var, ModelPrior, batch_to_arr2d, \
-    arr2d_to_batch, ceil_to_batch_size
+    arr2d_to_batch, ceil_to_batch_size, gm_proposal_rvs, gm_proposal_logpdf, take_column
 from elfi.model.elfi_model import ComputationContext, NodeReference, ElfiModel
+from elfi.store import NpyPersistedArray
 from elfi.utils import is_array
 
 logger = logging.getLogger(__name__)
@@ -58,7 +64,7 @@ class ParameterInference:
     """
 
     def __init__(self, model, output_names, batch_size=1000, seed=None, pool=None,
-                 max_parallel_batches=None):
+                 max_parallel_batches=None, dtype=None):
         """Construct the inference algorithm object.
 
         If you are implementing your own algorithm do not forget to call `super`.
@@ -77,6 +83,13 @@ class ParameterInference:
         max_parallel_batches : int
             Maximum number of batches allowed to be in computation at the same time.
             Defaults to number of cores in the client
+        dtype : np.dtype or dict, optional
+            Data type of the floating point node outputs, e.g. `np.float32` to halve the
+            memory and storage needs, or a dict with node names as keys. A single dtype
+            is not applied to the parameters, the nodes the method needs in full
+            precision (e.g. the prior densities of the SMC weights) and their ancestors,
+            which are kept in the precision they produce. Default is not to cast the
+            outputs.
 
 
         """
@@ -85,17 +98,15 @@ class ParameterInference:
             raise ValueError('Model {} defines no parameters'.format(model))
 
         self.model = model.copy()
-        self.output_names = self._check_outputs(output_names)
-
-        self.client = elfi.client.get_client()
+        client = elfi.client.get_client()
 
         # Prepare the computation_context
-        context = ComputationContext(batch_size=batch_size, seed=seed, pool=pool)
-        self.batches = elfi.client.BatchHandler(self.model, context=context,
-                                                output_names=output_names,
-                                                client=self.client)
-        self.computation_context = context
-        self.max_parallel_batches = max_parallel_batches or self.client.num_cores
+        context = ComputationContext(batch_size=batch_size, seed=seed, pool=pool,
+                                     dtype=self._resolve_dtype(dtype))
+        batches = elfi.client.BatchHandler(self.model, context=context,
+                                           output_names=output_names, client=client)
+        self._init_inference(self.model, output_names, client, context, batches,
+                             max_parallel_batches or client.num_cores)
 
         if self.max_parallel_batches <= 0:
             msg = 'Value for max_parallel_batches ({}) must be at least one.'.format(
@@ -106,11 +117,39 @@ class ParameterInference:
                        'parameter by hand.'
             raise ValueError(msg)
 
+    def _init_inference(self, model, output_names, client, context, batches,
+                        max_parallel_batches):
+        """Set up the attributes common to all the inference methods.
+
+        Also used for inference objects that share the model and the computation context
+        of another one, in which case `batches` may be None.
+        """
+        self.model = model
+        self.output_names = self._check_outputs(output_names)
+        self.client = client
+        self.computation_context = context
+        self.batches = batches
+        self.max_parallel_batches = max_parallel_batches
+
         # State and objective should contain all information needed to continue the
         # inference after an iteration.
         self.state = dict(n_sim=0, n_batches=0)
         self.objective = dict()
 
+    def _resolve_dtype(self, dtype):
+        if dtype is None or isinstance(dtype, dict):
+            return dtype
+
+        keep = set(self.parameter_names) | set(self._full_precision_outputs)
+        for name in list(keep):
+            keep.update(nx.ancestors(self.model.source_net, name))
+        return {node: dtype for node in self.model.nodes if node not in keep}
+
+    @property
+    def _full_precision_outputs(self):
+        """Outputs that a single dtype of the inference is not applied to."""
+        return []
+
     @property
     def pool(self):
         """Return the output pool of the inference."""
@@ -399,26 +438,77 @@ class Rejection(Sampler):
     http://dx.doi.org/10.1093/sysbio/syw077.
     """
 
-    def __init__(self, model, discrepancy_name=None, output_names=None, **kwargs):
+    def __init__(self, model, discrepancy_name=None, output_names=None, spill_path=None,
+                 worker_filter=False, **kwargs):
         """
 
         Parameters
         ----------
         model : ElfiModel or NodeReference
-        discrepancy_name : str, NodeReference, optional
-            Only needed if model is an ElfiModel
+        discrepancy_name : str, NodeReference or list, optional
+            Only needed if model is an ElfiModel. With a list of discrepancies all of
+            them are computed from the same simulations and the result is a dict of
+            samples with the discrepancy names as keys.
         output_names : list
             Additional outputs from the model to be included in the inference result, e.g.
             corresponding summaries to the acquired samples
+        spill_path : str, optional
+            Directory for spilling the outputs of the accepted samples to the disk. In
+            this streaming mode only the discrepancies are kept in the memory and the
+            outputs of the result are memory mapped .npy files in this directory. Useful
+            with large outputs or a large number of samples.
+        worker_filter : bool, optional
+            Send the current acceptance threshold with each batch and return only the
+            rows that can still be accepted from the workers. Reduces the data transfer
+            and the merge costs at low acceptance rates. Cannot be used with a pool.
         kwargs:
             See InferenceMethod
         """
 
-        model, discrepancy_name = self._resolve_model(model, discrepancy_name)
-        output_names = [discrepancy_name] + model.parameter_names + (output_names or [])
-        super(Rejection, self).__init__(model, output_names, **kwargs)
+        if isinstance(discrepancy_name, (list, tuple)):
+            model = model.model if isinstance(model, NodeReference) else model
+            discrepancy_names = [self._resolve_model(model, d)[1]
+                                 for d in discrepancy_name]
+            discrepancy_name = discrepancy_names[0]
+        else:
+            model, discrepancy_name = self._resolve_model(model, discrepancy_name)
+            discrepancy_names = [discrepancy_name]
 
+        extra_outputs = output_names or []
+        output_names = discrepancy_names + model.parameter_names + extra_outputs
+        super(Rejection, self).__init__(model, output_names, **kwargs)
+        self._init_rejection(discrepancy_name, spill_path, worker_filter)
+
+        # Samplers for each of the discrepancies fed from the batches of this one
+        if len(discrepancy_names) > 1:
+            if worker_filter:
+                raise ValueError('Filtering the batches in the workers cannot be used '
+                                 'with several discrepancies')
+            self._rejections = OrderedDict()
+            for d in discrepancy_names:
+                path = None if spill_path is None else os.path.join(spill_path, d)
+                self._rejections[d] = self._discrepancy_sampler(d, extra_outputs, path)
+
+    def _discrepancy_sampler(self, discrepancy_name, output_names, spill_path):
+        """Return a sampler for one of the discrepancies.
+
+        It shares the model and the computation context with this sampler and only
+        merges the batches given to its `update`. It never submits batches itself.
+        """
+        rejection = Rejection.__new__(Rejection)
+        rejection._init_inference(self.model,
+                                  [discrepancy_name] + self.parameter_names + output_names,
+                                  self.client, self.computation_context, None,
+                                  self.max_parallel_batches)
+        rejection._init_rejection(discrepancy_name, spill_path, False)
+        return rejection
+
+    def _init_rejection(self, discrepancy_name, spill_path, worker_filter):
         self.discrepancy_name = discrepancy_name
+        self.spill_path = spill_path
+        self.worker_filter = _check_worker_filter(worker_filter, self.pool)
+        self._spill = None
+        self._rejections = None
 
     def set_objective(self, n_samples, threshold=None, quantile=None, n_sim=None):
         """
@@ -427,61 +517,233 @@ class Rejection(Sampler):
         ----------
         n_samples : int
             number of samples to generate
-        threshold : float
+        threshold : float or list
             Acceptance threshold
-        quantile : float
+        quantile : float or list
             In between (0,1). Define the threshold as the p-quantile of all the
             simulations. n_sim = n_samples/quantile.
-        n_sim : int
+        n_sim : int or list
             Total number of simulations. The threshold will be the n_samples smallest
             discrepancy among n_sim simulations.
 
+        Notes
+        -----
+        Giving a list of values for one of `threshold`, `quantile` or `n_sim` computes a
+        result for each of them from a single stream of simulations. The inference then
+        returns a list of samples and the number of simulations is that of the most
+        demanding value. Each sample is the same as from a separate inference with the
+        same seed.
+
         Returns
         -------
 
         """
+        if self._rejections:
+            for rejection in self._rejections.values():
+                rejection._set_objective(n_samples, threshold, quantile, n_sim)
+            self.state = dict(samples=None, n_sim=0, n_batches=0)
+            self.objective = dict(n_samples=n_samples,
+                                  n_batches=self._max_objective_n_batches())
+        else:
+            self._set_objective(n_samples, threshold, quantile, n_sim)
+
+        # Reset the inference
+        self.batches.reset()
+        self.batches.accept = None
+
+    def _set_objective(self, n_samples, threshold, quantile, n_sim):
         if quantile is None and threshold is None and n_sim is None:
             quantile = .01
         self.state = dict(samples=None, threshold=np.Inf, n_sim=0, accept_rate=1,
                           n_batches=0)
 
+        levels = self._resolve_levels(threshold, quantile, n_sim)
+        if levels is not None:
+            for level in levels:
+                level['n_batches'] = self._initial_n_batches(
+                    n_samples, level['quantile'], level['n_sim'])
+            thresholds = [level['threshold'] for level in levels
+                          if level['threshold'] is not None]
+            self.objective = dict(n_samples=n_samples,
+                                  threshold=min(thresholds) if thresholds else None,
+                                  n_batches=max(level['n_batches'] for level in levels),
+                                  levels=levels)
+            self.state['level_results'] = [None]*len(levels)
+        else:
+            self.objective = dict(n_samples=n_samples, threshold=threshold,
+                                  n_batches=self._initial_n_batches(n_samples, quantile,
+                                                                    n_sim))
+
+    def _initial_n_batches(self, n_samples, quantile, n_sim):
         if quantile: n_sim = ceil(n_samples/quantile)
 
         # Set initial n_batches estimate
         if n_sim:
-            n_batches = ceil(n_sim/self.batch_size)
-        else:
-            n_batches = self.max_parallel_batches
+            return ceil(n_sim/self.batch_size)
+        return self.max_parallel_batches
+
+    @staticmethod
+    def _resolve_levels(threshold, quantile, n_sim):
+        """Return a list of the acceptance levels or None if only one is given."""
+        values = dict(threshold=threshold, quantile=quantile, n_sim=n_sim)
+        multiple = [k for k, v in values.items()
+                    if isinstance(v, (list, tuple, np.ndarray))]
+        if not multiple:
+            return None
+        elif len(multiple) > 1 or any(v is not None for k, v in values.items()
+                                      if k != multiple[0]):
+            raise ValueError('Multiple levels can be given only for one of threshold, '
+                             'quantile and n_sim')
+
+        key = multiple[0]
+        levels = []
+        for value in values[key]:
+            level = dict(threshold=None, quantile=None, n_sim=None)
+            level[key] = value
+            levels.append(level)
+        return levels
+
+    def replay(self, n_samples, threshold=None, quantile=None, n_sim=None,
+               batches_per_chunk=None):
+        """Sample using the simulations stored in the pool without new simulations.
+
+        The outputs are recomputed from the stored nodes over large chunks of batches
+        in parallel (see `elfi.client.PoolReplay`). This is much faster than `sample`
+        when e.g. only the summaries or the discrepancy of the model have changed.
+
+        Parameters
+        ----------
+        n_samples : int
+            number of samples to generate
+        threshold : float, optional
+            Acceptance threshold. All the stored simulations are used.
+        quantile : float, optional
+            In between (0,1). Use the first n_samples/quantile stored simulations.
+        n_sim : int, optional
+            Number of stored simulations to use. Defaults to all of them.
+        batches_per_chunk : int, optional
+            Number of batches computed at once.
+
+        Returns
+        -------
+        result : Sample
+        """
+        if self.pool is None:
+            raise ValueError('Replaying requires a pool')
+        if self._rejections:
+            raise ValueError('Replaying is not supported with several discrepancies')
+
+        if quantile:
+            n_sim = ceil(n_samples/quantile)
+        n_batches = len(self.pool) if n_sim is None else ceil(n_sim/self.batch_size)
+        if n_batches > len(self.pool):
+            raise ValueError('The pool has only {} batches but {} were requested'
+                             .format(len(self.pool), n_batches))
 
         self.objective = dict(n_samples=n_samples, threshold=threshold,
                               n_batches=n_batches)
-
-        # Reset the inference
         self.batches.reset()
 
+        replay = elfi.client.PoolReplay(self.model, self.computation_context,
+                                        self.output_names, stop=n_batches,
+                                        client=self.client)
+        outputs = replay.compute(batches_per_chunk)
+
+        # Take the n_samples smallest discrepancies
+        discrepancies = outputs[self.discrepancy_name].ravel()
+        n_accepted = n_samples
+        if threshold is not None:
+            n_accepted = min(n_samples, np.count_nonzero(discrepancies <= threshold))
+            if n_accepted < n_samples:
+                logger.warning('Only {} stored simulations are below the threshold'
+                               .format(n_accepted))
+        inds = np.argsort(discrepancies, kind='mergesort')[:n_accepted]
+
+        s = self.state
+        s['samples'] = {k: v[inds] for k, v in outputs.items()}
+        s['spill_rows'] = None
+        s['n_batches'] = n_batches
+        s['n_sim'] = n_batches*self.batch_size
+        s['threshold'] = discrepancies[inds[-1]].item() if n_accepted else np.Inf
+        s['accept_rate'] = min(1, n_accepted/s['n_sim'])
+
+        return self.extract_result()
+
     def update(self, batch, batch_index):
         super(Rejection, self).update(batch, batch_index)
+        if self._rejections:
+            for rejection in self._rejections.values():
+                # Do not change a finished sample with further batches
+                if not rejection.finished:
+                    rejection.update(batch, batch_index)
+            self.objective['n_batches'] = self._max_objective_n_batches()
+            return
+
         if self.state['samples'] is None:
             # Lazy initialization of the outputs dict
             self._init_samples_lazy(batch)
         self._merge_batch(batch)
         self._update_state_meta()
         self._update_objective_n_batches()
+        if self.worker_filter:
+            self.batches.accept = self._accept_condition()
+        if 'levels' in self.objective:
+            self._extract_finished_levels()
+
+    def _max_objective_n_batches(self):
+        return max(r.objective['n_batches'] for r in self._rejections.values())
+
+    def _extract_finished_levels(self):
+        results = self.state['level_results']
+        for i, level in enumerate(self.objective['levels']):
+            if results[i] is None and level['n_batches'] <= self.state['n_batches']:
+                results[i] = self._extract_sample()
+
+    def _accept_condition(self):
+        """Rows with a discrepancy above the current threshold can never be accepted."""
+        threshold = self.state['threshold']
+        if not np.isfinite(threshold):
+            return None
+        return self.discrepancy_name, threshold
 
     def extract_result(self):
         """Extracts the result from the current state
 
         Returns
         -------
-        result : Sample
+        result : Sample, list or dict
+            A list of samples if several acceptance levels were given in the objective.
+            The levels that have not been reached yet use the current state. With
+            several discrepancies a dict of these with the discrepancy names as keys.
         """
+        if self._rejections:
+            return OrderedDict((d, rejection.extract_result())
+                               for d, rejection in self._rejections.items())
+        if 'levels' in self.objective:
+            return [self._extract_sample() if result is None else result
+                    for result in self.state['level_results']]
+        return self._extract_sample()
+
+    def _extract_sample(self):
         if self.state['samples'] is None:
             raise ValueError('Nothing to extract')
 
-        # Take out the correct number of samples
+        # The samples are kept unordered, so sort them by the discrepancy here
+        samples = self.state['samples']
+        discrepancies = samples[self.discrepancy_name].reshape(-1)
+        order = np.argsort(discrepancies, kind='mergesort')[:self.objective['n_samples']]
         outputs = dict()
-        for k, v in self.state['samples'].items():
-            outputs[k] = v[:self.objective['n_samples']]
+        for k, v in samples.items():
+            outputs[k] = v[order]
+
+        rows = self.state.get('spill_rows')
+        if rows is not None:
+            # Leave out the slots that were never filled
+            order = order[rows[order] >= 0]
+            outputs[self.discrepancy_name] = samples[self.discrepancy_name][order]
+            for node, spill in self._spill.items():
+                filename = self._write_spilled_rows(spill, rows[order], node)
+                outputs[node] = np.load(filename, mmap_mode='r')
 
         return Sample(outputs=outputs, **self._extract_result_kwargs())
 
@@ -499,11 +761,15 @@ class Rejection(Sampler):
             nbatch = batch[node]
             if not is_array(nbatch):
                 raise ValueError(e_noarr.format(node, self.batch_size))
-            elif len(nbatch) != self.batch_size:
+            elif len(nbatch) != self.batch_size and not self.worker_filter:
                 raise ValueError(e_len.format(node, len(nbatch), self.batch_size))
 
+            if self.spill_path is not None and node != self.discrepancy_name:
+                # Spilled to the disk
+                continue
+
             # Prepare samples
-            shape = (self.objective['n_samples'] + self.batch_size,) + nbatch.shape[1:]
+            shape = (self.objective['n_samples'],) + nbatch.shape[1:]
             dtype = nbatch.dtype
 
             if node == self.discrepancy_name:
@@ -512,51 +778,143 @@ class Rejection(Sampler):
             else:
                 samples[node] = np.empty(shape, dtype=dtype)
 
+        if self.spill_path is not None:
+            self._init_spill()
+        else:
+            self.state['spill_rows'] = None
         self.state['samples'] = samples
 
+    def _init_spill(self):
+        """Prepare the spill arrays for the outputs other than the discrepancy."""
+        os.makedirs(self.spill_path, exist_ok=True)
+        if self._spill is not None:
+            for spill in self._spill.values():
+                spill.close()
+
+        self._spill = {}
+        for node in self.output_names:
+            if node == self.discrepancy_name:
+                continue
+            filename = os.path.join(self.spill_path, '{}_spill'.format(node))
+            self._spill[node] = NpyPersistedArray(filename, truncate=True)
+
+        # Row of each accepted sample in the spill arrays
+        self.state['spill_rows'] = np.full(self.objective['n_samples'], -1,
+                                           dtype=np.int64)
+
     def _merge_batch(self, batch):
-        # TODO: add index vector so that you can recover the original order
+        """Replace the worst accepted samples with the better ones from the batch.
+
+        The accepted samples are not kept in order. Only the rows entering the accepted
+        set are copied.
+        """
         samples = self.state['samples']
-        # Put the acquired samples to the end
-        for node, v in samples.items():
-            v[self.objective['n_samples']:] = batch[node]
+        n_samples = self.objective['n_samples']
+        accepted = samples[self.discrepancy_name].reshape(-1)
+        new = np.asarray(batch[self.discrepancy_name]).reshape(-1)
 
-        # Sort the smallest to the beginning
-        sort_mask = np.argsort(samples[self.discrepancy_name], axis=0).ravel()
-        for k, v in samples.items():
-            v[:] = v[sort_mask]
+        # Only the rows better than the worst accepted sample may enter
+        candidates = np.flatnonzero(new < accepted.max())
+        if len(candidates) == 0:
+            return
+
+        discrepancies = np.concatenate((accepted, new[candidates]))
+        best = np.argpartition(discrepancies, n_samples - 1)[:n_samples]
+
+        leaving = np.ones(n_samples, dtype=bool)
+        leaving[best[best < n_samples]] = False
+        leaving = np.flatnonzero(leaving)
+        entering = candidates[best[best >= n_samples] - n_samples]
+
+        for node, v in samples.items():
+            v[leaving] = batch[node][entering]
+
+        if self._spill and self.state['spill_rows'] is not None:
+            self._spill_rows(batch, leaving, entering)
+
+    def _spill_rows(self, batch, leaving, entering):
+        rows = self.state['spill_rows']
+        start = len(next(iter(self._spill.values())))
+        for node, spill in self._spill.items():
+            spill.append(np.asarray(batch[node])[entering])
+        rows[leaving] = np.arange(start, start + len(entering))
+
+        # Compact the spill files when most of the rows have been rejected
+        if start + len(entering) > 4*len(rows):
+            self._compact_spill()
+
+    def _compact_spill(self):
+        rows = self.state['spill_rows']
+        filled = np.flatnonzero(rows >= 0)
+        for node, spill in list(self._spill.items()):
+            filename = self._write_spilled_rows(spill, rows[filled], node + '_spill')
+            spill.close()
+            self._spill[node] = NpyPersistedArray(filename)
+        rows[filled] = np.arange(len(filled))
+
+    def _write_spilled_rows(self, spill, rows, name, chunk_size=10000):
+        """Copy the rows of the spill array to a new .npy file in chunks.
+
+        The file is replaced atomically, so that earlier results memory mapping the same
+        file remain valid.
+        """
+        spill.flush()
+        filename = os.path.join(self.spill_path, name + '.npy')
+        tmp = NpyPersistedArray(os.path.join(self.spill_path, name + '_tmp'),
+                                truncate=True)
+        for i in range(0, len(rows), chunk_size):
+            tmp.append(np.asarray(spill[rows[i:i + chunk_size]]))
+        if len(rows) == 0:
+            # Write an empty array of the correct shape and dtype
+            tmp.append(np.asarray(spill[:0]))
+        tmp.close()
+        os.replace(tmp.name, filename)
+        return filename
 
     def _update_state_meta(self):
         """Updates n_sim, threshold, and accept_rate
         """
         o = self.objective
         s = self.state
-        s['threshold'] = s['samples'][self.discrepancy_name][o['n_samples'] - 1].item()
+        s['threshold'] = s['samples'][self.discrepancy_name].max().item()
         s['accept_rate'] = min(1, o['n_samples']/s['n_sim'])
 
     def _update_objective_n_batches(self):
+        if 'levels' in self.objective:
+            levels = self.objective['levels']
+            for i, level in enumerate(levels):
+                # Finished levels are not updated
+                if level['threshold'] and self.state['level_results'][i] is None:
+                    level['n_batches'] = self._estimate_n_batches(level['threshold'],
+                                                                  level['n_batches'])
+            self.objective['n_batches'] = max(level['n_batches'] for level in levels)
+            return
+
         # Only in the case that the threshold is used
         if not self.objective.get('threshold'): return
 
+        self.objective['n_batches'] = self._estimate_n_batches(
+            self.objective['threshold'], self.objective['n_batches'])
+        logger.debug('Estimated objective n_batches=%d' % self.objective['n_batches'])
+
+    def _estimate_n_batches(self, t, n_batches):
+        """Estimate the number of batches needed for n_samples below the threshold t"""
         s = self.state
-        t, n_samples = [self.objective.get(k) for k in ('threshold', 'n_samples')]
+        n_samples = self.objective['n_samples']
 
         # noinspection PyTypeChecker
         n_acceptable = np.sum(s['samples'][self.discrepancy_name] <= t) if s['samples'] else 0
         if n_acceptable == 0:
             # No acceptable samples found yet, increase n_batches of objective by one in
             # order to keep simulating
-            n_batches = self.objective['n_batches'] + 1
-        else:
-            accept_rate_t = n_acceptable / s['n_sim']
-            # Add some margin to estimated n_batches. One could also use confidence
-            # bounds here
-            margin = .2 * self.batch_size * int(n_acceptable < n_samples)
-            n_batches = (n_samples / accept_rate_t + margin) / self.batch_size
-            n_batches = ceil(n_batches)
-
-        self.objective['n_batches'] = n_batches
-        logger.debug('Estimated objective n_batches=%d' % self.objective['n_batches'])
+            return n_batches + 1
+
+        accept_rate_t = n_acceptable / s['n_sim']
+        # Add some margin to estimated n_batches. One could also use confidence
+        # bounds here
+        margin = .2 * self.batch_size * int(n_acceptable < n_samples)
+        n_batches = (n_samples / accept_rate_t + margin) / self.batch_size
+        return ceil(n_batches)
 
     def plot_state(self, **options):
         displays = []
@@ -571,7 +929,79 @@ class Rejection(Sampler):
 
 class SMC(Sampler):
     """Sequential Monte Carlo ABC sampler"""
-    def __init__(self, model, discrepancy_name=None, output_names=None, **kwargs):
+
+    # Name of the internal output holding the log proposal density of each sample
+    _proposal_logpdf = '_proposal_logpdf'
+    # Names of the internal nodes for the proposal (means, cov, weights) and its draws
+    _proposal = '_proposal'
+    _proposal_rvs = '_proposal_rvs'
+
+    def __init__(self, model, discrepancy_name=None, output_names=None,
+                 worker_filter=False, reuse_pending=False, covariance='diagonal',
+                 worker_proposal=False, recycle=False, **kwargs):
+        """
+
+        Parameters
+        ----------
+        model : ElfiModel or NodeReference
+        discrepancy_name : str, NodeReference, optional
+            Only needed if model is an ElfiModel. Unlike in `Rejection`, only a single
+            discrepancy is supported, since the proposals of the later rounds depend on
+            the discrepancy of the earlier ones.
+        output_names : list
+            Additional outputs from the model to be included in the inference result.
+        worker_filter : bool, optional
+            Filter the batches in the workers by the current threshold of the round. See
+            `Rejection`.
+        reuse_pending : bool, optional
+            Do not cancel the batches that are still being computed when a round
+            finishes, but use them in the next round. The samples are weighted by the
+            proposal they were generated from. This saves simulations with many workers
+            but forgoes the guarantee for the exactly same result with the same seed,
+            since the number of such batches depends on the timing. Cannot be used
+            together with `worker_filter`. Default False.
+        covariance : str, optional
+            Covariance of the Gaussian proposal around each particle. 'diagonal'
+            (default) and 'full' use twice the weighted sample covariance of the
+            population (only its diagonal for 'diagonal'). 'olcm' uses the optimal local
+            covariance matrix of each particle computed from the particles below the next
+            threshold, which suits correlated or curved posteriors better [1].
+        worker_proposal : bool, optional
+            Draw the parameters from the proposal and compute their proposal density in
+            the workers with the random state of each batch. Only the proposal is sent
+            with the batches, which relieves the master with many workers. The results
+            differ from those with the parameters drawn in the master. Default False.
+        recycle : bool, optional
+            Keep the simulations of each round that are below its threshold and admit
+            those below the threshold of a later round into its population, so that
+            fewer new simulations are needed. The samples are then weighted by the
+            mixture of all the proposals so far (multiple importance sampling) and the
+            populations may be larger than n_samples. Not used together with
+            `reuse_pending` or `worker_filter`. Default False.
+        kwargs:
+            See InferenceMethod
+
+        References
+        ----------
+        [1] Filippi S, Barnes CP, Cornebise J, Stumpf MPH (2013). On optimality of
+        kernels for approximate Bayesian computation using sequential Monte Carlo.
+        Statistical Applications in Genetics and Molecular Biology 12(1):87-107.
+        """
+        if recycle and (reuse_pending or worker_filter):
+            raise ValueError('Recycling the simulations cannot be used with '
+                             'reuse_pending or worker_filter')
+        if reuse_pending and worker_filter:
+            raise ValueError('The pending batches cannot be reused with worker_filter, '
+                             'since they were filtered by the threshold of their round')
+        if covariance not in ('diagonal', 'full', 'olcm'):
+            raise ValueError("Covariance must be 'diagonal', 'full' or 'olcm' (was {})"
+                             .format(covariance))
+        if isinstance(discrepancy_name, (list, tuple)):
+            if len(discrepancy_name) != 1:
+                raise ValueError('SMC supports a single discrepancy. Use Rejection '
+                                 'with a list of discrepancies to compare them on the '
+                                 'same simulations, e.g. for the first round.')
+            discrepancy_name = discrepancy_name[0]
         model, discrepancy_name = self._resolve_model(model, discrepancy_name)
 
         # Add the prior pdf nodes to the model
@@ -581,20 +1011,93 @@ class SMC(Sampler):
         output_names = [discrepancy_name] + model.parameter_names + [logpdf_name] + \
                        (output_names or [])
 
+        # The weights need the prior densities in full precision
+        self.prior_logpdf = logpdf_name
         super(SMC, self).__init__(model, output_names, **kwargs)
 
         self.discrepancy_name = discrepancy_name
-        self.prior_logpdf = logpdf_name
+        self.worker_filter = _check_worker_filter(worker_filter, self.pool)
+        self.reuse_pending = reuse_pending
+        self.covariance = covariance
+        self.worker_proposal = worker_proposal
+        self.recycle = recycle
         self.state['round'] = 0
         self._populations = []
         self._rejection = None
         self._round_random_state = None
 
-    def set_objective(self, n_samples, thresholds):
+        # Round of each pending batch and the proposal of each round
+        self._batch_rounds = {}
+        self._proposals = {}
+
+        # Outputs below the threshold and the number of simulations of each round, and
+        # the outputs admitted to the current round from the earlier ones
+        self._round_outputs = []
+        self._round_n_sim = []
+        self._recycled = None
+
+        # Net drawing the parameters from the proposal of the round in the workers
+        self._prior_net = self.batches.compiled_net
+        self._proposal_net = self._compile_proposal_net() if worker_proposal else None
+
+    def set_objective(self, n_samples, thresholds=None, quantile=None,
+                      min_threshold=None, min_accept_rate=None, max_sim=None,
+                      max_rounds=None):
+        """
+
+        Parameters
+        ----------
+        n_samples : int
+            Number of samples in each population
+        thresholds : list, optional
+            Acceptance thresholds of the rounds
+        quantile : float, optional
+            In between (0,1). Adapt the thresholds instead of giving them. The first
+            round accepts this quantile of the simulations from the prior, and the
+            threshold of each following round is this quantile of the discrepancies of
+            the previous population.
+        min_threshold : float, optional
+            Stop after a round whose threshold reaches this target tolerance. The
+            adapted thresholds are not set below it.
+        min_accept_rate : float, optional
+            Stop after a round whose acceptance rate falls below this.
+        max_sim : int, optional
+            Do not start new rounds after this many simulations in total.
+        max_rounds : int, optional
+            Maximum number of rounds.
+
+        Notes
+        -----
+        The stopping criteria are checked between the rounds and they can also end a
+        schedule given in `thresholds` early. With `quantile`, at least one of them must
+        be given.
+
+        """
+        if (thresholds is None) == (quantile is None):
+            raise ValueError('Give either thresholds or quantile')
+        if quantile is not None:
+            if not 0 < quantile < 1:
+                raise ValueError('Quantile must be in between (0,1)')
+            if min_threshold is None and min_accept_rate is None and max_sim is None \
+                    and max_rounds is None:
+                raise ValueError('The adaptive thresholds need a stopping criterion: '
+                                 'min_threshold, min_accept_rate, max_sim or max_rounds')
+            # The threshold of the first round is decided by the quantile
+            thresholds = [None]
+            n_rounds = np.inf if max_rounds is None else max_rounds
+        else:
+            thresholds = list(thresholds)
+            n_rounds = len(thresholds) if max_rounds is None else \
+                min(max_rounds, len(thresholds))
+
         self.objective.update(dict(n_samples=n_samples,
                                    n_batches=self.max_parallel_batches,
-                                   round=len(thresholds) - 1,
-                                   thresholds=thresholds))
+                                   round=n_rounds - 1,
+                                   thresholds=thresholds,
+                                   quantile=quantile,
+                                   min_threshold=min_threshold,
+                                   min_accept_rate=min_accept_rate,
+                                   max_sim=max_sim))
         self._init_new_round()
 
     def extract_result(self):
@@ -612,10 +1115,25 @@ class SMC(Sampler):
                          **self._extract_result_kwargs())
 
     def update(self, batch, batch_index):
+        # Count the batch before the stopping criteria of the round are checked
+        self.state['n_batches'] += 1
+        self.state['n_sim'] += self.batch_size
+
+        if self.reuse_pending or self.worker_proposal:
+            batch = self._add_proposal_logpdf(batch, batch_index)
+        else:
+            self._batch_rounds.pop(batch_index, None)
+        if self.recycle:
+            self._store_outputs(batch)
         self._rejection.update(batch, batch_index)
+        if self.worker_filter:
+            self.batches.accept = self._rejection._accept_condition()
 
         if self._rejection.finished:
-            self.batches.cancel_pending()
+            if not self.reuse_pending:
+                self.batches.cancel_pending()
+            if self.state['round'] < self.objective['round']:
+                self._set_next_threshold()
             if self.state['round'] < self.objective['round']:
                 self._populations.append(self._extract_population())
                 self.state['round'] += 1
@@ -625,10 +1143,14 @@ class SMC(Sampler):
         self._update_objective()
 
     def prepare_new_batch(self, batch_index):
+        self._batch_rounds[batch_index] = self.state['round']
         if self.state['round'] == 0:
             # Use the actual prior
             return
 
+        if self.worker_proposal:
+            return {self._proposal: self._gm_params}
+
         # Sample from the proposal
         params = GMDistribution.rvs(*self._gm_params, size=self.batch_size,
                                     random_state=self._round_random_state)
@@ -646,18 +1168,148 @@ class SMC(Sampler):
         seed = self.seed if round == 0 else get_sub_seed(self.seed, round)
         self._round_random_state = np.random.RandomState(seed)
 
-        self._rejection = Rejection(self.model,
-                                    discrepancy_name=self.discrepancy_name,
-                                    output_names=self.output_names,
-                                    batch_size=self.batch_size,
-                                    seed=seed,
-                                    max_parallel_batches=self.max_parallel_batches)
-
-        self._rejection.set_objective(self.objective['n_samples'],
-                                      threshold=self.current_population_threshold)
+        if self._rejection is None:
+            # The batches are computed by this sampler, so the same Rejection (and its
+            # compiled net) can be used for all the rounds
+            self._rejection = Rejection(self.model,
+                                        discrepancy_name=self.discrepancy_name,
+                                        output_names=self.output_names,
+                                        batch_size=self.batch_size,
+                                        seed=self.seed,
+                                        max_parallel_batches=self.max_parallel_batches,
+                                        worker_filter=self.worker_filter)
+            if self.reuse_pending or self.worker_proposal:
+                self._rejection.output_names.append(self._proposal_logpdf)
+        self._rejection.computation_context.seed = seed
+        if self.worker_proposal:
+            self.batches.compiled_net = self._prior_net if round == 0 else \
+                self._proposal_net
+        self.batches.accept = None
+        if round > 0:
+            self._proposals[round] = self._gm_params
+
+        threshold = self.current_population_threshold
+        quantile = self.objective['quantile'] if threshold is None else None
+        n_samples = self.objective['n_samples']
+        if self.recycle:
+            if round > 0:
+                self._round_n_sim.append(self._rejection.state['n_sim'])
+                self._recycled = self._recycle_outputs(threshold)
+                n_recycled = len(self._recycled[self.discrepancy_name])
+                logger.info('Recycled %d simulations from the earlier rounds'
+                            % n_recycled)
+                n_samples = max(n_samples - n_recycled, 1)
+            self._round_outputs.append([])
+        self._rejection.set_objective(n_samples, threshold=threshold, quantile=quantile)
+
+    def _store_outputs(self, batch):
+        """Store the rows of the batch below the threshold of the round."""
+        threshold = self.current_population_threshold
+        d = np.asarray(batch[self.discrepancy_name])
+        mask = np.ones(len(d), dtype=bool) if threshold is None else \
+            d.reshape(len(d), -1)[:, 0] <= threshold
+        self._round_outputs[-1].append({k: batch[k][mask] for k in self.output_names})
+
+    def _recycle_outputs(self, threshold):
+        """Return the stored outputs of the earlier rounds below the threshold.
+
+        The stored outputs above the thresholds of the remaining rounds are dropped.
+        """
+        max_threshold = max(self.objective['thresholds'][self.state['round']:])
+        recycled = []
+        for i, outputs in enumerate(self._round_outputs):
+            outputs = {k: np.concatenate([o[k] for o in outputs])
+                       for k in self.output_names}
+            d = outputs[self.discrepancy_name]
+            d = d.reshape(len(d), -1)[:, 0]
+            self._round_outputs[i] = [{k: v[d <= max_threshold]
+                                       for k, v in outputs.items()}]
+            recycled.append({k: v[d <= threshold] for k, v in outputs.items()})
+        return {k: np.concatenate([r[k] for r in recycled]) for k in self.output_names}
+
+    def _set_next_threshold(self):
+        """Check the stopping criteria after a finished round and set the threshold of
+        the next round if the rounds continue."""
+        o = self.objective
+        round = self.state['round']
+        rejection_state = self._rejection.state
+        threshold = rejection_state['threshold']
+        if o['thresholds'][round] is None:
+            o['thresholds'][round] = threshold
+        n_sim = self.state['n_sim']
+
+        stop = None
+        if o['min_threshold'] is not None and threshold <= o['min_threshold']:
+            stop = 'reached the threshold {}'.format(o['min_threshold'])
+        elif o['min_accept_rate'] is not None and \
+                rejection_state['accept_rate'] < o['min_accept_rate']:
+            stop = 'acceptance rate {:.4g} is below {}'.format(
+                rejection_state['accept_rate'], o['min_accept_rate'])
+        elif o['max_sim'] is not None and n_sim >= o['max_sim']:
+            stop = 'used {} of the {} simulations'.format(n_sim, o['max_sim'])
+        elif o['quantile'] is not None:
+            discrepancies = rejection_state['samples'][self.discrepancy_name]
+            next_threshold = np.percentile(discrepancies, 100*o['quantile']).item()
+            if o['min_threshold'] is not None:
+                next_threshold = max(next_threshold, o['min_threshold'])
+            if next_threshold < threshold:
+                o['thresholds'].append(next_threshold)
+            else:
+                stop = 'the threshold {} did not decrease'.format(threshold)
+
+        if stop is not None:
+            logger.info('Stopping after round %d: %s' % (round, stop))
+            o['round'] = round
+            del o['thresholds'][round + 1:]
+
+    def _compile_proposal_net(self):
+        """Compile a net where the parameters are drawn from the proposal given in the
+        batch and their log proposal density is an output."""
+        net = nx.DiGraph(self._prior_net)
+        net.graph['outputs'] = list(net.graph['outputs']) + [self._proposal_logpdf]
+
+        net.add_node(self._proposal)
+        net.add_node(self._proposal_rvs, operation=gm_proposal_rvs)
+        net.add_edge(self._proposal, self._proposal_rvs, param=0)
+        for node, param in [('_batch_size', 'batch_size'),
+                            ('_random_state', 'random_state')]:
+            # The loaders fill in these nodes
+            net.add_node(node)
+            net.add_edge(node, self._proposal_rvs, param=param)
+
+        for i, name in enumerate(self.parameter_names):
+            net.remove_edges_from(net.in_edges(name))
+            net.node[name] = {'operation': partial(take_column, index=i)}
+            net.add_edge(self._proposal_rvs, name, param=0)
+
+        net.add_node(self._proposal_logpdf, operation=gm_proposal_logpdf)
+        net.add_edge(self._proposal_rvs, self._proposal_logpdf, param=0)
+        net.add_edge(self._proposal, self._proposal_logpdf, param=1)
+        return net
+
+    def _add_proposal_logpdf(self, batch, batch_index):
+        """Add the log density of the proposal that generated the parameters."""
+        batch = dict(batch)
+        round = self._batch_rounds.pop(batch_index, self.state['round'])
+        # The density is computed already in the worker with `worker_proposal`
+        if self._proposal_logpdf not in batch:
+            if round == 0:
+                q_logpdf = batch[self.prior_logpdf]
+            else:
+                params = batch_to_arr2d(batch, self.parameter_names)
+                q_logpdf = GMDistribution.logpdf(params, *self._proposals[round])
+            batch[self._proposal_logpdf] = np.asarray(q_logpdf).reshape(-1)
+
+        # Forget the proposals that are no longer needed
+        oldest = min(self._batch_rounds.values(), default=self.state['round'])
+        for r in [r for r in self._proposals if r < oldest]:
+            del self._proposals[r]
+        return batch
 
     def _extract_population(self):
         sample = self._rejection.extract_result()
+        if self._recycled is not None:
+            sample = self._add_recycled(sample)
         # Append the sample object
         sample.method_name = "Rejection within SMC-ABC"
         w, cov = self._compute_weights_and_cov(sample)
@@ -666,11 +1318,56 @@ class SMC(Sampler):
         sample.meta['n_batches'] = self._rejection.state['n_batches']
         return sample
 
+    def _add_recycled(self, sample):
+        """Add the recycled outputs to the sample of the round."""
+        outputs = {k: np.concatenate([self._recycled[k], sample.outputs[k]])
+                   for k in self._recycled}
+        d = outputs[self.discrepancy_name]
+        order = np.argsort(d.reshape(len(d), -1)[:, 0], kind='mergesort')
+        outputs = {k: v[order] for k, v in outputs.items()}
+        meta = dict(sample.meta, n_recycled=len(d) - sample.n_samples)
+        return Sample(method_name=sample.method_name, outputs=outputs,
+                      parameter_names=sample.parameter_names,
+                      discrepancy_name=sample.discrepancy_name, **meta)
+
+    def _mixture_logpdf(self, params, prior_logpdf):
+        """Log density of the mixture of the proposals of all the rounds so far weighted
+        by their number of simulations."""
+        n_sim = np.array(self._round_n_sim + [self._rejection.state['n_sim']])
+        logpdfs = [prior_logpdf]
+        for pop in self._populations[:len(n_sim) - 1]:
+            logpdfs.append(self._gm_logpdf(params, pop.samples_array, pop.cov,
+                                           pop.weights))
+        logpdfs = np.column_stack(logpdfs) + np.log(n_sim/np.sum(n_sim))
+        return logsumexp(logpdfs, axis=1)
+
+    @property
+    def _full_precision_outputs(self):
+        return [self.prior_logpdf]
+
+    def _gm_logpdf(self, params, means, cov, weights):
+        """Log density of a proposal of the populations.
+
+        The chunks of the points are evaluated in the client unless it is still computing
+        batches, which the chunks would have to wait for.
+        """
+        client = None if self.batches.has_pending else self.client
+        return GMDistribution.logpdf(params, means, cov, weights, client=client)
+
     def _compute_weights_and_cov(self, pop):
         params = np.column_stack(tuple([pop.outputs[p] for p in self.parameter_names]))
 
-        if self._populations:
-            q_logpdf = GMDistribution.logpdf(params, *self._gm_params)
+        if self.recycle:
+            # Multiple importance sampling weights for the samples from all the rounds
+            prior_logpdf = pop.outputs[self.prior_logpdf]
+            pop.outputs.pop(self._proposal_logpdf, None)
+            w = np.exp(prior_logpdf - self._mixture_logpdf(params, prior_logpdf))
+        elif self._proposal_logpdf in pop.outputs:
+            # Each sample is weighted by the proposal it was generated from
+            q_logpdf = pop.outputs.pop(self._proposal_logpdf)
+            w = np.exp(pop.outputs[self.prior_logpdf] - q_logpdf)
+        elif self._populations:
+            q_logpdf = self._gm_logpdf(params, *self._gm_params)
             w = np.exp(pop.outputs[self.prior_logpdf] - q_logpdf)
         else:
             w = np.ones(pop.n_samples)
@@ -681,7 +1378,13 @@ class SMC(Sampler):
                                "a too small sample size.")
 
         # New covariance
-        cov = 2 * np.diag(weighted_var(params, w))
+        if self.covariance == 'olcm':
+            discrepancies = pop.outputs[self.discrepancy_name].reshape(-1)
+            cov = self._compute_local_cov(params, w, discrepancies)
+        elif self.covariance == 'full':
+            cov = 2 * np.atleast_2d(np.cov(params, rowvar=False, aweights=w))
+        else:
+            cov = 2 * np.diag(weighted_var(params, w))
 
         if not np.all(np.isfinite(cov)):
             logger.warning("Could not estimate the sample covariance. This is often "
@@ -691,12 +1394,33 @@ class SMC(Sampler):
 
         return w, cov
 
+    def _compute_local_cov(self, params, w, discrepancies):
+        """Optimal local covariance matrices of the particles.
+
+        The covariance of particle i is the weighted sum of (x_k - x_i)(x_k - x_i)^T
+        over the particles k below the next threshold, i.e. the weighted covariance of
+        those particles plus the outer product of the particle's distance to their mean.
+        """
+        thresholds = self.objective['thresholds']
+        round = self.state['round']
+        local = np.ones(len(params), dtype=bool)
+        if round + 1 < len(thresholds):
+            local = discrepancies <= thresholds[round + 1]
+            if np.count_nonzero(w[local]) <= params.shape[1]:
+                # Too few particles for a nonsingular covariance
+                local[:] = True
+
+        w_local = w[local] / np.sum(w[local])
+        mean = w_local.dot(params[local])
+        diff = params[local] - mean
+        cov = (w_local[:, None] * diff).T.dot(diff)
+        dist = params - mean
+        return cov[None, :, :] + dist[:, :, None] * dist[:, None, :]
+
     def _update_state(self):
-        """Updates n_sim, threshold, and accept_rate
+        """Updates threshold, and accept_rate
         """
         s = self.state
-        s['n_batches'] += 1
-        s['n_sim'] += self.batch_size
         # TODO: use overall estimates
         s['threshold'] = self._rejection.state['threshold']
         s['accept_rate'] = self._rejection.state['accept_rate']
@@ -717,13 +1441,21 @@ class SMC(Sampler):
         return self.objective['thresholds'][self.state['round']]
 
 
+def _check_worker_filter(worker_filter, pool):
+    if worker_filter and pool is not None:
+        raise ValueError('Filtering the batches in the workers cannot be used with a '
+                         'pool, which needs to store the whole batches')
+    return worker_filter
+
+
 class BayesianOptimization(ParameterInference):
     """Bayesian Optimization of an unknown target function."""
 
     def __init__(self, model, target_name=None, bounds=None, initial_evidence=None,
                  update_interval=10, target_model=None, acquisition_method=None,
                  acq_noise_var=0, exploration_rate=10, batch_size=1,
-                 batches_per_acquisition=None, async=False, **kwargs):
+                 batches_per_acquisition=None, async=False, acq_batch_method=None,
+                 parallel_acquisition=False, **kwargs):
         """
         Parameters
         ----------
@@ -739,7 +1471,7 @@ class BayesianOptimization(ParameterInference):
             and discrepancy values. Default value depends on the dimensionality.
         update_interval : int
             How often to update the GP hyperparameters of the target_model
-        target_model : GPyRegression, optional
+        target_model : GPyRegression or GPRegression, optional
         acquisition_method : Acquisition, optional
             Method of acquiring evidence points. Defaults to LCBSC.
         acq_noise_var : float or np.array, optional
@@ -758,6 +1490,16 @@ class BayesianOptimization(ParameterInference):
             efficient with a large amount of workers (e.g. in cluster environments) but
             forgoes the guarantee for the exactly same result with the same initial
             conditions (e.g. the seed). Default False.
+        acq_batch_method : str, optional
+            How the default LCBSC acquisition method acquires distinct points for a
+            batch: 'kriging_believer', 'constant_liar' or 'local_penalization'. The
+            points still under evaluation are taken into account. Default is to copy
+            the minimum of the acquisition function.
+        parallel_acquisition : bool, optional
+            Refine the candidate points of the default LCBSC acquisition method, and in
+            BOLFI those of the threshold of the posterior, as separate tasks in the
+            client instead of in lockstep. This pays off with an expensive surrogate
+            model and idle workers. Default False.
         **kwargs
         """
 
@@ -780,12 +1522,15 @@ class BayesianOptimization(ParameterInference):
             self.target_model.update(params, precomputed[target_name])
 
         self.batches_per_acquisition = batches_per_acquisition or self.max_parallel_batches
+        self.parallel_acquisition = parallel_acquisition
         self.acquisition_method = acquisition_method or \
                                   LCBSC(self.target_model,
                                         prior=ModelPrior(self.model),
                                         noise_var=acq_noise_var,
                                         exploration_rate=exploration_rate,
-                                        seed=self.seed)
+                                        seed=self.seed,
+                                        batch_method=acq_batch_method,
+                                        client=self._acquisition_client)
 
         self.n_initial_evidence = n_initial
         self.n_precomputed_evidence = n_precomputed
@@ -795,6 +1540,11 @@ class BayesianOptimization(ParameterInference):
         self.state['n_evidence'] = self.n_precomputed_evidence
         self.state['last_GP_update'] = self.n_initial_evidence
         self.state['acquisition'] = []
+        self._acquired_batches = {}
+
+    @property
+    def _acquisition_client(self):
+        return self.client if self.parallel_acquisition else None
 
     def _resolve_initial_evidence(self, initial_evidence):
         # Some sensibility limit for starting GP regression
@@ -871,6 +1621,7 @@ class BayesianOptimization(ParameterInference):
         """
         super(BayesianOptimization, self).update(batch, batch_index)
         self.state['n_evidence'] += self.batch_size
+        self._acquired_batches.pop(batch_index, None)
 
         params = batch_to_arr2d(batch, self.parameter_names)
         self._report_batch(batch_index, params, batch[self.target_name])
@@ -889,13 +1640,24 @@ class BayesianOptimization(ParameterInference):
         # Take the next batch from the acquisition_batch
         acquisition = self.state['acquisition']
         if len(acquisition) == 0:
-            acquisition = self.acquisition_method.acquire(self.acq_batch_size, t=t)
+            acquisition = self.acquisition_method.acquire(self.acq_batch_size, t=t,
+                                                          pending=self._pending_points)
 
+        self._acquired_batches[batch_index] = acquisition[:self.batch_size]
         batch = arr2d_to_batch(acquisition[:self.batch_size], self.parameter_names)
         self.state['acquisition'] = acquisition[self.batch_size:]
 
         return batch
 
+    @property
+    def _pending_points(self):
+        """Acquired points of the batches still under evaluation."""
+        points = [self._acquired_batches[i] for i in self.batches.pending_indices
+                  if i in self._acquired_batches]
+        if len(points) == 0:
+            return None
+        return np.concatenate(points)
+
     def _get_acquisition_index(self, batch_index):
         acq_batch_size = self.batch_size * self.batches_per_acquisition
         initial_offset = self.n_initial_evidence - self.n_precomputed_evidence
@@ -967,7 +1729,7 @@ class BayesianOptimization(ParameterInference):
             if len(gp.X) > 1:
                 f.axes[1].scatter(*point, color='red')
 
-        displays = [gp._gp]
+        displays = [getattr(gp, '_gp', gp)]
 
         if options.get('interactive'):
             from IPython import display
@@ -1004,7 +1766,7 @@ class BayesianOptimization(ParameterInference):
         axes = axes.ravel()
 
         for ii in range(n_plots):
-            axes[ii].scatter(self.target_model._gp.X[:, ii], self.target_model._gp.Y[:, 0])
+            axes[ii].scatter(self.target_model.X[:, ii], self.target_model.Y[:, 0])
             axes[ii].set_xlabel(self.parameter_names[ii])
 
         axes[0].set_ylabel('Discrepancy')
@@ -1057,7 +1819,9 @@ class BOLFI(BayesianOptimization):
         if self.state['n_batches'] == 0:
             raise ValueError('Model is not fitted yet, please see the `fit` method.')
 
-        return BolfiPosterior(self.target_model, threshold=threshold, prior=ModelPrior(self.model))
+        return BolfiPosterior(self.target_model, threshold=threshold,
+                              prior=ModelPrior(self.model),
+                              client=self._acquisition_client)
 
     def sample(self, n_samples, warmup=None, n_chains=4, threshold=None, initials=None,
                algorithm='nuts', n_evidence=None, **kwargs):
@@ -4,7 +4,7 @@ import numpy as np
 import scipy.stats as ss
 import matplotlib.pyplot as plt
 
-from elfi.methods.bo.utils import minimize
+from elfi.methods.bo.utils import multistart_minimize
 
 
 logger = logging.getLogger(__name__)
@@ -39,13 +39,17 @@ class BolfiPosterior:
     prior : ScipyLikeDistribution, optional
         By default uniform distribution within model bounds.
     n_inits : int, optional
-        Number of initialization points in internal optimization.
+        Number of candidate points refined in internal optimization.
     max_opt_iters : int, optional
         Maximum number of iterations performed in internal optimization.
+    seed : int, optional
+    client : elfi.client.ClientBase, optional
+        Refine the candidate points of the threshold in parallel in the client. The
+        client is not kept in the posterior.
     """
 
     def __init__(self, model, threshold=None, prior=None, n_inits=10, max_opt_iters=1000,
-                 seed=0):
+                 seed=0, client=None):
         super(BolfiPosterior, self).__init__()
         self.threshold = threshold
         self.model = model
@@ -58,13 +62,14 @@ class BolfiPosterior:
 
         if self.threshold is None:
             # TODO: the evidence could be used for a good guess for starting locations
-            minloc, minval = minimize(self.model.predict_mean,
-                                      self.model.bounds,
-                                      self.model.predictive_gradient_mean,
-                                      self.prior,
-                                      self.n_inits,
-                                      self.max_opt_iters,
-                                      random_state=self.random_state)
+            minloc, minval = multistart_minimize(self.model.predict_mean,
+                                                 self.model.bounds,
+                                                 self.model.predictive_gradient_mean,
+                                                 self.prior,
+                                                 self.n_inits,
+                                                 self.max_opt_iters,
+                                                 random_state=self.random_state,
+                                                 client=client)
             self.threshold = minval
             logger.info("Using optimized minimum value (%.4f) of the GP discrepancy mean "
                         "function as a threshold" % (self.threshold))
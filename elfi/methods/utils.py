@@ -2,7 +2,9 @@ import logging
 from math import ceil
 
 import numpy as np
+import scipy.linalg as sl
 import scipy.stats as ss
+from scipy.special import logsumexp
 
 from elfi.model.elfi_model import ComputationContext
 import elfi.model.augmenter as augmenter
@@ -117,10 +119,19 @@ def weighted_var(x, weights=None):
 
 
 class GMDistribution:
-    """Gaussian mixture distribution with a shared covariance matrix."""
+    """Gaussian mixture distribution with a shared covariance matrix or a covariance
+    matrix for each component.
+
+    The densities are computed in the log space for all the components at once. The
+    covariances are factorized only once and the points are processed in chunks
+    to limit the memory use.
+    """
+
+    # Maximum number of point-component pairs evaluated at once
+    chunk_pairs = 2**20
 
     @classmethod
-    def pdf(cls, x, means, cov=1, weights=None):
+    def pdf(cls, x, means, cov=1, weights=None, client=None):
         """Evaluate the density at points x.
 
         Parameters
@@ -133,20 +144,71 @@ class GMDistribution:
         weights : array_like
             1d array of weights of the gaussian mixture components
         cov : array_like, float
-            a shared covariance matrix for the mixture components
+            a shared covariance matrix for the mixture components or a 3d array of
+            covariance matrices for each of them
+        client : elfi.client.ClientBase, optional
+            Evaluate the chunks of points in parallel in the client.
         """
+        return np.exp(cls.logpdf(x, means=means, cov=cov, weights=weights,
+                                 client=client))
 
+    @classmethod
+    def logpdf(cls, x, means, cov=1, weights=None, client=None):
+        """Evaluate the log density at points x.
+
+        Parameters
+        ----------
+        x : array_like
+            scalar, 1d or 2d array of points where to evaluate, observations in rows
+        means : array_like
+            means of the Gaussian mixture components
+        weights : array_like
+            1d array of weights of the gaussian mixture components
+        cov : array_like, float
+            a shared covariance matrix for the mixture components or a 3d array of
+            covariance matrices for each of them
+        client : elfi.client.ClientBase, optional
+            Evaluate the chunks of points in parallel in the client.
+        """
         means, weights = cls._normalize_params(means, weights)
 
         ndim = np.asanyarray(x).ndim
         if means.ndim == 1:
             x = np.atleast_1d(x)
-        if means.ndim == 2:
+            # Univariate components
+            x2d, means2d = x.reshape(-1, 1), means.reshape(-1, 1)
+        else:
             x = np.atleast_2d(x)
-
-        d = np.zeros(len(x))
-        for m, w in zip(means, weights):
-            d += w * ss.multivariate_normal.pdf(x, mean=m, cov=cov)
+            x2d, means2d = x, means
+        x2d = np.asarray(x2d, dtype=np.float64)
+
+        with np.errstate(divide='ignore'):
+            log_w = np.log(weights)
+
+        if np.ndim(cov) == 3:
+            # Whitening transformation of each component
+            chol = cls._cholesky(cov, means2d.shape[1])
+            eye = np.broadcast_to(np.eye(chol.shape[1]), chol.shape)
+            chol_inv = np.linalg.solve(chol, eye)
+            means_w = np.einsum('kij,kj->ki', chol_inv, means2d)
+            log_det = np.sum(np.log(np.diagonal(chol, axis1=1, axis2=2)), axis=1)
+            fn, args = _gm_local_logpdf_chunk, (means_w, chol_inv, log_w - log_det)
+            pair_size = means2d.shape[1]
+        else:
+            chol = cls._cholesky(cov, means2d.shape[1])
+            # Whiten the means once
+            means_w = sl.solve_triangular(chol, means2d.T, lower=True).T
+            fn, args = _gm_logpdf_chunk, (means_w, chol, log_w)
+            pair_size = 1
+
+        chunk_size = max(1, cls.chunk_pairs // (len(means2d)*pair_size))
+        chunks = [x2d[i:i + chunk_size] for i in range(0, len(x2d), chunk_size)]
+        if client is not None and len(chunks) > 1:
+            ids = [client.apply(fn, c, *args) for c in chunks]
+            d = [client.get_result(id) for id in ids]
+        else:
+            d = [fn(c, *args) for c in chunks]
+        d = np.concatenate(d) if d else np.zeros(0)
 
         # Cast to correct ndim
         if ndim == 0 or (ndim==1 and means.ndim==2):
@@ -154,9 +216,17 @@ class GMDistribution:
         else:
             return d
 
-    @classmethod
-    def logpdf(cls, x, means, cov=1, weights=None):
-        return np.log(cls.pdf(x, means=means, cov=cov, weights=weights))
+    @staticmethod
+    def _cholesky(cov, dim):
+        cov = np.asarray(cov, dtype=np.float64)
+        if cov.ndim == 0:
+            cov = cov * np.eye(dim)
+        elif cov.ndim == 1:
+            cov = np.diag(cov)
+        elif cov.ndim == 3:
+            # Lower triangular factors of all the components at once
+            return np.linalg.cholesky(cov)
+        return sl.cholesky(cov, lower=True)
 
     @classmethod
     def rvs(cls, means, cov=1, weights=None, size=1, random_state=None):
@@ -171,7 +241,8 @@ class GMDistribution:
         weights : array_like
             1d array of weights of the gaussian mixture components
         cov : array_like
-            a shared covariance matrix for the mixture components
+            a shared covariance matrix for the mixture components or a 3d array of
+            covariance matrices for each of them
         size : int or tuple
         random_state : np.random.RandomState or None
         """
@@ -181,6 +252,16 @@ class GMDistribution:
 
         inds = random_state.choice(len(means), size=size, p=weights)
         rvs = means[inds]
+        if np.ndim(cov) == 3:
+            # Factorize only the covariances of the chosen components
+            dim = 1 if means.ndim == 1 else means.shape[1]
+            chol = GMDistribution._cholesky(np.asarray(cov)[inds], dim)
+            z = random_state.standard_normal(chol.shape[:-1])
+            perturb = np.einsum('...ij,...j->...i', chol, z)
+            if means.ndim == 1:
+                perturb = perturb[..., 0]
+            return rvs + perturb
+
         perturb = ss.multivariate_normal.rvs(mean=means[0]*0,
                                              cov=cov,
                                              random_state=random_state,
@@ -199,6 +280,63 @@ class GMDistribution:
         return means, weights
 
 
+def _gm_logpdf_chunk(x, means_w, chol, log_weights):
+    """Log density of a Gaussian mixture at points x given the whitened means."""
+    dim = chol.shape[0]
+    x_w = sl.solve_triangular(chol, x.T, lower=True).T
+
+    # Squared Mahalanobis distances of all the point-component pairs
+    d2 = np.sum(x_w**2, axis=1)[:, None] + np.sum(means_w**2, axis=1)[None, :] \
+        - 2*x_w.dot(means_w.T)
+    np.maximum(d2, 0, out=d2)
+
+    log_norm = .5*dim*np.log(2*np.pi) + np.sum(np.log(np.diag(chol)))
+    return logsumexp(log_weights - .5*d2, axis=1) - log_norm
+
+
+def _gm_local_logpdf_chunk(x, means_w, chol_inv, log_weights):
+    """Log density of a Gaussian mixture at points x given the whitening transformations
+    and the whitened means of the components.
+
+    The log determinants of the components are assumed to be included in log_weights.
+    """
+    dim = chol_inv.shape[1]
+    x_w = np.einsum('kij,nj->nki', chol_inv, x)
+    d2 = np.sum((x_w - means_w[None, :, :])**2, axis=2)
+    return logsumexp(log_weights - .5*d2, axis=1) - .5*dim*np.log(2*np.pi)
+
+
+def gm_proposal_rvs(proposal, batch_size=1, random_state=None):
+    """Draw a batch of parameters from a Gaussian mixture proposal.
+
+    Parameters
+    ----------
+    proposal : tuple
+        (means, cov, weights) of the mixture, see `GMDistribution`
+    batch_size : int
+    random_state : np.random.RandomState, optional
+
+    Returns
+    -------
+    np.ndarray
+        2d array with the parameters in the columns
+    """
+    means, cov, weights = proposal
+    rvs = GMDistribution.rvs(means, cov, weights, size=batch_size,
+                             random_state=random_state)
+    return rvs.reshape(batch_size, -1)
+
+
+def gm_proposal_logpdf(x, proposal):
+    """Log density of a Gaussian mixture proposal at the parameters x."""
+    return np.asarray(GMDistribution.logpdf(x, *proposal)).reshape(-1)
+
+
+def take_column(x, index):
+    """Return a column of a 2d array, e.g. a parameter from a batch of proposals."""
+    return x[:, index]
+
+
 def numgrad(fn, x, h=None, replace_neg_inf=True):
     """Naive numeric gradient implementation for scalar valued functions.
 
@@ -72,10 +72,12 @@ class ComputationContext:
     pool : elfi.OutputPool
     num_submissions : int
         Number of submissions using this context.
+    dtype : dict
+        Data types for the floating point outputs of the nodes.
 
 
     """
-    def __init__(self, batch_size=None, seed=None, pool=None):
+    def __init__(self, batch_size=None, seed=None, pool=None, dtype=None):
         """
 
         Parameters
@@ -86,9 +88,13 @@ class ComputationContext:
             recommended for debugging
         observed : dict
         pool : elfi.OutputPool
+        dtype : dict, optional
+            Node names as keys and numpy dtypes as values. The floating point outputs
+            of the nodes, including their observed data, are cast to these types.
 
         """
         self.batch_size = batch_size or 1
+        self.dtype = dtype or {}
 
         # Synchronize the seed with the pool
         if seed is None:
@@ -1,11 +1,28 @@
 import os
 import io
+import bisect
+import logging
 import shutil
 import pickle
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 import numpy as np
 import numpy.lib.format as npformat
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on e.g. Windows. Concurrent mode is then not supported.
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
 
 class OutputPool:
     """Store node outputs to dictionary-like stores.
@@ -17,9 +34,23 @@ class OutputPool:
     See the `elfi.store.BatchStore` interface if you wish to implement your own ELFI
     compatible store.
 
+    In the write-behind mode `add_batch` returns immediately and a background thread
+    writes the batches to the stores. Batches that are still waiting to be written are
+    served from the queue. Call `sync` (or `close`) to make sure that all the batches
+    have been written.
+
+    With `read_ahead` set, the next batches are read from the stores to the memory in a
+    background thread while the current one is being used, so that sequential reuse of
+    a disk based pool is not bound by the reading.
+
+    Retention policies (see `elfi.store.RetentionPolicy`) limit which batches of a node
+    are stored. They are enforced when the batches are added, e.g. to keep the pool
+    within a disk budget in long runs.
+
     """
 
-    def __init__(self, outputs=None):
+    def __init__(self, outputs=None, write_behind=False, max_pending=10, read_ahead=0,
+                 retention=None):
         """
 
         Depending on the algorithm, some of these values may be reused
@@ -33,6 +64,16 @@ class OutputPool:
         outputs : list, dict, optional
             list of node names which to store or a dictionary with existing stores. The
             stores are created on demand.
+        write_behind : bool, optional
+            Write the batches to the stores in a background thread. Default False.
+        max_pending : int, optional
+            Maximum number of batches waiting to be written in the write-behind mode.
+            `add_batch` blocks when the limit is reached.
+        read_ahead : int, optional
+            Number of batches to prefetch after each loaded batch. Default 0.
+        retention : dict, optional
+            Retention policy or a list of them for the nodes, e.g.
+            `{'sim': KeepEvery(10), 'd': MaxBytes(2**30)}`.
             
         Returns
         -------
@@ -52,6 +93,26 @@ class OutputPool:
         self.batch_size = None
         self.seed = None
 
+        self.write_behind = write_behind
+        self.max_pending = max_pending
+        self.read_ahead = read_ahead
+
+        retention = retention or {}
+        self.retention = {node: list(p) if isinstance(p, (list, tuple)) else [p]
+                          for node, p in retention.items()}
+        self._init_threads()
+
+    def _init_threads(self):
+        self._pending = {}
+        self._queue = None
+        self._writer = None
+        self._writer_error = None
+        self._store_lock = threading.RLock()
+
+        self._prefetched = {}
+        self._prefetch_queue = None
+        self._prefetcher = None
+
     @property
     def context_set(self):
         return self.seed is not None and self.batch_size is not None
@@ -89,33 +150,269 @@ class OutputPool:
         """
 
         outputs = outputs or self.outputs
+        with self._store_lock:
+            prefetched = self._prefetched.pop(batch_index, None)
+        if isinstance(prefetched, dict):
+            return {k: v for k, v in prefetched.items() if k in outputs}
+
         batch = dict()
-        for output in outputs:
-            store = self.stores[output]
-            if store is None:
-                continue
-            if batch_index in store:
-                batch[output] = store[batch_index]
+        pending = self._pending.get(batch_index, {})
+        with self._store_lock:
+            for output in outputs:
+                if output in pending:
+                    batch[output] = pending[output]
+                    continue
+                store = self.stores[output]
+                if store is None:
+                    continue
+                if batch_index in store:
+                    batch[output] = store[batch_index]
         return batch
 
+    def get_all(self, node):
+        """Return all the stored outputs of a node concatenated over the batches.
+
+        See `get_range`.
+
+        Parameters
+        ----------
+        node : str
+
+        Returns
+        -------
+        np.ndarray or iterator
+        """
+        return self.get_range(node, 0, len(self))
+
+    def get_range(self, node, start, stop):
+        """Return the outputs of a node from batches [start, stop) concatenated.
+
+        If the store keeps the batches contiguously in an array (e.g. `ArrayPool`)
+        and all of them are stored, a read-only view (memory map) to the array is
+        returned without copying any data. Otherwise returns an iterator over
+        concatenated chunks of the stored batches, see `iter_chunks`.
+
+        Parameters
+        ----------
+        node : str
+        start : int
+            First batch index
+        stop : int
+            Batch index after the last one
+
+        Returns
+        -------
+        np.ndarray or iterator
+        """
+        store = self.stores[node]
+        if hasattr(store, 'view'):
+            view = store.view(start, stop)
+            if view is not None:
+                return view
+        return self.iter_chunks(node, start, stop)
+
+    def iter_chunks(self, node, start, stop, chunk_size=100):
+        """Iterate over the outputs of a node from batches [start, stop) in chunks.
+
+        Missing batches are skipped.
+
+        Parameters
+        ----------
+        node : str
+        start : int
+        stop : int
+        chunk_size : int, optional
+            Maximum number of batches concatenated into a chunk.
+
+        Returns
+        -------
+        iterator
+            Yields np.ndarrays
+        """
+        store = self.stores[node]
+        if store is None:
+            return
+
+        if hasattr(store, 'get_range'):
+            batches = (data for _, data in store.get_range(start, stop))
+        else:
+            batches = (store[bi] for bi in range(start, stop) if bi in store)
+
+        chunk = []
+        for data in batches:
+            chunk.append(data)
+            if len(chunk) == chunk_size:
+                yield np.concatenate(chunk)
+                chunk = []
+        if chunk:
+            yield np.concatenate(chunk)
+
+    def prefetch(self, batch_indices):
+        """Start reading the batches to the memory in a background thread.
+
+        The prefetched batches are returned (once) by `get_batch`.
+
+        Parameters
+        ----------
+        batch_indices : iterable
+        """
+        if self._prefetcher is None:
+            self._prefetch_queue = queue.Queue()
+            self._prefetcher = threading.Thread(target=self._prefetch_loop, daemon=True)
+            self._prefetcher.start()
+
+        for batch_index in batch_indices:
+            if batch_index not in self._prefetched:
+                # Mark as requested with a token that identifies this request
+                self._prefetched[batch_index] = object()
+                self._prefetch_queue.put(batch_index)
+
+    def _prefetch_loop(self):
+        while True:
+            batch_index = self._prefetch_queue.get()
+            if batch_index is None:
+                return
+            with self._store_lock:
+                token = self._prefetched.get(batch_index)
+                stores = [(output, store) for output, store in self.stores.items()
+                          if store is not None]
+            if token is None or isinstance(token, dict):
+                # Already consumed, invalidated or read
+                continue
+
+            # Read without holding the lock so that the I/O does not block the stores
+            batch = {}
+            try:
+                for output, store in stores:
+                    if batch_index in store:
+                        # Copy to read the data to the memory, e.g. from a memory map
+                        batch[output] = np.array(store[batch_index])
+            except KeyError:
+                # Removed in the meantime
+                batch = {}
+            except Exception:
+                logger.warning('Prefetching batch {} failed'.format(batch_index),
+                               exc_info=True)
+                batch = {}
+
+            with self._store_lock:
+                # Publish only if the request was not invalidated in the meantime
+                if self._prefetched.get(batch_index) is token:
+                    if batch:
+                        self._prefetched[batch_index] = batch
+                    else:
+                        del self._prefetched[batch_index]
+
     def add_batch(self, batch, batch_index):
         """Adds the outputs from the batch to their stores."""
-        for node, values in batch.items():
-            if node not in self.stores:
-                continue
-            store = self._get_store_for(node)
+        # The batch may have new outputs
+        with self._store_lock:
+            self._prefetched.pop(batch_index, None)
+        if not self.write_behind:
+            return self._write_batch(batch, batch_index)
+
+        if self._writer is None:
+            self._queue = queue.Queue(maxsize=self.max_pending)
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+
+        batch = {k: v for k, v in batch.items() if k in self.stores}
+        self._pending[batch_index] = batch
+        # Blocks if there are too many pending batches
+        self._queue.put((batch, batch_index))
+
+    def _write_batch(self, batch, batch_index):
+        with self._store_lock:
+            for node, values in batch.items():
+                if node not in self.stores:
+                    continue
+                store = self._get_store_for(node)
+
+                # Do not add again. The output should be the same.
+                if batch_index in store:
+                    continue
+
+                policies = self.retention.get(node, ())
+                keep = self.keeps(node, batch, batch_index)
+                for policy in policies:
+                    for evicted in policy.update(node, batch, batch_index, store, keep):
+                        if evicted in store:
+                            del store[evicted]
+
+                if keep:
+                    store[batch_index] = values
+
+    def keeps(self, node, batch, batch_index):
+        """Whether the output of `node` for the batch would be stored.
 
-            # Do not add again. The output should be the same.
-            if batch_index in store:
-                continue
+        Parameters
+        ----------
+        node : str
+        batch : dict
+            Outputs of the batch.
+        batch_index : int
+
+        Returns
+        -------
+        bool
+        """
+        return all(policy.keep(node, batch, batch_index)
+                   for policy in self.retention.get(node, ()))
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            batch, batch_index = item
+            try:
+                self._write_batch(batch, batch_index)
+            except Exception as e:
+                # The batch is kept pending so that it is not lost
+                logger.warning('Writing batch {} failed'.format(batch_index),
+                               exc_info=True)
+                self._writer_error = e
+            else:
+                self._pending.pop(batch_index, None)
+            finally:
+                self._queue.task_done()
 
-            store[batch_index] = values
+    def sync(self):
+        """Wait until all the pending batches have been written to the stores.
+
+        Raises the error of a failed write in the write-behind mode. The batches that
+        could not be written are still served by `get_batch`.
+        """
+        if self._queue is not None:
+            self._queue.join()
+        if self._writer_error is not None:
+            e, self._writer_error = self._writer_error, None
+            raise e
+
+    def close(self):
+        """Write the pending batches and stop the background threads."""
+        if self._prefetcher is not None:
+            self._prefetch_queue.put(None)
+            self._prefetcher.join()
+            self._prefetch_queue = None
+            self._prefetcher = None
+            self._prefetched.clear()
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._queue = None
+            self._writer = None
+        self.sync()
 
     def remove_batch(self, batch_index):
         """Removes the batch from all the stores."""
-        for store in self.stores.values():
-            if batch_index in store:
-                del store[batch_index]
+        self.sync()
+        with self._store_lock:
+            self._prefetched.pop(batch_index, None)
+            for store in self.stores.values():
+                if batch_index in store:
+                    del store[batch_index]
 
     def has_store(self, name):
         return name in self.stores
@@ -155,6 +452,8 @@ class OutputPool:
         store
             The removed store
         """
+        self.sync()
+        self._prefetched.clear()
         store = self.stores.pop(name)
         return store
 
@@ -172,12 +471,15 @@ class OutputPool:
 
     def __len__(self):
         """Largest batch index in any of the stores"""
-        l = 0
+        n = 0
         for output, store in self.stores.items():
             if store is None:
                 continue
-            l = max(l, len(store))
-        return l
+            n = max(n, len(store))
+        pending = list(self._pending)
+        if pending:
+            n = max(n, max(pending) + 1)
+        return n
 
     def __getitem__(self, batch_index):
         """Return the batch"""
@@ -191,9 +493,27 @@ class OutputPool:
 
     def clear(self):
         """Removes all data from the stores"""
+        self.sync()
+        self._prefetched.clear()
         for store in self.stores.values():
             store.clear()
 
+    def __getstate__(self):
+        self.sync()
+        state = self.__dict__.copy()
+        for key in ('_pending', '_queue', '_writer', '_writer_error', '_store_lock',
+                    '_prefetched', '_prefetch_queue', '_prefetcher'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('write_behind', False)
+        state.setdefault('max_pending', 10)
+        state.setdefault('read_ahead', 0)
+        state.setdefault('retention', {})
+        self.__dict__.update(state)
+        self._init_threads()
+
     @property
     def outputs(self):
         return list(self.stores.keys())
@@ -214,9 +534,19 @@ class ArrayPool(OutputPool):
     Internally the `elfi.ArrayPool` will create an `elfi.store.BatchArrayStore' object
     wrapping a `NpyPersistedArray` for each output. The `elfi.store.NpyPersistedArray`
     object is responsible for managing the `.npy` file.
+
+    In the concurrent mode several processes may use the same pool (same name and seed)
+    at the same time. The `.npy` files are then locked with `fcntl` during writes, each
+    store keeps an on-disk mask of the committed batches and batch ranges can be
+    reserved with `reserve_batches` so that the writers fill disjoint batch indices.
+
+    Outputs with a retention policy are stored to an
+    `elfi.store.CompactBatchArrayStore` that reuses the space of the removed batches
+    and is compacted when more than half of it is free.
     """
 
-    def __init__(self, outputs, name=None, path=None):
+    def __init__(self, outputs, name=None, path=None, concurrent=False,
+                 write_behind=False, max_pending=10, read_ahead=0, retention=None):
         """
 
         Parameters
@@ -228,18 +558,37 @@ class ArrayPool(OutputPool):
         path : str
             Path to directory under which `elfi.ArrayPool` will place its folders and
             files. Default is ./pools, where . is the current working directory.
+        concurrent : bool, optional
+            Allow multiple processes to write to and read from the pool at the same
+            time. Requires `fcntl` (POSIX systems). Default False.
+        write_behind : bool, optional
+            Write the batches to the files in a background thread, see `OutputPool`.
+        max_pending : int, optional
+            Maximum number of batches waiting to be written in the write-behind mode.
+        read_ahead : int, optional
+            Number of batches to prefetch from the files after each loaded batch.
+        retention : dict, optional
+            Retention policies for the outputs, see `OutputPool`.
             
         Returns
         -------
         instance : ArrayPool
         """
-        super(ArrayPool, self).__init__(outputs)
+        super(ArrayPool, self).__init__(outputs, write_behind=write_behind,
+                                        max_pending=max_pending, read_ahead=read_ahead,
+                                        retention=retention)
 
         if name is not None:
             # TODO: load the pool with this name
             pass
+        if concurrent and fcntl is None:
+            raise ValueError('Concurrent ArrayPool requires the fcntl module')
+        if concurrent and self.retention:
+            raise ValueError('Retention policies are not supported in the concurrent '
+                             'mode')
         self.name = name
         self.path = path or self._default_path()
+        self.concurrent = concurrent
         os.makedirs(self.path, exist_ok=True)
 
     @property
@@ -254,16 +603,67 @@ class ArrayPool(OutputPool):
             return None
         return self._arraypath(self.name, self.path)
 
+    def set_context(self, context):
+        super(ArrayPool, self).set_context(context)
+        if self.concurrent:
+            # Open the stores right away to see the data from the other processes
+            for name in self.outputs:
+                self._get_store_for(name)
+
     def _make_store_for(self, name):
         if not self.context_set:
             raise ValueError('Arraypool has no context set')
+        self._make_arraypath()
+
+        filename = os.path.join(self.arraypath, name)
+        array = NpyPersistedArray(filename, concurrent=self.concurrent)
+        if name in self.retention:
+            index = NpyPersistedArray(filename + '_index')
+            return CompactBatchArrayStore(array, self.batch_size, index)
+        if not self.concurrent:
+            return BatchArrayStore(array, self.batch_size)
+
+        mask = NpyPersistedArray(filename + '_mask', concurrent=True)
+        return BatchArrayStore(array, self.batch_size, mask=mask)
+
+    def _make_arraypath(self):
         if self.name is None:
             self.name = 'arraypool_{}'.format(self.seed)
-            os.makedirs(self.arraypath)
+            # Other processes may share the folder in the concurrent mode
+            os.makedirs(self.arraypath, exist_ok=self.concurrent)
+        elif self.concurrent:
+            os.makedirs(self.arraypath, exist_ok=True)
 
-        filename = os.path.join(self.arraypath, name)
-        array = NpyPersistedArray(filename)
-        return BatchArrayStore(array, self.batch_size)
+    def reserve_batches(self, n_batches):
+        """Reserve a range of consecutive batch indices for this process.
+
+        The reservations are recorded to the pool folder, so that concurrent writers
+        sharing the pool receive disjoint ranges. Batches are still stored with
+        `add_batch` (or through an inference method) using the reserved indices.
+
+        Parameters
+        ----------
+        n_batches : int
+
+        Returns
+        -------
+        batch_indices : range
+        """
+        if not self.concurrent:
+            raise ValueError('Reserving batches requires a concurrent ArrayPool')
+        if not self.context_set:
+            raise ValueError('Arraypool has no context set')
+        self._make_arraypath()
+
+        # The log holds the end index of each reservation made so far
+        log = NpyPersistedArray(os.path.join(self.arraypath, '_reservations'),
+                                concurrent=True)
+        with log.lock():
+            start = int(log[len(log) - 1]) if len(log) > 0 else 0
+            log.append(np.array([start + n_batches], dtype=np.int64))
+        log.close()
+
+        return range(start, start + n_batches)
 
     def delete(self):
         """Removes the folder and all the data in this pool."""
@@ -278,9 +678,10 @@ class ArrayPool(OutputPool):
 
         You can reopen the pool with ArrayPool.open.
         """
-        for store in self.stores.values():
-            if hasattr(store, 'array') and hasattr(store.array, 'close'):
-                store.array.close()
+        super(ArrayPool, self).close()
+        for array in self._store_arrays():
+            if hasattr(array, 'close'):
+                array.close()
         try:
             filename = os.path.join(self.arraypath, self._pkl_name())
             pickle.dump(self, open(filename, "wb" ) )
@@ -291,9 +692,17 @@ class ArrayPool(OutputPool):
 
     def flush(self):
         """Flushes all array files of the stores."""
+        self.sync()
+        for array in self._store_arrays():
+            if hasattr(array, 'flush'):
+                array.flush()
+
+    def _store_arrays(self):
         for store in self.stores.values():
-            if hasattr(store, 'array') and hasattr(store.array, 'flush'):
-                store.array.flush()
+            for attr in ('array', 'mask', 'index'):
+                array = getattr(store, attr, None)
+                if array is not None:
+                    yield array
 
     @classmethod
     def open(cls, name, path=None):
@@ -326,6 +735,313 @@ class ArrayPool(OutputPool):
 
 
 
+class CachedArrayPool(ArrayPool):
+    """An `ArrayPool` with a memory budgeted cache in front of the `.npy` stores.
+
+    Recently used batches are kept in memory until the total size of the cached
+    outputs exceeds `cache_size` bytes, after which the least recently used batches
+    are evicted. Batches are always written through to the disk, so evicting a batch
+    only drops it from the memory. This makes it fast to rerun inferences with the
+    pool without growing the memory usage without bound.
+
+    The cache hit and miss counts are available from `cache.hits` and `cache.misses`.
+    """
+
+    def __init__(self, outputs, cache_size=2**30, **kwargs):
+        """
+
+        Parameters
+        ----------
+        outputs : list
+            name of nodes whose output to store to a numpy .npy file.
+        cache_size : int, optional
+            Maximum number of bytes to keep in the memory. Default is 1 GiB.
+        kwargs
+            See `ArrayPool`
+
+        Returns
+        -------
+        instance : CachedArrayPool
+        """
+        super(CachedArrayPool, self).__init__(outputs, **kwargs)
+        self.cache = LRUBatchCache(cache_size)
+
+    def _make_store_for(self, name):
+        store = super(CachedArrayPool, self)._make_store_for(name)
+        return CachedBatchStore(store, self.cache, name)
+
+
+class RetentionPolicy:
+    """Decides which batches of a node are stored in an `OutputPool`.
+
+    The policies are enforced in `OutputPool.add_batch`. For every new batch of the
+    node the pool first asks `keep` from all the policies of the node and then calls
+    `update`, which may return previously stored batches to remove.
+    """
+
+    def keep(self, node, batch, batch_index):
+        """Whether to store the output of `node` from a new batch.
+
+        Parameters
+        ----------
+        node : str
+        batch : dict
+            Outputs of the batch. May have only some of the outputs.
+        batch_index : int
+
+        Returns
+        -------
+        bool
+        """
+        return True
+
+    def update(self, node, batch, batch_index, store, keep):
+        """Update the policy with a new batch.
+
+        Parameters
+        ----------
+        node : str
+        batch : dict
+        batch_index : int
+        store : BatchStore
+            The store of the node.
+        keep : bool
+            Whether the batch will be stored.
+
+        Returns
+        -------
+        evict : list
+            Batch indices to remove from the store.
+        """
+        return []
+
+
+class KeepEvery(RetentionPolicy):
+    """Keep only every k-th batch, e.g. for subsampling raw simulator outputs."""
+
+    def __init__(self, k):
+        self.k = k
+
+    def keep(self, node, batch, batch_index):
+        return batch_index % self.k == 0
+
+
+class DropIfStored(RetentionPolicy):
+    """Do not store the output if the outputs of the given nodes are in the batch.
+
+    Use e.g. to drop the raw simulator outputs once the summaries are stored.
+    """
+
+    def __init__(self, nodes):
+        """
+
+        Parameters
+        ----------
+        nodes : list
+            Names of the nodes whose outputs make this output unnecessary.
+        """
+        self.nodes = [nodes] if isinstance(nodes, str) else list(nodes)
+
+    def keep(self, node, batch, batch_index):
+        return not all(n in batch for n in self.nodes)
+
+
+class MaxBytes(RetentionPolicy):
+    """Limit the size of the store by removing the oldest batches."""
+
+    def __init__(self, max_bytes):
+        """
+
+        Parameters
+        ----------
+        max_bytes : int
+            Maximum size of the stored batches in bytes.
+        """
+        self.max_bytes = max_bytes
+        self._sizes = OrderedDict()
+
+    def keep(self, node, batch, batch_index):
+        return node not in batch or self._nbytes(batch[node]) <= self.max_bytes
+
+    def update(self, node, batch, batch_index, store, keep):
+        # Forget the batches that have been removed elsewhere
+        for bi in [bi for bi in self._sizes if bi not in store]:
+            del self._sizes[bi]
+        if not keep or node not in batch:
+            return []
+
+        nbytes = self._nbytes(batch[node])
+        total = sum(self._sizes.values()) + nbytes
+        evict = []
+        while self._sizes and total > self.max_bytes:
+            bi, size = self._sizes.popitem(last=False)
+            total -= size
+            evict.append(bi)
+        self._sizes[batch_index] = nbytes
+        return evict
+
+    @staticmethod
+    def _nbytes(values):
+        return np.asarray(values).nbytes
+
+
+class KeepBelowQuantile(RetentionPolicy):
+    """Keep only the batches whose smallest discrepancy is below a quantile of those of
+    all the batches seen so far.
+
+    Stored batches that fall above the quantile as more batches arrive are removed.
+    Batches without the discrepancy output are always kept. The quantile is exact for
+    the first `max_exact` batches and a streaming estimate after that.
+    """
+
+    def __init__(self, discrepancy, quantile, max_exact=1000):
+        """
+
+        Parameters
+        ----------
+        discrepancy : str
+            Name of the discrepancy node.
+        quantile : float
+            In range (0, 1].
+        max_exact : int, optional
+            Number of batches for which the quantile is computed exactly.
+        """
+        self.discrepancy = discrepancy
+        self.quantile = quantile
+        self.threshold = None
+        self._estimate = _StreamingQuantile(quantile, max_exact)
+        self._pending = None
+        self._stored = {}
+
+    def keep(self, node, batch, batch_index):
+        score = self._score(batch)
+        if score is None:
+            return True
+        # Cache the threshold for the update of the same batch
+        self._pending = (batch_index, score, self._estimate.value(score))
+        return score <= self._pending[2]
+
+    def update(self, node, batch, batch_index, store, keep):
+        # Forget the batches that have been removed elsewhere
+        for bi in [bi for bi in self._stored if bi not in store]:
+            del self._stored[bi]
+
+        score = self._score(batch)
+        if score is None:
+            return []
+
+        if self._pending is not None and self._pending[:2] == (batch_index, score):
+            self.threshold = self._pending[2]
+        else:
+            self.threshold = self._estimate.value(score)
+        self._pending = None
+        self._estimate.add(score)
+
+        evict = [bi for bi, s in self._stored.items() if s > self.threshold]
+        for bi in evict:
+            del self._stored[bi]
+        if keep:
+            self._stored[batch_index] = score
+        return evict
+
+    def _score(self, batch):
+        if self.discrepancy not in batch:
+            return None
+        return float(np.min(batch[self.discrepancy]))
+
+
+class _StreamingQuantile:
+    """Quantile of a stream of values.
+
+    The values are kept sorted until there are `max_exact` of them, after which the
+    quantile is estimated with the P-square algorithm in constant time and memory.
+
+    References
+    ----------
+    R. Jain and I. Chlamtac (1985). The P-square algorithm for dynamic calculation of
+    quantiles and histograms without storing observations. Communications of the ACM
+    28(10):1076-1085.
+    """
+
+    def __init__(self, quantile, max_exact=1000):
+        self.quantile = quantile
+        self.max_exact = max(max_exact, 5)
+        self.count = 0
+        self._sorted = []
+        # Heights, positions and desired positions of the five markers
+        self._q = None
+        self._n = None
+        self._desired = None
+
+    def value(self, x=None):
+        """Return the quantile, including the value x if given without adding it."""
+        if self._q is None:
+            values = self._sorted
+            if x is not None:
+                values = list(values)
+                bisect.insort(values, x)
+            return np.percentile(values, 100*self.quantile) if values else None
+
+        if x is None:
+            estimate = self
+        else:
+            estimate = _StreamingQuantile(self.quantile, self.max_exact)
+            estimate.count = self.count
+            estimate._q, estimate._n = self._q.copy(), self._n.copy()
+            estimate._desired = self._desired.copy()
+            estimate.add(x)
+        return estimate._q[4] if self.quantile == 1 else estimate._q[2]
+
+    def add(self, x):
+        self.count += 1
+        if self._q is None:
+            bisect.insort(self._sorted, x)
+            if len(self._sorted) == self.max_exact:
+                self._init_markers()
+            return
+
+        q, n = self._q, self._n
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = np.searchsorted(q, x, side='right') - 1
+        n[k + 1:] += 1
+        p = self.quantile
+        self._desired += [0, p/2, p, (1 + p)/2, 1]
+
+        for i in range(1, 4):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                # Piecewise parabolic prediction, or linear if it is not monotonic
+                qp = q[i] + d/(n[i + 1] - n[i - 1]) * \
+                    ((n[i] - n[i - 1] + d)*(q[i + 1] - q[i])/(n[i + 1] - n[i]) +
+                     (n[i + 1] - n[i] - d)*(q[i] - q[i - 1])/(n[i] - n[i - 1]))
+                if not q[i - 1] < qp < q[i + 1]:
+                    qp = q[i] + d*(q[i + d] - q[i])/(n[i + d] - n[i])
+                q[i] = qp
+                n[i] += d
+
+    def _init_markers(self):
+        values, p = self._sorted, self.quantile
+        last = len(values) - 1
+        desired = np.array([0, p/2, p, (1 + p)/2, 1])*last
+        n = np.round(desired).astype(int)
+        # The positions must be strictly increasing from 0 to last
+        for i in range(3, 0, -1):
+            n[i] = min(n[i], n[i + 1] - 1)
+        for i in range(1, 4):
+            n[i] = max(n[i], n[i - 1] + 1)
+        self._q = np.array([values[i] for i in n], dtype=float)
+        self._n = n.astype(float)
+        self._desired = desired
+        self._sorted = []
+
+
 class BatchStore:
     """Stores batches for a single node"""
     def __getitem__(self, batch_index):
@@ -349,12 +1065,11 @@ class BatchStore:
         raise NotImplementedError
 
 
-# TODO: add mask for missing items. It should replace the use of `current_index`.
-#       This should make it possible to also append further than directly to the end
-#       of current index or length of the array.
+# TODO: add mask for missing items also for the default case. It should replace the use
+#       of `current_index`.
 class BatchArrayStore(BatchStore):
     """Helper class to use arrays as data stores in ELFI"""
-    def __init__(self, array, batch_size, n_batches=0):
+    def __init__(self, array, batch_size, n_batches=0, mask=None):
         """
 
         Parameters
@@ -366,12 +1081,21 @@ class BatchArrayStore(BatchStore):
         n_batches : int
             When using pre allocated arrays, this keeps track of the number of batches
             currently stored to the array.
+        mask : NpyPersistedArray, optional
+            Boolean array with an item per batch index telling whether the batch is
+            stored. With a mask batches can be stored in any order, which is needed when
+            several processes write to the same array. Requires that `array` supports
+            `reserve`.
         """
         self.array = array
         self.batch_size = batch_size
         self.n_batches = n_batches
+        self.mask = mask
 
     def __contains__(self, batch_index):
+        if self.mask is not None:
+            return batch_index < len(self.mask) and bool(self.mask[batch_index])
+
         b = self._to_slice(batch_index).stop
         return batch_index < self.n_batches and b <= len(self.array)
 
@@ -382,7 +1106,16 @@ class BatchArrayStore(BatchStore):
     def __setitem__(self, batch_index, data):
         sl = self._to_slice(batch_index)
 
-        if batch_index in self:
+        if self.mask is not None:
+            # Grow the arrays if needed, write the data and only then commit the batch
+            is_new = batch_index not in self
+            self.array.reserve(sl.stop, data)
+            self.array[sl] = data
+            self.mask.reserve(batch_index + 1, np.zeros(1, dtype=bool))
+            self.mask[batch_index] = True
+            if is_new:
+                self.n_batches += 1
+        elif batch_index in self:
             self.array[sl] = data
         elif batch_index == self.n_batches:
             # Append a new batch
@@ -402,6 +1135,10 @@ class BatchArrayStore(BatchStore):
         if batch_index not in self:
             raise IndexError("Cannot remove, batch index {} is not in the array"
                              .format(batch_index))
+        elif self.mask is not None:
+            self.mask[batch_index] = False
+            self.n_batches -= 1
+            return
         elif batch_index != self.n_batches:
             raise IndexError("It is not yet possible to remove batches from the middle "
                              "of the array")
@@ -413,8 +1150,26 @@ class BatchArrayStore(BatchStore):
         self.n_batches -= 1
 
     def __len__(self):
+        if self.mask is not None:
+            return len(self.mask)
         return int(len(self.array)/self.batch_size)
 
+    def view(self, start, stop):
+        """Return a read-only view to the batches [start, stop) or None if some of them
+        are not stored."""
+        if self.mask is not None:
+            stored = stop <= len(self.mask) and bool(np.all(self.mask[start:stop]))
+        else:
+            stored = stop <= self.n_batches and self.batch_size*stop <= len(self.array)
+        if not stored:
+            return None
+
+        view = self.array[self.batch_size*start:self.batch_size*stop]
+        if isinstance(view, np.ndarray):
+            view = view.view()
+            view.flags.writeable = False
+        return view
+
     def _to_slice(self, batch_index):
         a = self.batch_size*batch_index
         return slice(a, a + self.batch_size)
@@ -422,9 +1177,430 @@ class BatchArrayStore(BatchStore):
     def clear(self):
         if hasattr(self.array, 'clear'):
             self.array.clear()
+        if self.mask is not None and len(self.mask) > 0:
+            self.mask.clear()
         self.n_batches = 0
 
 
+class CompactBatchArrayStore(BatchStore):
+    """Stores the batches to consecutive slots of an array in any order.
+
+    The batch index of each slot is kept in a separate index array. Slots of the removed
+    batches are reused by new batches and the arrays are compacted when more than half
+    of the slots are free, so the files do not grow beyond the batches that are kept.
+    """
+
+    def __init__(self, array, batch_size, index):
+        """
+
+        Parameters
+        ----------
+        array : NpyPersistedArray
+        batch_size : int
+        index : NpyPersistedArray
+            Batch index of each slot in `array` or -1 for a free slot.
+        """
+        self.array = array
+        self.batch_size = batch_size
+        self.index = index
+
+        self._slots = {}
+        self._free = set()
+        n_slots = len(index)
+        for slot, batch_index in enumerate(index[:n_slots] if n_slots else []):
+            if batch_index < 0:
+                self._free.add(slot)
+            else:
+                self._slots[int(batch_index)] = slot
+
+    def __contains__(self, batch_index):
+        return batch_index in self._slots
+
+    def __getitem__(self, batch_index):
+        return self.array[self._to_slice(self._slots[batch_index])]
+
+    def __setitem__(self, batch_index, data):
+        if batch_index in self._slots:
+            self.array[self._to_slice(self._slots[batch_index])] = data
+        elif self._free:
+            slot = min(self._free)
+            self._free.remove(slot)
+            self.array[self._to_slice(slot)] = data
+            self.index[slot] = batch_index
+            self._slots[batch_index] = slot
+        else:
+            self.array.append(data)
+            self.index.append(np.array([batch_index], dtype=np.int64))
+            self._slots[batch_index] = len(self.index) - 1
+
+    def __delitem__(self, batch_index):
+        if batch_index not in self._slots:
+            raise IndexError("Cannot remove, batch index {} is not in the array"
+                             .format(batch_index))
+        slot = self._slots.pop(batch_index)
+        self.index[slot] = -1
+        self._free.add(slot)
+
+        if len(self._free) > len(self._slots):
+            self.compact()
+
+    def __len__(self):
+        """Largest batch index + 1"""
+        return max(self._slots) + 1 if self._slots else 0
+
+    @property
+    def nbytes(self):
+        """Size of the stored batches in bytes."""
+        if not self._slots:
+            return 0
+        return len(self._slots)*self[next(iter(self._slots))].nbytes
+
+    def compact(self):
+        """Move the batches to the beginning of the arrays and truncate the free
+        slots."""
+        # Moving the batches in the slot order never overwrites a batch not yet moved
+        order = sorted(self._slots.items(), key=lambda item: item[1])
+        for new_slot, (batch_index, slot) in enumerate(order):
+            if new_slot != slot:
+                self.array[self._to_slice(new_slot)] = self.array[self._to_slice(slot)]
+                self.index[new_slot] = batch_index
+                self._slots[batch_index] = new_slot
+
+        n_slots = len(self._slots)
+        self.array.truncate(n_slots*self.batch_size)
+        self.index.truncate(n_slots)
+        self._free.clear()
+
+    def _to_slice(self, slot):
+        a = self.batch_size*slot
+        return slice(a, a + self.batch_size)
+
+    def clear(self):
+        if len(self.index) > 0:
+            self.array.clear()
+            self.index.clear()
+        self._slots.clear()
+        self._free.clear()
+
+
+class LRUBatchCache:
+    """Least recently used cache of batches with a limit on the total size in bytes.
+
+    Attributes
+    ----------
+    max_bytes : int
+    nbytes : int
+        Current size of the cached values.
+    hits : int
+    misses : int
+    evictions : int
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        """Return the cached value and mark it as the most recently used or None if
+        the key is not cached. Updates the hit and miss counters."""
+        if key not in self._items:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._items.move_to_end(key)
+        return self._items[key][0]
+
+    def put(self, key, value):
+        """Cache the value and evict the least recently used values if needed."""
+        self.remove(key)
+        nbytes = self._nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+
+        self._items[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self._items.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+            self.evictions += 1
+
+    def remove(self, key):
+        if key in self._items:
+            self.nbytes -= self._items.pop(key)[1]
+
+    def clear(self):
+        self._items.clear()
+        self.nbytes = 0
+
+    def keys(self):
+        return list(self._items.keys())
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    @staticmethod
+    def _nbytes(value):
+        return value.nbytes if hasattr(value, 'nbytes') else sys.getsizeof(value)
+
+    def __getstate__(self):
+        # Do not pickle the cached data
+        state = self.__dict__.copy()
+        state['_items'] = OrderedDict()
+        state['nbytes'] = 0
+        return state
+
+
+class CachedBatchStore(BatchStore):
+    """Serves batches of a store through a shared `LRUBatchCache`."""
+
+    def __init__(self, store, cache, name):
+        """
+
+        Parameters
+        ----------
+        store : BatchStore, dict
+            The underlying (disk) store.
+        cache : LRUBatchCache
+            Cache that may be shared with other stores.
+        name : str
+            Name of the store used in the cache keys.
+        """
+        self.store = store
+        self.cache = cache
+        self.name = name
+
+    @property
+    def array(self):
+        return getattr(self.store, 'array', None)
+
+    @property
+    def mask(self):
+        return getattr(self.store, 'mask', None)
+
+    @property
+    def index(self):
+        return getattr(self.store, 'index', None)
+
+    def __getitem__(self, batch_index):
+        key = (self.name, batch_index)
+        data = self.cache.get(key)
+        if data is None:
+            # Read the data to the memory, e.g. from a memory map
+            data = np.array(self.store[batch_index])
+            self.cache.put(key, data)
+        return data
+
+    def __setitem__(self, batch_index, data):
+        self.store[batch_index] = data
+        self.cache.put((self.name, batch_index), data)
+
+    def __delitem__(self, batch_index):
+        del self.store[batch_index]
+        self.cache.remove((self.name, batch_index))
+
+    def __contains__(self, batch_index):
+        return (self.name, batch_index) in self.cache or batch_index in self.store
+
+    def __len__(self):
+        return len(self.store)
+
+    def view(self, start, stop):
+        if hasattr(self.store, 'view'):
+            return self.store.view(start, stop)
+
+    def clear(self):
+        self.store.clear()
+        for key in self.cache.keys():
+            if key[0] == self.name:
+                self.cache.remove(key)
+
+
+class SqliteBatchStore(BatchStore):
+    """Stores the batches of a node to an SQLite database.
+
+    Arbitrary outputs, such as object arrays from `elfi.tools.vectorize` with
+    `dtype=False`, can be stored. Numeric arrays are stored as their raw buffer together
+    with their shape and dtype, other outputs are pickled. Several stores (nodes) can
+    share the same database file. The database is used in the write-ahead logging (WAL)
+    mode so that other processes can read it while batches are being written.
+
+    Examples
+    --------
+    >>> pool = OutputPool({'S1': SqliteBatchStore('pool.db', 'S1')})  # doctest: +SKIP
+
+    """
+
+    def __init__(self, filename, node, seed=None, timeout=30):
+        """
+
+        Parameters
+        ----------
+        filename : str
+            Path to the database file. Created if it does not exist.
+        node : str
+            Name of the node whose outputs are stored.
+        seed : int, optional
+            Seed of the computation context, recorded with each batch.
+        timeout : float, optional
+            Seconds to wait for a lock held by another connection.
+        """
+        self.filename = filename
+        self.node = node
+        self.seed = seed
+        self.timeout = timeout
+
+        self._init_connections()
+
+    def _init_connections(self):
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._connect()
+
+    @property
+    def _connection(self):
+        """The connection of the current thread.
+
+        SQLite connections cannot be shared between threads, so e.g. the write-behind
+        and prefetch threads of `OutputPool` open their own.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Each connection is used only in its thread but may be closed in any
+            connection = sqlite3.connect(self.filename, timeout=self.timeout,
+                                         check_same_thread=False)
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _connect(self):
+        with self._connection as c:
+            c.execute('PRAGMA journal_mode=WAL')
+            c.execute('CREATE TABLE IF NOT EXISTS batches ('
+                      'node TEXT NOT NULL, '
+                      'batch_index INTEGER NOT NULL, '
+                      'data BLOB, '
+                      'shape TEXT, '
+                      'dtype TEXT, '
+                      'seed INTEGER, '
+                      'wall_time REAL, '
+                      'PRIMARY KEY (node, batch_index))')
+
+    def __getitem__(self, batch_index):
+        row = self._connection.execute(
+            'SELECT data, shape, dtype FROM batches WHERE node=? AND batch_index=?',
+            (self.node, batch_index)).fetchone()
+        if row is None:
+            raise KeyError(batch_index)
+        return self._deserialize(*row)
+
+    def __setitem__(self, batch_index, data):
+        row = (self.node, batch_index) + self._serialize(data) + \
+              (self.seed, time.time())
+        with self._connection as c:
+            c.execute('INSERT OR REPLACE INTO batches VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+
+    def __delitem__(self, batch_index):
+        if batch_index not in self:
+            raise IndexError("Cannot remove, batch index {} is not in the store"
+                             .format(batch_index))
+        with self._connection as c:
+            c.execute('DELETE FROM batches WHERE node=? AND batch_index=?',
+                      (self.node, batch_index))
+
+    def __contains__(self, batch_index):
+        row = self._connection.execute(
+            'SELECT 1 FROM batches WHERE node=? AND batch_index=?',
+            (self.node, batch_index)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM batches WHERE node=?',
+                                        (self.node,)).fetchone()[0]
+
+    def get_range(self, start, stop):
+        """Iterate over the stored batches with indices in [start, stop) in order.
+
+        Parameters
+        ----------
+        start : int
+        stop : int
+
+        Returns
+        -------
+        iterator
+            Yields tuples (batch_index, data).
+        """
+        rows = self._connection.execute(
+            'SELECT batch_index, data, shape, dtype FROM batches '
+            'WHERE node=? AND batch_index>=? AND batch_index<? ORDER BY batch_index',
+            (self.node, start, stop))
+        for batch_index, data, shape, dtype in rows:
+            yield batch_index, self._deserialize(data, shape, dtype)
+
+    def get_meta(self, batch_index):
+        """Return the metadata stored with the batch.
+
+        Returns
+        -------
+        meta : dict
+            Keys `seed` and `wall_time`, the latter being the time of storing the batch
+            in seconds since the epoch.
+        """
+        row = self._connection.execute(
+            'SELECT seed, wall_time FROM batches WHERE node=? AND batch_index=?',
+            (self.node, batch_index)).fetchone()
+        if row is None:
+            raise KeyError(batch_index)
+        return dict(seed=row[0], wall_time=row[1])
+
+    def clear(self):
+        with self._connection as c:
+            c.execute('DELETE FROM batches WHERE node=?', (self.node,))
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+    @staticmethod
+    def _serialize(data):
+        if isinstance(data, np.ndarray) and not data.dtype.hasobject and \
+                data.dtype.fields is None:
+            return (np.ascontiguousarray(data).tobytes(), ','.join(map(str, data.shape)),
+                    data.dtype.str)
+        # Object and structured arrays and other outputs
+        return pickle.dumps(data), None, None
+
+    @staticmethod
+    def _deserialize(data, shape, dtype):
+        if dtype is None:
+            return pickle.loads(data)
+        shape = tuple(int(d) for d in shape.split(',') if d)
+        return np.frombuffer(data, dtype=np.dtype(dtype)).reshape(shape).copy()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_local', '_connections', '_connections_lock'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_connections()
+
+
 class NpyPersistedArray:
     """
 
@@ -432,7 +1608,11 @@ class NpyPersistedArray:
     -----
     - Supports only binary files.
     - Supports only .npy version 2.0
-    - See numpy.lib.npformat for documentation of the .npy format """
+    - See numpy.lib.npformat for documentation of the .npy format
+    - In the concurrent mode the file is locked with `fcntl.flock` for every write and
+      the header is rewritten right after the data. The header thus always describes
+      data that has been fully written and other processes can map it at any time.
+    """
 
     MAX_SHAPE_LEN = 2**64
 
@@ -440,7 +1620,7 @@ class NpyPersistedArray:
     HEADER_DATA_OFFSET = 12
     HEADER_DATA_SIZE_OFFSET = 8
 
-    def __init__(self, name, array=None, truncate=False):
+    def __init__(self, name, array=None, truncate=False, concurrent=False):
         """
 
         Parameters
@@ -451,7 +1631,13 @@ class NpyPersistedArray:
             Initial array
         truncate : bool
             Whether to truncate the file or not
+        concurrent : bool
+            Whether other processes may write to the file at the same time.
         """
+        if concurrent and fcntl is None:
+            raise ValueError('Concurrent mode requires the fcntl module')
+        self.concurrent = concurrent
+        self._lock_depth = 0
 
         self.header_length = None
         self.itemsize = None
@@ -471,7 +1657,16 @@ class NpyPersistedArray:
         self.name = name
 
         self.fs = None
-        if truncate is False and os.path.exists(self.name):
+        if concurrent:
+            # Never truncate a file that another process may have just created. Use
+            # unbuffered io so that reads always see the latest header.
+            fd = os.open(self.name, os.O_RDWR | os.O_CREAT)
+            self.fs = open(fd, 'r+b', buffering=0)
+            with self.lock():
+                if truncate and os.fstat(fd).st_size > 0:
+                    self.fs.truncate(0)
+                self._refresh()
+        elif truncate is False and os.path.exists(self.name):
             self.fs = open(self.name, 'r+b')
             self._init_from_file_header()
         else:
@@ -482,25 +1677,70 @@ class NpyPersistedArray:
             self.flush()
 
     def __getitem__(self, sl):
-        if self.header_length is None:
-            raise IndexError()
-        order = 'F' if self.fortran_order else 'C'
-        # TODO: do not recreate if nothing has changed
-        mmap = np.memmap(self.fs, dtype=self.dtype, shape=self.shape,
-                         offset=self.header_length, order=order)
+        with self.lock(shared=True):
+            self._refresh()
+            if self.header_length is None:
+                raise IndexError()
+            order = 'F' if self.fortran_order else 'C'
+            # TODO: do not recreate if nothing has changed
+            mmap = np.memmap(self.fs, dtype=self.dtype, shape=self.shape,
+                             offset=self.header_length, order=order)
         return mmap[sl]
 
     def __setitem__(self, sl, value):
-        if self.header_length is None:
-            raise IndexError()
-        order = 'F' if self.fortran_order else 'C'
-        mmap = np.memmap(self.fs, dtype=self.dtype, shape=self.shape,
-                         offset=self.header_length, order=order)
+        with self.lock(shared=True):
+            self._refresh()
+            if self.header_length is None:
+                raise IndexError()
+            order = 'F' if self.fortran_order else 'C'
+            mmap = np.memmap(self.fs, dtype=self.dtype, shape=self.shape,
+                             offset=self.header_length, order=order)
         mmap[sl] = value
 
     def __len__(self):
+        with self.lock(shared=True):
+            self._refresh()
         return self.shape[0] if self.shape else 0
 
+    @contextmanager
+    def lock(self, shared=False):
+        """Hold an advisory lock on the file in the concurrent mode.
+
+        Writes to the header and the length of the file are made under an exclusive lock
+        and header reads under a shared one. The lock is reentrant and does nothing if
+        the array is not concurrent.
+
+        Parameters
+        ----------
+        shared : bool
+            Acquire a shared (read) lock instead of an exclusive one.
+        """
+        if not self.concurrent or self.closed:
+            yield
+            return
+
+        if self._lock_depth == 0:
+            fcntl.flock(self.fs.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0:
+                fcntl.flock(self.fs.fileno(), fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Read the current header written possibly by another process."""
+        if not self.concurrent or self.closed:
+            return
+        if os.fstat(self.fs.fileno()).st_size == 0:
+            return
+        if self.header_length is None:
+            self._init_from_file_header()
+        else:
+            self.fs.seek(self.HEADER_DATA_SIZE_OFFSET)
+            self.shape = npformat.read_array_header_2_0(self.fs)[0]
+
     @property
     def size(self):
         return np.prod(self.shape)
@@ -510,21 +1750,60 @@ class NpyPersistedArray:
         if self.closed:
             raise ValueError('Array is not opened.')
 
-        if not self.initialized:
-            self._init_from_array(array)
+        with self.lock():
+            self._refresh()
+            if not self.initialized:
+                self._init_from_array(array)
 
-        if array.shape[1:] != self.shape[1:]:
-            raise ValueError("Appended array is of different shape")
-        elif array.dtype != self.dtype:
-            raise ValueError("Appended array is of different dtype")
+            if array.shape[1:] != self.shape[1:]:
+                raise ValueError("Appended array is of different shape")
+            elif array.dtype != self.dtype:
+                raise ValueError("Appended array is of different dtype")
 
-        # Append new data
-        self.fs.seek(0, 2)
-        self.fs.write(array.tobytes('C'))
-        self.shape = (self.shape[0] + len(array),) + self.shape[1:]
+            # Append new data
+            self.fs.seek(self.header_length + self.size*self.itemsize)
+            self.fs.write(array.tobytes('C'))
+            self.shape = (self.shape[0] + len(array),) + self.shape[1:]
 
-        # Only prepare the header bytes, need to be flushed to take effect
-        self._prepare_header_data()
+            # Only prepare the header bytes, need to be flushed to take effect
+            self._prepare_header_data()
+            if self.concurrent:
+                # Commit the appended data for the other processes
+                self._write_header_data()
+
+    def reserve(self, length, array=None):
+        """Grow the array with zeros so that it has at least `length` rows.
+
+        Lets several writers fill disjoint parts of the array with `__setitem__`.
+
+        Parameters
+        ----------
+        length : int
+            Minimum length (=`shape[0]`) of the array.
+        array : ndarray, optional
+            Example data for determining the dtype and shape of an uninitialized array.
+
+        Returns
+        -------
+        None
+        """
+        if self.closed:
+            raise ValueError('Array is not opened.')
+
+        with self.lock():
+            self._refresh()
+            if not self.initialized:
+                if array is None:
+                    raise ValueError('Cannot reserve space for an uninitialized array '
+                                     'without example data.')
+                self._init_from_array(array)
+            if length <= len(self):
+                return
+
+            self.shape = (length,) + self.shape[1:]
+            self.fs.truncate(self.header_length + self.size*self.itemsize)
+            self._prepare_header_data()
+            self._write_header_data()
 
     def _init_from_file_header(self):
         """Initialize the object from existing file"""
@@ -594,13 +1873,14 @@ class NpyPersistedArray:
         elif self.fs.closed:
             raise ValueError('Array has been closed')
 
-        # Reset length
-        self.shape = (length,) + self.shape[1:]
-        self._prepare_header_data()
-        self._write_header_data()
+        with self.lock():
+            # Reset length
+            self.shape = (length,) + self.shape[1:]
+            self._prepare_header_data()
+            self._write_header_data()
 
-        self.fs.seek(self.header_length + self.size*self.itemsize)
-        self.fs.truncate()
+            self.fs.seek(self.header_length + self.size*self.itemsize)
+            self.fs.truncate()
 
     def close(self):
         if self.initialized:
@@ -621,8 +1901,9 @@ class NpyPersistedArray:
         self.header_length = None
 
     def flush(self):
-        self._write_header_data()
-        self.fs.flush()
+        with self.lock():
+            self._write_header_data()
+            self.fs.flush()
 
     def __del__(self):
         self.close()
@@ -676,9 +1957,9 @@ class NpyPersistedArray:
     def __getstate__(self):
         if not self.fs.closed:
             self.flush()
-        return {'name': self.name}
+        return {'name': self.name, 'concurrent': self.concurrent}
 
     def __setstate__(self, state):
         name = state.pop('name')
-        self.__init__(name)
+        self.__init__(name, concurrent=state.get('concurrent', False))
 
@@ -43,6 +43,14 @@ def is_array(output):
     return hasattr(output, 'shape')
 
 
+def cast_floats(output, dtype):
+    """Cast a floating point array to dtype. Other outputs are returned as is."""
+    if is_array(output) and getattr(output, 'dtype', None) is not None and \
+            output.dtype.kind == 'f' and output.dtype != dtype:
+        return output.astype(dtype)
+    return output
+
+
 # NetworkX utils
 
 
@@ -1,6 +1,8 @@
 import pytest
 import time
 
+import numpy as np
+
 import elfi
 
 
@@ -45,15 +47,35 @@ def test_pool(sleep_model):
     assert td < 1.2
 
 
-
-
-
-
-
-
-
-
-
-
-
-
+@pytest.mark.usefixtures('with_all_clients')
+def test_pool_replay(ma2):
+    pool = elfi.OutputPool(ma2.parameter_names + ['S1', 'S2'])
+    rej = elfi.Rejection(ma2['d'], batch_size=100, pool=pool)
+    rej.sample(10, n_sim=2000)
+
+    # Change the distance and replay the stored summaries
+    d2 = elfi.Distance('cityblock', ma2['S1'], ma2['S2'], name='d2')
+    rej = elfi.Rejection(d2, batch_size=100, pool=pool)
+    res = rej.replay(10, quantile=.01, batches_per_chunk=3)
+    assert res.n_sim == 1000
+    assert np.all(np.diff(res.discrepancies) >= 0)
+
+    # The result equals running the sampler with the pool
+    rej = elfi.Rejection(d2, batch_size=100, pool=pool)
+    res_sampled = rej.sample(10, quantile=.01)
+    assert np.allclose(res.samples_array, res_sampled.samples_array)
+    assert res.threshold == res_sampled.threshold
+
+    # Store the new discrepancies while replaying
+    new_pool = elfi.OutputPool(['d2'])
+    new_pool.set_context(rej.computation_context)
+    replay = elfi.client.PoolReplay(ma2, rej.computation_context, ['d2'])
+    outputs = replay.compute(pool=new_pool)
+    assert len(new_pool) == 20
+    assert np.array_equal(new_pool[19]['d2'], outputs['d2'][-100:])
+
+    # Summaries that depend on the simulations cannot be replayed without them
+    S3 = elfi.Summary(lambda x: x[:, :2], ma2['MA2'], name='S3')
+    d3 = elfi.Distance('euclidean', S3, name='d3')
+    with pytest.raises(ValueError):
+        elfi.Rejection(d3, batch_size=100, pool=pool).replay(10)
@@ -1,9 +1,15 @@
+import pickle
+
+import GPy
 import pytest
 
 import numpy as np
+from scipy.optimize import approx_fprime
 
 import elfi
 import elfi.methods.bo.acquisition as acquisition
+from elfi.methods.bo.gp_regression import GPRegression, SparseGPRegression, RBF, \
+    Matern32, Matern52, Bias
 from elfi.methods.bo.gpy_regression import GPyRegression
 
 
@@ -127,3 +133,238 @@ def test_acquisition():
     assert new.shape == (n2, n_params)
     assert np.all((new[:, 0] >= bounds['a'][0]) & (new[:, 0] <= bounds['a'][1]))
     assert np.all((new[:, 1] >= bounds['b'][0]) & (new[:, 1] <= bounds['b'][1]))
+
+
+@pytest.mark.parametrize('batch_method', ['kriging_believer', 'constant_liar',
+                                          'local_penalization'])
+def test_batch_acquisition(batch_method):
+    n2 = 5
+    bounds = {'a': [-2, 3], 'b': [5, 6]}
+    random = np.random.RandomState(0)
+    x = np.column_stack((random.uniform(*bounds['a'], 10),
+                         random.uniform(*bounds['b'], 10)))
+    y = (x[:, 0] - 1)**2 + random.rand(10)
+    target_model = GPyRegression(['a', 'b'], bounds=bounds)
+    target_model.update(x, y)
+
+    acquisition_method = acquisition.LCBSC(target_model, batch_method=batch_method,
+                                           seed=0)
+    new = acquisition_method.acquire(n2, t=1)
+    assert new.shape == (n2, 2)
+    assert np.all((new[:, 0] >= bounds['a'][0]) & (new[:, 0] <= bounds['a'][1]))
+    assert np.all((new[:, 1] >= bounds['b'][0]) & (new[:, 1] <= bounds['b'][1]))
+    # The points are distinct
+    dist = np.sqrt(np.sum((new[:, None] - new[None])**2, axis=2))
+    assert np.all(dist[np.triu_indices(n2, 1)] > 1e-3)
+    # The model is not changed
+    assert target_model.n_evidence == 10
+
+    # The first point avoids the pending ones
+    pending = new[:2]
+    new = acquisition_method.acquire(1, t=1, pending=pending)
+    assert np.min(np.sqrt(np.sum((pending - new)**2, axis=1))) > 1e-3
+
+    with pytest.raises(ValueError):
+        acquisition.LCBSC(target_model, batch_method='foo')
+
+
+@pytest.mark.usefixtures('with_all_clients')
+def test_BO_batch_acquisition(ma2):
+    log_d = elfi.Operation(np.log, ma2['d'], name='log_d')
+    bounds = {n: (-2, 2) for n in ma2.parameter_names}
+    bo = elfi.BayesianOptimization(log_d, initial_evidence=10, update_interval=10,
+                                   batch_size=2, batches_per_acquisition=3,
+                                   bounds=bounds, async=True,
+                                   acq_batch_method='kriging_believer')
+    bo.infer(22)
+    assert bo.target_model.n_evidence == 22
+    acquired = bo.target_model.X[10:16]
+    assert len(np.unique(acquired, axis=0)) == 6
+
+
+def test_incremental_update():
+    bounds = {'a': (0, 1), 'b': (0, 1)}
+    random = np.random.RandomState(0)
+    x = random.uniform(0, 1, size=(40, 2))
+    y = np.sin(5*x[:, 0]) + x[:, 1]**2 + .1*random.randn(40)
+    x_test = random.uniform(0, 1, size=(5, 2))
+
+    models = [GPyRegression(['a', 'b'], bounds=bounds, incremental=inc)
+              for inc in (True, False)]
+    initial_gps = []
+    for gp in models:
+        gp.update(x[:10], y[:10], optimize=True)
+        initial_gps.append(gp._gp)
+        for i in range(10, 40, 3):
+            gp.update(x[i:i+3], y[i:i+3])
+    incremental, full = models
+
+    # The posterior is updated in place instead of rebuilding the GPy model
+    assert incremental._gp is initial_gps[0]
+    assert full._gp is not initial_gps[1]
+    assert incremental.n_evidence == full.n_evidence == 40
+    assert np.array_equal(incremental.X, full.X)
+    for a, b in zip(incremental.predict(x_test), full.predict(x_test)):
+        assert np.allclose(a, b)
+    assert np.allclose(incremental.predictive_gradients(x_test),
+                       full.predictive_gradients(x_test))
+    assert np.isclose(incremental._gp.log_likelihood(), full._gp.log_likelihood())
+
+    # Optimizing refactorizes with all the evidence
+    incremental.update(x[:1], y[:1], optimize=True)
+    assert incremental.n_evidence == 41
+
+
+def test_gp_regression():
+    bounds = {'a': (0, 1), 'b': (0, 1)}
+    random = np.random.RandomState(0)
+    x = random.uniform(0, 1, size=(30, 2))
+    y = np.sin(5*x[:, 0]) + x[:, 1]**2 + .1*random.randn(30)
+    x_test = random.uniform(0, 1, size=(7, 2))
+
+    kernels = [(RBF(2, 2., .3) + Bias(2, .5),
+                GPy.kern.RBF(2, 2., .3) + GPy.kern.Bias(2, .5)),
+               (Matern32(2, 1.5, [.3, .5]),
+                GPy.kern.Matern32(2, 1.5, [.3, .5], ARD=True)),
+               (Matern52(2, 1.5, .4), GPy.kern.Matern52(2, 1.5, .4))]
+    for kernel, gpy_kernel in kernels:
+        gp = GPRegression(['a', 'b'], bounds=bounds, kernel=kernel, noise_var=.01)
+        # Evidence added in two parts updates the cached factors
+        gp.update(x[:20], y[:20])
+        gp.update(x[20:], y[20:])
+        gpy = GPy.models.GPRegression(x, y[:, None], gpy_kernel, noise_var=.01)
+
+        assert np.allclose(gp.predict(x_test)[0], gpy.predict(x_test)[0])
+        assert np.allclose(gp.predict(x_test)[1], gpy.predict(x_test)[1])
+        assert np.allclose(gp.predict(x_test, noiseless=True)[1],
+                           gpy.predict_noiseless(x_test)[1])
+        assert np.isclose(gp.log_likelihood(), gpy.log_likelihood())
+
+        grad_mean, grad_var = gpy.predictive_gradients(x_test)
+        assert np.allclose(gp.predictive_gradients(x_test)[0], grad_mean[:, :, 0])
+        assert np.allclose(gp.predictive_gradients(x_test)[1], grad_var)
+
+        # Analytic gradients of the hyperparameter objective
+        log_params = np.log(np.r_[gp.kernel.get_params(), gp.noise_var])
+
+        def value(p):
+            return gp._objective(p, gp.X, gp.Y)[0]
+
+        assert np.allclose(gp._objective(log_params, gp.X, gp.Y)[1],
+                           approx_fprime(log_params, value, 1e-6), rtol=1e-4, atol=1e-4)
+
+    # The default kernel and the optimization
+    gp = GPRegression(['a', 'b'], bounds=bounds)
+    gp.update(x, y, optimize=True)
+    assert gp.n_evidence == 30
+    assert np.mean((gp.predict_mean(x) - y[:, None])**2) < .05
+
+    # The cached factors are not pickled
+    kopy = pickle.loads(pickle.dumps(gp))
+    assert kopy._L is None
+    assert np.allclose(kopy.predict(x_test)[0], gp.predict(x_test)[0])
+    kopy = gp.copy()
+    kopy.update(x_test, np.zeros(7), optimize=True)
+    assert gp.n_evidence == 30
+    assert not np.allclose(kopy.kernel.get_params(), gp.kernel.get_params())
+
+
+def test_sparse_gp_regression():
+    bounds = {'a': (0, 1), 'b': (0, 1)}
+    random = np.random.RandomState(0)
+    x = random.uniform(0, 1, size=(300, 2))
+    y = np.sin(5*x[:, 0]) + x[:, 1]**2 + .1*random.randn(300)
+    x_test = random.uniform(0, 1, size=(7, 2))
+
+    # With all evidence as inducing inputs the posterior is exact
+    kwargs = dict(kernel=RBF(2, 2., .3) + Bias(2, .5), noise_var=.01)
+    sparse = SparseGPRegression(['a', 'b'], bounds, max_inducing=50,
+                                inducing_threshold=1e-6, **kwargs)
+    exact = GPRegression(['a', 'b'], bounds, **kwargs)
+    for gp in (sparse, exact):
+        gp.update(x[:20], y[:20])
+        gp.update(x[20:30], y[20:30])
+    assert sparse.n_inducing == 30
+    assert np.allclose(sparse.predict(x_test)[0], exact.predict(x_test)[0])
+    assert np.allclose(sparse.predict(x_test)[1], exact.predict(x_test)[1])
+    assert np.allclose(sparse.predictive_gradients(x_test)[0],
+                       exact.predictive_gradients(x_test)[0], atol=1e-4)
+    assert np.allclose(sparse.predictive_gradients(x_test)[1],
+                       exact.predictive_gradients(x_test)[1], atol=1e-4)
+    assert np.isclose(sparse.log_likelihood(), exact.log_likelihood())
+
+    # The bound is maximized with analytic gradients over all evidence
+    log_params = np.log(np.r_[sparse.kernel.get_params(), sparse.noise_var])
+    value, grad = sparse._objective(log_params, sparse.X, sparse.Y)
+    assert np.isclose(value, exact._objective(log_params, exact.X, exact.Y)[0])
+    assert np.allclose(grad, exact._objective(log_params, exact.X, exact.Y)[1],
+                       rtol=1e-4, atol=1e-4)
+    gp = SparseGPRegression(['a', 'b'], bounds, max_inducing=5, noise_var=.01,
+                            kernel=kwargs['kernel'].copy())
+    gp.update(x, y)
+    log_params = np.log(np.r_[gp.kernel.get_params(), gp.noise_var])
+
+    def value(p):
+        return gp._objective(p, gp.X, gp.Y)[0]
+
+    assert np.isclose(value(log_params), -gp.log_likelihood() - gp.kernel.log_prior()[0])
+    assert np.allclose(gp._objective(log_params, gp.X, gp.Y)[1],
+                       approx_fprime(log_params, value, 1e-6), rtol=1e-4, atol=1e-4)
+    bound = gp.log_likelihood()
+    gp.optimize()
+    assert gp.log_likelihood() > bound
+
+    # Inducing inputs are added as the evidence arrives
+    gp = SparseGPRegression(['a', 'b'], bounds, max_inducing=40)
+    gp.update(x[:50], y[:50], optimize=True)
+    n_inducing = gp.n_inducing
+    for i in range(50, 300, 50):
+        gp.update(x[i:i + 50], y[i:i + 50])
+    assert gp.n_evidence == 300
+    assert n_inducing <= gp.n_inducing <= 40
+    assert np.all(gp.Z == x[gp._inducing])
+    assert np.mean((gp.predict_mean(x) - y[:, None])**2) < .05
+
+    # The incrementally updated statistics match the recomputed ones
+    mean, var = gp.predict(x_test)
+    P, b = gp._P, gp._b
+    gp._recompute()
+    gp._clear_cache()
+    assert np.allclose(gp._P, P) and np.allclose(gp._b, b)
+    assert np.allclose(gp.predict(x_test)[0], mean)
+    assert np.allclose(gp.predict(x_test)[1], var)
+
+    kopy = pickle.loads(pickle.dumps(gp))
+    assert kopy._K_nm is None
+    kopy.update(x_test, np.zeros(7))
+    assert kopy.n_evidence == 307
+    assert gp.n_evidence == 300
+
+
+def test_BO_with_gp_regression(ma2):
+    log_d = elfi.Operation(np.log, ma2['d'], name='log_d')
+    bounds = {'t1': (-2, 2), 't2': (-1, 1)}
+    target_model = GPRegression(ma2.parameter_names, bounds=bounds)
+    bolfi = elfi.BOLFI(log_d, initial_evidence=10, update_interval=5, batch_size=5,
+                       target_model=target_model)
+    bolfi.infer(20)
+    assert bolfi.target_model is target_model
+    assert target_model.n_evidence == 20
+
+    res = bolfi.sample(10, n_chains=2)
+    assert res.samples_array.shape == (10, 2)
+
+
+def test_parallel_acquisition(ma2):
+    bounds = {n: (-2, 2) for n in ma2.parameter_names}
+    bolfi = elfi.BOLFI(ma2, 'd', initial_evidence=10, update_interval=5, bounds=bounds,
+                       parallel_acquisition=True, seed=1)
+    assert bolfi.acquisition_method.client is bolfi.client
+    bolfi.infer(15)
+    assert bolfi.n_evidence == 15
+
+    # The client is used for the threshold but not kept in the posterior
+    posterior = bolfi.extract_posterior()
+    assert np.isfinite(posterior.threshold)
+    assert 'client' not in vars(posterior)
+    assert elfi.BOLFI(ma2, 'd', bounds=bounds).acquisition_method.client is None
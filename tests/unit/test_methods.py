@@ -1,10 +1,13 @@
 import pytest
 
+import networkx as nx
 import numpy as np
 
 import elfi
+import elfi.clients.native as native
 
-from elfi.methods.parameter_inference import ParameterInference
+from elfi.methods.parameter_inference import ParameterInference, SMC
+from elfi.methods.utils import GMDistribution
 
 
 def test_no_model_parameters(simple_model):
@@ -80,3 +83,302 @@ def test_BOLFI_short(ma2, distribution_test):
     grad_cached_mu, grad_cached_var = bolfi.target_model.predictive_gradients(x)
     assert(np.allclose(grad_mu[:,:,0], grad_cached_mu))
     assert(np.allclose(grad_var, grad_cached_var))
+
+
+def test_dtype_policy(ma2):
+    rej = elfi.Rejection(ma2['d'], batch_size=100, output_names=['S1'],
+                         dtype=np.float32)
+    res = rej.sample(10, quantile=.1)
+    assert res.outputs['d'].dtype == np.float32
+    assert res.outputs['S1'].dtype == np.float32
+    # Parameters are kept as is
+    assert res.outputs['t1'].dtype == np.float64
+    assert 't1' not in rej.computation_context.dtype
+
+    # The prior densities of the SMC weights are kept in full precision
+    smc = elfi.SMC(ma2['d'], batch_size=100, dtype=np.float32, seed=1)
+    res = smc.sample(50, thresholds=[.5, .3])
+    pdf_nodes = [smc.prior_logpdf] + \
+        list(nx.ancestors(smc.model.source_net, smc.prior_logpdf))
+    assert not set(pdf_nodes) & set(smc.computation_context.dtype)
+    assert res.outputs['d'].dtype == np.float32
+    for pop in res.populations:
+        assert pop.outputs[smc.prior_logpdf].dtype == np.float64
+        assert pop.weights.dtype == np.float64
+
+    rej = elfi.Rejection(ma2['d'], batch_size=100, dtype={'MA2': np.float32})
+    res = rej.sample(10, quantile=.1)
+    assert res.outputs['d'].dtype == np.float64
+
+
+def test_rejection_merge(ma2):
+    pool = elfi.OutputPool(['d', 't1'])
+    rej = elfi.Rejection(ma2['d'], batch_size=50, pool=pool)
+    res = rej.sample(20, n_sim=500)
+
+    d = np.concatenate([pool[i]['d'] for i in range(10)])
+    t1 = np.concatenate([pool[i]['t1'] for i in range(10)])
+    order = np.argsort(d)[:20]
+    assert np.array_equal(res.outputs['d'], d[order])
+    assert np.array_equal(res.samples['t1'], t1[order])
+    assert res.threshold == d[order[-1]]
+
+
+def test_rejection_spill(ma2, tmpdir):
+    rej = elfi.Rejection(ma2['d'], batch_size=50, output_names=['S1'], seed=1)
+    res = rej.sample(20, n_sim=2000)
+
+    rej = elfi.Rejection(ma2['d'], batch_size=50, output_names=['S1'], seed=1,
+                         spill_path=str(tmpdir))
+    res_spill = rej.sample(20, n_sim=2000)
+    assert set(rej.state['samples'].keys()) == {'d'}
+    # The spill files have been compacted
+    assert len(rej._spill['t1']) <= 4*20
+    for k, v in res.outputs.items():
+        assert np.array_equal(v, res_spill.outputs[k])
+    assert isinstance(res_spill.outputs['S1'], np.memmap)
+    assert res.threshold == res_spill.threshold
+
+
+def test_worker_filter(ma2):
+    for kwargs in (dict(n_sim=2000), dict(threshold=.3)):
+        results = []
+        for worker_filter in (False, True):
+            rej = elfi.Rejection(ma2['d'], batch_size=100, seed=1,
+                                 worker_filter=worker_filter)
+            results.append(rej.sample(50, **kwargs))
+        assert np.array_equal(results[0].samples_array, results[1].samples_array)
+        assert results[0].n_sim == results[1].n_sim
+
+    results = []
+    for worker_filter in (False, True):
+        smc = elfi.SMC(ma2['d'], batch_size=500, seed=1, worker_filter=worker_filter)
+        results.append(smc.sample(100, thresholds=[.5, .2]))
+    assert np.array_equal(results[0].samples_array, results[1].samples_array)
+
+    with pytest.raises(ValueError):
+        elfi.Rejection(ma2['d'], pool=elfi.OutputPool(['d']), worker_filter=True)
+
+
+def test_rejection_levels(ma2):
+    quantiles = [.1, .02, .05]
+    rej = elfi.Rejection(ma2['d'], batch_size=100, seed=1)
+    results = rej.sample(20, quantile=quantiles)
+    assert len(results) == 3
+    assert rej.state['n_sim'] == 1000
+
+    for q, res in zip(quantiles, results):
+        rej = elfi.Rejection(ma2['d'], batch_size=100, seed=1)
+        res_q = rej.sample(20, quantile=q)
+        assert np.array_equal(res.samples_array, res_q.samples_array)
+        assert res.n_sim == res_q.n_sim
+        assert res.threshold == res_q.threshold
+
+    rej = elfi.Rejection(ma2['d'], batch_size=100, seed=1)
+    results = rej.sample(20, threshold=[.5, .2])
+    assert np.all(results[1].discrepancies <= .2)
+    assert results[0].n_sim <= results[1].n_sim
+
+    with pytest.raises(ValueError):
+        rej.sample(20, quantile=[.1, .2], n_sim=1000)
+
+
+def test_rejection_several_discrepancies(ma2):
+    d2 = elfi.Distance('cityblock', ma2['S1'], ma2['S2'], name='d2')
+    rej = elfi.Rejection(ma2, discrepancy_name=['d', d2], batch_size=100, seed=1)
+    results = rej.sample(20, n_sim=1000)
+    assert list(results.keys()) == ['d', 'd2']
+    assert rej.state['n_sim'] == 1000
+
+    for d in ('d', 'd2'):
+        res = elfi.Rejection(ma2[d], batch_size=100, seed=1).sample(20, n_sim=1000)
+        assert np.array_equal(res.samples_array, results[d].samples_array)
+        assert results[d].discrepancy_name == d
+
+    # The samplers of the discrepancies share the model of the parent
+    assert all(r.model is rej.model for r in rej._rejections.values())
+
+    # The samplers of the discrepancies use the dtype of the parent
+    rej = elfi.Rejection(ma2, discrepancy_name=['d', d2], batch_size=100, seed=1,
+                         dtype=np.float32)
+    results = rej.sample(20, n_sim=1000)
+    assert results['d2'].outputs['d2'].dtype == np.float32
+
+    with pytest.raises(ValueError, match='single discrepancy'):
+        elfi.SMC(ma2, ['d', d2])
+
+
+def test_smc_reuse_pending(ma2):
+    thresholds = [.5, .3, .2]
+    smc = elfi.SMC(ma2['d'], batch_size=100, seed=1)
+    res = smc.sample(100, thresholds=thresholds)
+    rejection = smc._rejection
+
+    # The same rejection sampler is used in all the rounds
+    assert smc._rejection is rejection
+    assert res.populations[0].seed != res.populations[1].seed
+
+    smc = elfi.SMC(ma2['d'], batch_size=100, seed=1, reuse_pending=True)
+    smc.set_objective(100, thresholds)
+    n_reused = 0
+    while not smc.finished:
+        # Keep several batches pending
+        while smc.batches.num_pending < 3:
+            smc.batches.submit(smc.prepare_new_batch(smc.batches.next_index))
+        next_index = smc.batches.next_index - smc.batches.num_pending
+        n_reused += smc._batch_rounds[next_index] < smc.state['round']
+        smc.iterate()
+    smc.batches.cancel_pending()
+    res_reuse = smc.extract_result()
+
+    # Batches pending in the end of a round are used in the next one
+    assert n_reused > 0
+    assert sum(pop.n_batches for pop in res_reuse.populations) == smc.state['n_batches']
+    assert np.array_equal(res.populations[0].samples_array,
+                          res_reuse.populations[0].samples_array)
+    for pop, threshold in zip(res_reuse.populations, thresholds):
+        assert np.all(pop.weights >= 0) and np.sum(pop.weights) > 0
+        assert SMC._proposal_logpdf not in pop.outputs
+        assert np.all(pop.discrepancies <= threshold)
+
+    with pytest.raises(ValueError):
+        elfi.SMC(ma2['d'], reuse_pending=True, worker_filter=True)
+
+
+def test_smc_adaptive_thresholds(ma2):
+    N = 100
+    smc = elfi.SMC(ma2['d'], batch_size=100, seed=1)
+    res = smc.sample(N, quantile=.5, min_threshold=.3, max_rounds=6)
+    thresholds = smc.objective['thresholds']
+
+    assert res.n_populations == len(thresholds) <= 6
+    assert np.all(np.diff(thresholds) < 0)
+    assert min(thresholds) >= .3
+    # The first round takes the best half of the prior simulations
+    assert res.populations[0].n_sim == 2*N
+    for pop, threshold in zip(res.populations, thresholds):
+        assert np.all(pop.discrepancies <= threshold)
+        assert np.isclose(pop.threshold, threshold) or pop.threshold < threshold
+
+    # The simulation budget is checked between the rounds
+    smc = elfi.SMC(ma2['d'], batch_size=100, seed=1)
+    res_budget = smc.sample(N, quantile=.5, max_sim=1000)
+    n_sim = np.cumsum([pop.n_sim for pop in res_budget.populations])
+    assert n_sim[-1] >= 1000 > n_sim[-2]
+    assert np.array_equal(res.populations[1].samples_array,
+                          res_budget.populations[1].samples_array)
+
+    # The acceptance rate ends also a fixed schedule early
+    smc = elfi.SMC(ma2['d'], batch_size=100, seed=1)
+    res = smc.sample(N, thresholds=[.5, .2, .1], min_accept_rate=.9)
+    assert res.n_populations == 1
+
+    with pytest.raises(ValueError):
+        smc.set_objective(N, quantile=.5)
+
+
+def test_smc_covariance(ma2):
+    thresholds = [.5, .3, .2]
+    N = 200
+    results = {}
+    for covariance in ['diagonal', 'full', 'olcm']:
+        smc = elfi.SMC(ma2['d'], batch_size=100, seed=1, covariance=covariance)
+        results[covariance] = smc.sample(N, thresholds=thresholds)
+
+    n_params = len(ma2.parameter_names)
+    pop = results['full'].populations[0]
+    assert pop.cov.shape == (n_params, n_params)
+    assert not np.allclose(pop.cov, np.diag(np.diag(pop.cov)))
+
+    # A covariance matrix for each particle
+    pop = results['olcm'].populations[0]
+    assert pop.cov.shape == (N, n_params, n_params)
+    assert np.all(np.linalg.eigvalsh(pop.cov) > 0)
+    for res in results.values():
+        assert np.all(res.discrepancies <= thresholds[-1])
+        assert np.all(res.weights >= 0) and np.sum(res.weights) > 0
+
+    with pytest.raises(ValueError):
+        elfi.SMC(ma2['d'], covariance='local')
+
+
+def test_smc_worker_proposal(ma2):
+    thresholds = [.5, .3, .2]
+    N = 100
+    smc = elfi.SMC(ma2['d'], batch_size=100, seed=1, worker_proposal=True)
+    res = smc.sample(N, thresholds=thresholds)
+
+    # Only the proposal is sent with the batches
+    batch = smc.prepare_new_batch(smc.batches.next_index)
+    assert list(batch.keys()) == [SMC._proposal]
+
+    # The weights from the densities computed in the workers
+    for i in range(1, len(thresholds)):
+        prev, pop = res.populations[i - 1], res.populations[i]
+        assert SMC._proposal_logpdf not in pop.outputs
+        assert np.all(pop.discrepancies <= thresholds[i])
+        params = pop.samples_array
+        q_logpdf = GMDistribution.logpdf(params, prev.samples_array, prev.cov,
+                                         prev.weights)
+        assert np.allclose(pop.weights, np.exp(pop.outputs[smc.prior_logpdf] - q_logpdf))
+
+    smc = elfi.SMC(ma2['d'], batch_size=100, seed=1, worker_proposal=True)
+    res_same = smc.sample(N, thresholds=thresholds)
+    assert np.array_equal(res.samples_array, res_same.samples_array)
+
+
+def test_smc_recycle(ma2):
+    thresholds = [.6, .4, .3]
+    N = 200
+    smc = elfi.SMC(ma2['d'], batch_size=100, seed=1)
+    res = smc.sample(N, thresholds=thresholds)
+    smc = elfi.SMC(ma2['d'], batch_size=100, seed=1, recycle=True)
+    res_recycle = smc.sample(N, thresholds=thresholds)
+
+    # The first round is the same
+    assert np.array_equal(res.populations[0].samples_array,
+                          res_recycle.populations[0].samples_array)
+    assert res_recycle.n_sim < res.n_sim
+
+    n_sim = [pop.n_sim for pop in res_recycle.populations]
+    for i, pop in enumerate(res_recycle.populations[1:], 1):
+        assert pop.n_recycled > 0
+        assert pop.n_samples == N
+        assert np.all(pop.discrepancies <= thresholds[i])
+        assert SMC._proposal_logpdf not in pop.outputs
+
+        # Weighted by the mixture of the proposals of the rounds
+        params = pop.samples_array
+        q_pdf = n_sim[0]*np.exp(pop.outputs[smc.prior_logpdf])
+        for j in range(i):
+            prev = res_recycle.populations[j]
+            q_pdf += n_sim[j+1]*GMDistribution.pdf(params, prev.samples_array, prev.cov,
+                                                   prev.weights)
+        q_pdf /= sum(n_sim[:i+1])
+        assert np.allclose(pop.weights, np.exp(pop.outputs[smc.prior_logpdf])/q_pdf)
+
+    with pytest.raises(ValueError):
+        elfi.SMC(ma2['d'], recycle=True, reuse_pending=True)
+
+
+def test_smc_weights_in_client(ma2, monkeypatch):
+    thresholds = [.6, .4, .3]
+    res = elfi.SMC(ma2['d'], batch_size=100, seed=1).sample(100, thresholds=thresholds)
+
+    class CountingClient(native.Client):
+        n_applied = 0
+
+        def apply(self, kallable, *args, **kwargs):
+            self.n_applied += 1
+            return super().apply(kallable, *args, **kwargs)
+
+    # Split the evaluation of the proposal densities to several chunks
+    monkeypatch.setattr(GMDistribution, 'chunk_pairs', 1000)
+    smc = elfi.SMC(ma2['d'], batch_size=100, seed=1)
+    smc.client = CountingClient()
+    res_chunked = smc.sample(100, thresholds=thresholds)
+
+    assert smc.client.n_applied > 0
+    for pop, pop_chunked in zip(res.populations, res_chunked.populations):
+        assert np.array_equal(pop.samples_array, pop_chunked.samples_array)
+        assert np.allclose(pop.weights, pop_chunked.weights)
@@ -1,10 +1,16 @@
 import os
 import pickle
+import multiprocessing
+import threading
+import time
 
 import numpy as np
+import pytest
 
 import elfi
-from elfi.store import OutputPool, NpyPersistedArray, ArrayPool
+from elfi.model.elfi_model import ComputationContext
+from elfi.store import OutputPool, NpyPersistedArray, ArrayPool, CachedArrayPool, \
+    SqliteBatchStore, KeepEvery, DropIfStored, MaxBytes, KeepBelowQuantile
 
 
 def test_npy_persisted_array():
@@ -103,4 +109,330 @@ def test_array_pool(ma2):
     assert not os.path.exists(pool.arraypath)
 
 
+def _fill_reserved_batches(name, path, seed, batch_size, n_batches):
+    pool = ArrayPool(['x'], name=name, path=path, concurrent=True)
+    pool.set_context(ComputationContext(batch_size=batch_size, seed=seed))
+    for bi in pool.reserve_batches(n_batches):
+        pool.add_batch({'x': np.full((batch_size, 2), bi, dtype=float)}, bi)
+    pool.close()
+
+
+def test_concurrent_array_pool(tmpdir):
+    path = str(tmpdir)
+    seed, bs, n_batches, n_writers = 1, 7, 5, 4
+    args = ('concurrent', path, seed, bs, n_batches)
+
+    writers = [multiprocessing.Process(target=_fill_reserved_batches, args=args)
+               for i in range(n_writers)]
+    for w in writers:
+        w.start()
+
+    # Readers can follow the committed region while the writers are running
+    reader = ArrayPool(['x'], name='concurrent', path=path, concurrent=True)
+    reader.set_context(ComputationContext(batch_size=bs, seed=seed))
+    store = reader.get_store('x')
+
+    for w in writers:
+        w.join()
+        assert w.exitcode == 0
+
+    total = n_batches*n_writers
+    assert len(store) == total
+    for bi in range(total):
+        assert bi in store
+        assert np.all(reader.get_batch(bi)['x'] == bi)
+    assert total not in store
+
+    # Batches can be stored out of order and removed from the middle
+    reader.add_batch({'x': np.ones((bs, 2))}, total + 2)
+    assert total + 2 in store and total + 1 not in store
+    n_batches = store.n_batches
+    # Overwriting a committed batch does not count it again
+    store[total + 2] = np.zeros((bs, 2))
+    assert store.n_batches == n_batches
+    del store[3]
+    assert 3 not in store and 4 in store
+
+    # The data is a valid .npy file
+    loaded = np.load(os.path.join(reader.arraypath, 'x.npy'))
+    assert len(loaded) == (total + 3)*bs
+    reader.delete()
+
+
+def test_cached_array_pool(ma2, tmpdir):
+    bs = 100
+    batch_nbytes = bs*np.dtype(float).itemsize
+    # Room for three batches of 'S1'
+    pool = CachedArrayPool(['S1'], cache_size=3*batch_nbytes, path=str(tmpdir))
+    rej = elfi.Rejection(ma2['d'], batch_size=bs, pool=pool)
+    rej.sample(10, n_sim=5*bs)
+
+    assert len(pool) == 5
+    assert pool.cache.nbytes <= 3*batch_nbytes
+    assert len(pool.cache) == 3
+    assert pool.cache.evictions == 2
+
+    # The most recent batches are in the cache and the evicted ones are read from disk
+    disk = pool.stores['S1'].store
+    for bi in reversed(range(5)):
+        assert np.array_equal(pool.get_batch(bi)['S1'], disk[bi])
+    assert pool.cache.misses == 2
+    assert pool.cache.hits == 3
+
+    # The cache is not pickled with the pool
+    batch = np.array(disk[0])
+    pool.close()
+    pool = CachedArrayPool.open(pool.name, path=str(tmpdir))
+    assert len(pool.cache) == 0
+    assert np.array_equal(pool.get_batch(0)['S1'], batch)
+    pool.delete()
+
+
+def test_sqlite_batch_store(ma2, tmpdir):
+    filename = os.path.join(str(tmpdir), 'pool.db')
+    store = SqliteBatchStore(filename, 'S1', seed=123)
+
+    # Ragged outputs are stored as object arrays
+    ragged = np.empty(2, dtype=object)
+    ragged[:] = [np.arange(3), np.arange(5)]
+    store[0] = ragged
+    store[2] = np.arange(6, dtype=np.float32).reshape((3, 2))
+    assert 0 in store and 2 in store and 1 not in store
+    assert len(store) == 2
+    assert np.array_equal(store[0][1], np.arange(5))
+    assert store[2].dtype == np.float32 and store[2].shape == (3, 2)
+    assert [bi for bi, _ in store.get_range(0, 3)] == [0, 2]
+    assert store.get_meta(2)['seed'] == 123
+
+    # Readers see the batches and stores are picklable
+    reader = pickle.loads(pickle.dumps(store))
+    assert np.array_equal(reader[2], store[2])
+    del store[0]
+    assert 0 not in reader
+    store.clear()
+    assert len(reader) == 0
+
+    # Use it with an inference
+    pool = OutputPool({'S1': SqliteBatchStore(filename, 'S1')})
+    rej = elfi.Rejection(ma2['d'], batch_size=10, pool=pool)
+    rej.sample(5, n_sim=50)
+    assert len(pool) == 5
+    means = rej.sample(5, n_sim=50).sample_means_array
+
+    rej = elfi.Rejection(ma2['d'], batch_size=10, pool=pool)
+    assert np.array_equal(means, rej.sample(5, n_sim=50).sample_means_array)
+
+
+def test_pool_get_range(ma2, tmpdir):
+    bs, n_batches = 10, 6
+    pool = ArrayPool(['S1'], path=str(tmpdir))
+    rej = elfi.Rejection(ma2['d'], batch_size=bs, pool=pool)
+    rej.sample(5, n_sim=bs*n_batches)
+
+    # Array backed stores return a read-only view without copying
+    s1 = pool.get_all('S1')
+    assert isinstance(s1, np.memmap)
+    assert not s1.flags.writeable
+    assert len(s1) == bs*n_batches
+    assert np.array_equal(pool.get_range('S1', 2, 4),
+                          np.r_[pool[2]['S1'], pool[3]['S1']])
+
+    # Other stores are iterated in chunks
+    dict_pool = OutputPool({'S1': {bi: pool[bi]['S1'] for bi in range(n_batches)}})
+    chunks = list(dict_pool.get_all('S1'))
+    assert len(chunks) == 1
+    assert np.array_equal(chunks[0], s1)
+    del dict_pool.stores['S1'][1]
+    chunks = list(dict_pool.iter_chunks('S1', 0, n_batches, chunk_size=2))
+    assert [len(c) for c in chunks] == [2*bs, 2*bs, bs]
+    pool.delete()
+
+
+class _BlockingStore(dict):
+    def __init__(self, event):
+        self.event = event
+
+    def __setitem__(self, batch_index, data):
+        self.event.wait()
+        if data is None:
+            raise ValueError('No data')
+        super(_BlockingStore, self).__setitem__(batch_index, data)
+
+
+def test_write_behind_pool(ma2, tmpdir):
+    event = threading.Event()
+    pool = OutputPool({'x': _BlockingStore(event)}, write_behind=True, max_pending=2)
+    pool.add_batch({'x': np.ones(3), 'y': np.zeros(3)}, 0)
+
+    # Pending batches are served from the queue
+    assert 0 not in pool.stores['x']
+    assert np.array_equal(pool.get_batch(0)['x'], np.ones(3))
+    assert len(pool) == 1
+
+    event.set()
+    pool.sync()
+    assert np.array_equal(pool.stores['x'][0], np.ones(3))
 
+    # Write errors are raised at the barrier
+    pool.add_batch({'x': None}, 1)
+    with pytest.raises(ValueError):
+        pool.sync()
+    # The batch that failed is not lost
+    assert pool.get_batch(1) == {'x': None}
+    pool.close()
+
+    # The SQLite stores are written in the background thread
+    store = SqliteBatchStore(str(tmpdir.join('write_behind.db')), 'x')
+    pool = OutputPool({'x': store}, write_behind=True)
+    for i in range(3):
+        pool.add_batch({'x': np.full(3, i)}, i)
+    pool.close()
+    assert len(store) == 3
+    assert np.array_equal(store[2], np.full(3, 2))
+    store.close()
+
+    # The stored data equals to that of a synchronous pool
+    pool = ArrayPool(['S1'], path=str(tmpdir), write_behind=True)
+    rej = elfi.Rejection(ma2['d'], batch_size=10, pool=pool)
+    means = rej.sample(5, n_sim=100).sample_means_array
+    pool.close()
+
+    pool = ArrayPool.open(pool.name, path=str(tmpdir))
+    assert len(pool) == 10
+    pool2 = OutputPool(['S1'])
+    rej = elfi.Rejection(ma2['d'], batch_size=10, pool=pool2, seed=pool.seed)
+    assert np.array_equal(means, rej.sample(5, n_sim=100).sample_means_array)
+    for bi in range(10):
+        assert np.array_equal(pool[bi]['S1'], pool2[bi]['S1'])
+    pool.delete()
+
+
+def test_read_ahead_pool(ma2, tmpdir):
+    pool = ArrayPool(['S1', 'S2'], path=str(tmpdir))
+    rej = elfi.Rejection(ma2['d'], batch_size=10, pool=pool)
+    means = rej.sample(5, n_sim=100).sample_means_array
+    pool.close()
+
+    pool = ArrayPool.open(pool.name, path=str(tmpdir))
+    pool.prefetch(range(3))
+    batch = pool.get_batch(1)
+    assert np.array_equal(batch['S1'], pool.stores['S1'][1])
+    assert set(batch.keys()) == {'S1', 'S2'}
+
+    # Prefetched batches are invalidated when removed
+    pool2 = OutputPool(['x'])
+    pool2.add_batch({'x': np.ones(3)}, 0)
+    pool2.prefetch([0])
+    pool2.remove_batch(0)
+    assert pool2.get_batch(0) == {}
+    pool2.close()
+
+    # The stores are not locked while the prefetched data is read
+    reading, release = threading.Event(), threading.Event()
+
+    class SlowStore(dict):
+        def __getitem__(self, batch_index):
+            reading.set()
+            release.wait(5)
+            return super(SlowStore, self).__getitem__(batch_index)
+
+    pool3 = OutputPool({'x': SlowStore({0: np.ones(3)})})
+    pool3.prefetch([0])
+    assert reading.wait(5)
+    start = time.time()
+    pool3.add_batch({'x': np.zeros(3)}, 1)
+    assert 1 in pool3.stores['x'] and time.time() - start < 1
+    release.set()
+    assert np.array_equal(pool3.get_batch(0)['x'], np.ones(3))
+    pool3.close()
+
+    # The SQLite stores are read in the prefetch thread
+    store = SqliteBatchStore(str(tmpdir.join('prefetch.db')), 'x')
+    store[0] = np.ones(3)
+    pool4 = OutputPool({'x': store})
+    pool4.prefetch([0])
+    for _ in range(500):
+        if isinstance(pool4._prefetched.get(0), dict):
+            break
+        time.sleep(.01)
+    assert isinstance(pool4._prefetched.get(0), dict)
+    assert np.array_equal(pool4.get_batch(0)['x'], np.ones(3))
+    pool4.close()
+    store.close()
+
+    pool.read_ahead = 3
+    rej = elfi.Rejection(ma2['d'], batch_size=10, pool=pool)
+    assert np.array_equal(means, rej.sample(5, n_sim=100).sample_means_array)
+    pool.close()
+    pool.delete()
+
+
+def test_retention_policies(tmpdir):
+    batch_size = 10
+    retention = {'sim': [DropIfStored('S1'), KeepEvery(2)],
+                 'S1': MaxBytes(3*batch_size*8),
+                 'd': KeepBelowQuantile('d', .5)}
+    pool = ArrayPool(['sim', 'S1', 'd'], path=str(tmpdir), retention=retention)
+    pool.set_context(ComputationContext(batch_size, seed=1))
+
+    for bi in range(10):
+        pool.add_batch({'sim': np.full(batch_size, bi, dtype=float)}, bi)
+    assert [bi for bi in range(10) if bi in pool.stores['sim']] == [0, 2, 4, 6, 8]
+    assert np.all(pool.stores['sim'][4] == 4)
+
+    pool.add_batch({'sim': np.zeros(batch_size), 'S1': np.zeros(batch_size)}, 10)
+    assert 10 not in pool.stores['sim']
+
+    for bi in range(6):
+        pool.add_batch({'S1': np.full(batch_size, bi, dtype=float)}, bi)
+    assert [bi for bi in range(6) if bi in pool.stores['S1']] == [3, 4, 5]
+    assert pool.stores['S1'].nbytes == 3*batch_size*8
+    # Space of the removed batches is reused
+    assert len(pool.stores['S1'].array) == 3*batch_size
+    assert np.all(pool.stores['S1'][5] == 5)
+
+    # Decreasing discrepancies keep only the latest batches
+    for bi in range(8):
+        pool.add_batch({'d': np.full(batch_size, 10. - bi)}, bi)
+    kept = [bi for bi in range(8) if bi in pool.stores['d']]
+    assert kept == [4, 5, 6, 7]
+    # Compaction leaves no free space in the file
+    assert len(pool.stores['d'].array) <= 2*len(kept)*batch_size
+    for bi in kept:
+        assert np.all(pool.stores['d'][bi] == 10. - bi)
+
+    pool.close()
+    pool = ArrayPool.open(pool.name, path=str(tmpdir))
+    assert [bi for bi in range(8) if bi in pool.stores['d']] == kept
+    assert np.all(pool.stores['d'][7] == 3.)
+    pool.delete()
+
+
+def test_keep_below_quantile_streaming():
+    scores = np.random.RandomState(0).gamma(2, size=5000)
+    policy = KeepBelowQuantile('d', .2, max_exact=100)
+    store = {}
+    for bi, score in enumerate(scores):
+        batch = {'d': np.array([score, score + 1])}
+        keep = policy.keep('d', batch, bi)
+        for evicted in policy.update('d', batch, bi, store, keep):
+            del store[evicted]
+        if keep:
+            store[bi] = score
+    # Memory is bounded after the first max_exact batches
+    assert len(policy._estimate._sorted) == 0
+    assert np.isclose(policy.threshold, np.percentile(scores, 20), rtol=.02)
+    assert all(s <= policy.threshold for s in store.values())
+
+
+def test_retention_with_inference(ma2, tmpdir):
+    pool = ArrayPool(['MA2', 'S1'], path=str(tmpdir),
+                     retention={'MA2': DropIfStored('S1')})
+    rej = elfi.Rejection(ma2['d'], batch_size=10, pool=pool)
+    means = rej.sample(5, n_sim=50).sample_means_array
+    assert len(pool.stores['S1']) == 5
+    assert len(pool.stores['MA2']) == 0
+
+    rej = elfi.Rejection(ma2['d'], batch_size=10, pool=pool)
+    assert np.array_equal(means, rej.sample(5, n_sim=50).sample_means_array)
+    pool.delete()
@@ -4,7 +4,8 @@ import scipy.stats as ss
 import elfi
 from elfi.methods.utils import weighted_var, GMDistribution, normalize_weights, \
     ModelPrior, numgrad
-from elfi.methods.bo.utils import stochastic_optimization, minimize
+from elfi.methods.bo.utils import stochastic_optimization, minimize, multistart_minimize
+import elfi.clients.native as native
 
 
 def test_stochastic_optimization():
@@ -34,6 +35,32 @@ def test_minimize_with_approx_gradient():
     assert np.allclose(loc, np.array([0, 1]), atol=0.02)
 
 
+def test_multistart_minimize():
+    # Vectorized over the rows of x
+    def fun(x):
+        return x[:, 0]**2 + (x[:, 1] - 1)**4 - np.exp(-20*np.sum((x - 1.5)**2, axis=1))
+
+    def grad(x):
+        return np.column_stack((2*x[:, 0], 4*(x[:, 1] - 1)**3)) + \
+            40*(x - 1.5)*np.exp(-20*np.sum((x - 1.5)**2, axis=1))[:, None]
+
+    bounds = ((-2, 2), (-2, 3))
+    for kwargs in [dict(grad=grad), dict(), dict(grad=grad, client=native.Client())]:
+        loc, val = multistart_minimize(fun, bounds,
+                                       random_state=np.random.RandomState(0), **kwargs)
+        assert np.isclose(val, 0, atol=0.01)
+        assert np.allclose(loc, np.array([0, 1]), atol=0.02)
+
+    # The candidates are drawn from the prior and clipped to the bounds
+    m = elfi.ElfiModel()
+    elfi.Prior('norm', 0, .5, model=m, name='a')
+    elfi.Prior('norm', 1, 5, model=m, name='b')
+    prior = ModelPrior(m)
+    loc, val = multistart_minimize(fun, bounds, grad, prior=prior, n_candidates=50,
+                                   random_state=np.random.RandomState(0))
+    assert np.isclose(val, 0, atol=0.01)
+
+
 def test_weighted_var():
     # 1d case
     std = .3
@@ -79,6 +106,31 @@ class TestGMDistribution:
         # Distribution_test with 3d means
         distribution_test(GMDistribution, means, weights=weights)
 
+    def test_logpdf(self):
+        random = np.random.RandomState(0)
+        means = random.randn(50, 3)
+        weights = random.rand(50)
+        cov = np.array([[1., .3, 0], [.3, 2., .1], [0, .1, .5]])
+        x = random.randn(20, 3)
+
+        d_true = np.zeros(len(x))
+        for m, w in zip(means, normalize_weights(weights)):
+            d_true += w*ss.multivariate_normal.pdf(x, mean=m, cov=cov)
+        assert np.allclose(GMDistribution.logpdf(x, means, cov, weights), np.log(d_true))
+
+        # Chunked evaluation gives the same result
+        chunk_pairs = GMDistribution.chunk_pairs
+        GMDistribution.chunk_pairs = 100
+        try:
+            assert np.allclose(GMDistribution.pdf(x, means, cov, weights), d_true)
+        finally:
+            GMDistribution.chunk_pairs = chunk_pairs
+
+        # Far away points do not underflow
+        logpdf = GMDistribution.logpdf(x + 100, means, cov, weights)
+        assert np.all(np.isfinite(logpdf))
+        assert np.all(logpdf < -1000)
+
     def test_rvs(self):
         means = [[1000, 3], [-1000, -3]]
         weights = [.3, .7]
@@ -93,6 +145,35 @@ class TestGMDistribution:
         # Test that the mean of the second mode is correct
         assert np.abs(np.mean(rvs[:,1]) + 3) < .1
 
+    def test_component_covs(self):
+        random = np.random.RandomState(0)
+        means = random.randn(30, 2)
+        weights = random.rand(30)
+        a = random.randn(30, 2, 2)
+        covs = np.einsum('kij,klj->kil', a, a) + .1*np.eye(2)
+        x = random.randn(20, 2)
+
+        d_true = np.zeros(len(x))
+        for m, c, w in zip(means, covs, normalize_weights(weights)):
+            d_true += w*ss.multivariate_normal.pdf(x, mean=m, cov=c)
+        assert np.allclose(GMDistribution.pdf(x, means, covs, weights), d_true)
+        assert GMDistribution.pdf(x[0], means, covs, weights).ndim == 0
+
+        # The same covariance for each component equals a shared covariance
+        shared = np.broadcast_to(covs[0], covs.shape)
+        assert np.allclose(GMDistribution.logpdf(x, means, shared, weights),
+                           GMDistribution.logpdf(x, means, covs[0], weights))
+
+        # Variates around each component follow its covariance
+        means = [[1000, 3], [-1000, -3]]
+        covs = [[[1, .9], [.9, 1]], [[4, 0], [0, .25]]]
+        rvs = GMDistribution.rvs(means, covs, weights=[.3, .7], size=10000,
+                                 random_state=random)
+        first = rvs[rvs[:, 0] > 0]
+        assert np.abs(len(first)/10000 - .3) < .02
+        assert np.allclose(np.cov(first, rowvar=False), covs[0], atol=.1)
+        assert np.allclose(np.cov(rvs[rvs[:, 0] < 0], rowvar=False), covs[1], atol=.2)
+
 
 def test_numgrad():
     assert np.allclose(numgrad(lambda x: np.log(x), 3), [1/3])